@@ -1,27 +1,318 @@
 import time
-import pandas as pd
-import numpy as np
+import os
+import sys
+import json
+import math
+import argparse
+import threading
 import datetime
 
-pd.options.display.max_columns = None
+# pandas and NumPy are imported in the background by numeric_stack(), so that the
+# first prompt appears without waiting for them
+pd = None
+np = None
+numeric_import = None
 
 CITY_DATA = { 'chicago': 'chicago.csv',
               'new york city': 'new_york_city.csv',
               'washington': 'washington.csv' }
 
-mth_order = ['Jan','Feb','Mar','Apr','May','Jun']
+# The data files may also be gzip or zstd compressed (e.g. chicago.csv.gz)
+COMPRESSED_SUFFIXES = ['.gz', '.zst']
+
+# Declared column types of the data files, so the parser does not infer them
+TRIP_DTYPES = {'Trip Duration': 'float64',
+               'Start Station': 'object',
+               'End Station': 'object',
+               'User Type': 'object',
+               'Gender': 'object',
+               'Birth Year': 'float64'}
+TRIP_DATES = ['Start Time', 'End Time']
+
+# Each data file has a catalog of its metadata next to it (see update_catalog)
+CATALOG_SUFFIX = '.catalog.json'
+
+# The cleaned data is cached next to the data file (see write_clean), and trips that
+# fail validation are listed in a quarantine file (see clean_trips)
+CLEAN_SUFFIX = '.clean.npz'
+QUARANTINE_SUFFIX = '.quarantine.csv'
+
+# Raised whenever the prepared columns change, so that older caches are rebuilt
+CLEAN_FORMAT = 3
+
+# The months reported for a city are those its data covers, in calendar order (see report_months)
+month_names = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
 day_order = ['Mon','Tue','Wed','Thu','Fri','Sat','Sun']
+gender_order = ['Female','Male','Unknown']
+age_order = ['N/A','<18','18-29','30\'s','40\'s','50\'s','60\'s','70+']
+time_order = ['1am-5am','5am-9am','9am-1pm','1pm-5pm','5pm-9pm','9pm-1am']
+duration_bands = ['5 min','10 min','15 min','20 min','1 hr','3 hr','6 hr','>6 hr']
+variance_bands = ['1 sec','5 sec','1 min','10 min','1 hr','6 hr','24 hr','>24 hr']
+user_type_order = {'chicago': ['Customer','Dependent','Subscriber'],
+                   'new york city': ['Customer','Subscriber','Unknown'],
+                   'washington': ['Customer','Subscriber']}
+
+# Common schema for the user columns, applied to every city at load.  The value is
+# recorded where a trip is missing a value, or where a city does not collect the
+# column at all (Washington has no Gender or Birth Year)
+null_values = {'User Type': 'Unknown', 'Gender': 'Unknown', 'Birth Year': 0}
+
+# Trips longer than this (in seconds), and users older than this (in years), fail
+# validation at load (see clean_trips)
+MAX_TRIP_DURATION = 30 * 86400
+AGE_LIMIT = 90
+
+# Relative accuracy of the trip duration quantile sketches (1%)
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# Enough buckets to cover durations of up to ten years
+SKETCH_BUCKETS = math.ceil(math.log(10 * 365 * 86400) / math.log(SKETCH_GAMMA)) + 1
+
+# Sampling mode is offered for files larger than SAMPLE_THRESHOLD bytes.  Samples
+# are drawn from the lines of the file, SAMPLE_BLOCK bytes at a time, stratified by
+# the year, month and day of the week of the Start Time (for SAMPLE_YEARS years from
+# SAMPLE_YEAR)
+SAMPLE_THRESHOLD = 100 * 1024**2
+SAMPLE_FRACTION = 0.05
+SAMPLE_BLOCK = 16 * 1024**2
+SAMPLE_YEAR = 1900
+SAMPLE_YEARS = 300
+
+# Memory available for a city's data (set with --memory-budget).  Data estimated
+# to need more is read in chunks, keeping totals for all trips but the trip
+# details for a sample only (see load_data)
+MEMORY_BUDGET = 2048 * 1024**2
+CHUNK_ROWS = 200000
+
+# Rows written at a time when printing long tables (see render_table)
+RENDER_ROWS = 1000
+
+# How partial results are combined by merge_partials (other columns are group keys)
+PARTIAL_MERGE = {'Trip': 'sum', 'First': 'min', 'Duration': 'sum', 'Longest': 'max', 'Shortest': 'min'}
+
+# Number of report results kept in memory by the report server
+SERVER_CACHE_SIZE = 256
+
+# Long operations show their progress once they have run for PROGRESS_DELAY seconds,
+# updated every PROGRESS_INTERVAL seconds (see run_cancellable)
+PROGRESS_DELAY = 1.0
+PROGRESS_INTERVAL = 2.0
+
+# Precomputed data for each city loaded during the session, keyed by city name
+city_store = {}
+
+# Data attached from shared memory by a worker process (see attach_worker)
+worker_datasets = {}
+
+# Answers and step timings while a session is replayed from a script (see replay_session)
+replay = None
+
+# The operation running in a worker thread and its progress, and the worker threads
+# of operations the user has cancelled (see run_cancellable)
+progress = {}
+cancelled = set()
+
+class Cancelled(Exception):
+    """
+    Raised when the user cancels a long operation (see run_cancellable).
+    """
+
+class NoTrips(Exception):
+    """
+    Raised when a report is requested for filters that match no trips.
+    """
+
+def import_numeric():
+    """
+    Imports pandas and NumPy and sets the pandas display options (see numeric_stack).
+    """
+    global pd, np
+    import numpy
+    import pandas
+
+    pandas.options.display.max_columns = None
+    np = numpy
+    pd = pandas
+
+def numeric_stack(wait = True):
+    """
+    Starts importing pandas and NumPy in a background thread, if not already started,
+    and optionally waits for the import to finish.  The interactive prompts do not
+    need them, so the import overlaps with the user typing their choices.
+
+    Args:
+        wait - True to wait until pandas and NumPy are available
+    """
+    global numeric_import
+    if numeric_import is None:
+        numeric_import = threading.Thread(target = import_numeric, daemon = True)
+        numeric_import.start()
+    if wait:
+        numeric_import.join()
+
+def ask(prompt):
+    """
+    Asks the user a question.  While a session is replayed, the next answer is taken
+    from the script instead, and the time taken to reach the question since the
+    previous answer is recorded as the latency of the previous step.
+
+    Args:
+        (str) prompt - the question
+
+    Returns:
+        (str) the answer
+    """
+    if replay is None:
+        return input(prompt)
+
+    finish_step()
+    if not replay['answers']:
+        raise EOFError('End of replay script')
+
+    answer = replay['answers'].pop(0)
+    print(prompt + answer)
+    replay['steps'].append({'Prompt': prompt.strip().split('\n')[-1], 'Answer': answer})
+    replay['start'] = time.perf_counter()
+
+    return answer
+
+def pause(prompt):
+    """
+    Waits for the user to press Enter.  Pauses are skipped while a session is replayed.
+
+    Args:
+        (str) prompt - the message displayed
+    """
+    if replay is None:
+        input(prompt)
+
+def finish_step():
+    """
+    Records the latency of the replayed step in progress (see ask).
+    """
+    if replay['steps'] and 'Seconds' not in replay['steps'][-1]:
+        replay['steps'][-1]['Seconds'] = time.perf_counter() - replay['start']
+
+def run_cancellable(task, function, *args):
+    """
+    Runs a long operation (such as loading data or calculating report tables) in a
+    worker thread, so that it can be cancelled with Ctrl-C.  Once it has run for
+    PROGRESS_DELAY seconds, its progress is shown every PROGRESS_INTERVAL seconds:
+    the rows processed, rows per second and estimated time remaining where the
+    operation reports them (see progress_stage and progress_step), or the time
+    elapsed where it does not.  The operation stops at its next progress step once
+    cancelled, and its result is discarded, so the data already loaded is unchanged.
+
+    Args:
+        (str) task - description of the operation, shown with its progress
+        function - the function to run
+        args - the arguments for the function
+
+    Returns:
+        the result of the function
+
+    Raises:
+        Cancelled - if the user pressed Ctrl-C before the operation finished
+    """
+    outcome = {}
+
+    def work():
+        try:
+            outcome['result'] = function(*args)
+        except BaseException as error:
+            outcome['error'] = error
+        finally:
+            cancelled.discard(threading.current_thread())
+
+    worker = threading.Thread(target = work, daemon = True)
+    progress.update(thread = worker, stage = None, rows = 0, total = None, stage_start = time.perf_counter())
+    worker.start()
+
+    shown = False
+    try:
+        while True:
+            worker.join(PROGRESS_INTERVAL if shown else PROGRESS_DELAY)
+            if not worker.is_alive():
+                break
+            if not shown:
+                print('{} (press Ctrl-C to cancel)'.format(task))
+                shown = True
+            print(progress_text())
+    except KeyboardInterrupt:
+        cancelled.add(worker)
+        outcome = {'error': Cancelled(task)}
+    finally:
+        progress['thread'] = None
+
+    if 'error' in outcome:
+        raise outcome['error']
+
+    return outcome['result']
+
+def progress_stage(stage, rows = None):
+    """
+    Records the start of a stage of the operation run by run_cancellable(), e.g.
+    reading the data file, and the (estimated) number of rows it will process, so
+    that its progress can be shown as a percentage with the time remaining.
+    Does nothing in other threads.
+
+    Args:
+        (str) stage - description of the stage
+        (int) rows - the number of rows to process, or None if not known
+    """
+    if progress.get('thread') is threading.current_thread():
+        progress.update(stage = stage, rows = 0, total = rows, stage_start = time.perf_counter())
+
+def progress_step(rows):
+    """
+    Records rows processed by the operation run by run_cancellable(), and stops the
+    operation if the user has cancelled it.  Only the rows are ignored in other threads.
+
+    Args:
+        (int) rows - the number of rows processed since the last step
+
+    Raises:
+        Cancelled - if the user has cancelled the operation
+    """
+    if threading.current_thread() in cancelled:
+        cancelled.discard(threading.current_thread())
+        raise Cancelled()
+    if progress.get('thread') is threading.current_thread():
+        progress['rows'] += rows
+
+def progress_text():
+    """
+    Describes the progress of the operation run by run_cancellable(), e.g.
+    '  Reading: 1,200,000 of about 3,000,000 rows (40%), 850,000 rows/sec, 0:00:02 remaining'
+    """
+    rows = progress['rows']
+    total = progress['total']
+    if rows == 0:
+        text = '{} elapsed'.format(datetime.timedelta(seconds = int(time.perf_counter() - progress['stage_start'])))
+    else:
+        rate = rows / (time.perf_counter() - progress['stage_start'])
+        text = '{:,} rows'.format(rows)
+        if total:
+            text = '{:,} of about {:,} rows ({:.0%})'.format(rows, total, min(rows / total, 1))
+        text += ', {:,.0f} rows/sec'.format(rate)
+        if total and rows < total:
+            text += ', {} remaining'.format(datetime.timedelta(seconds = int((total - rows) / rate)))
+
+    if progress['stage'] is not None:
+        text = '{}: {}'.format(progress['stage'], text)
+
+    return '  ' + text
 
 def get_city():
     """
     Asks user to firstly select the city they are interested in.
 
-    Returns: (str) city - name of the city to analyse
+    Returns: (str) city - name of the city to analyse, or 'all' to compare the cities
     """
 
     cities = ['chicago','new york city','new york','washington',
               'washington dc','washington d.c','washington d.c.',
-              'washington, d.c.']
+              'washington, d.c.','all']
     ny = ['new york city','new york']
 
     print()
@@ -30,62 +321,1381 @@ def get_city():
     print('Welcome to the US Bike Share Reporting Package. We provide reporting')
     print('and analysis of bike share activity across three major US cities:')
     print('    - Chicago,\n    - New York City, and\n    - Washington')
-    city_input = input('Please enter the name of the city you would like to review: ')
+    print('You can also enter \'All\' to compare the three cities side by side.')
+    city_input = ask('Please enter the name of the city you would like to review: ')
     city_input = city_input.strip().lower()
 
     while city_input not in cities:
-        city_input = input('Sorry, that city is not available. Please try again: ')
+        city_input = ask('Sorry, that city is not available. Please try again: ')
         city_input = city_input.strip().lower()
 
-    if city_input == 'chicago':
-        city = 'chicago'
-    elif city_input in ny:
-        city = 'new york city'
-    else:
-        city = 'washington'
+    if city_input == 'chicago':
+        city = 'chicago'
+    elif city_input in ny:
+        city = 'new york city'
+    elif city_input == 'all':
+        city = 'all'
+    else:
+        city = 'washington'
+
+    return city
+
+def data_file(city):
+    """
+    Finds the data file for a city: the file named in CITY_DATA, or a compressed
+    copy of it (see COMPRESSED_SUFFIXES).
+
+    Args:
+        (str) city - name of the city
+
+    Returns:
+        (str) path of the data file, or None if there is no data for the city
+    """
+    for path in [CITY_DATA[city]] + [CITY_DATA[city] + suffix for suffix in COMPRESSED_SUFFIXES]:
+        if os.path.exists(path):
+            return path
+
+    return None
+
+def decompressed(raw, path):
+    """
+    Wraps an open data file so that it is decompressed as it is read.
+
+    Args:
+        raw - the data file opened in binary mode
+        path - path of the data file
+
+    Returns:
+        binary file object of the decompressed data
+    """
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.GzipFile(fileobj = raw)
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_size = 2**16)
+
+    return raw
+
+def read_trips(city, source = None, **options):
+    """
+    Reads a city's data file with the declared column types (TRIP_DTYPES and
+    TRIP_DATES).  Compressed files are decompressed as they are read, and whole
+    files are parsed by the multi-threaded pyarrow engine where it is installed.
+
+    Args:
+        (str) city - name of the city
+        source - file object to read instead of the data file (e.g. part of it)
+        options - other options for pd.read_csv (e.g. usecols, nrows, skiprows or
+                  chunksize)
+
+    Returns:
+        DataFrame of the trips read (or an iterator of chunks where chunksize is given)
+    """
+    import importlib.util
+    numeric_stack()
+
+    usecols = options.get('usecols')
+    options['dtype'] = {col: TRIP_DTYPES[col] for col in TRIP_DTYPES if usecols is None or col in usecols}
+    options['parse_dates'] = [col for col in TRIP_DATES if usecols is None or col in usecols]
+
+    # The pyarrow engine reads whole files only
+    if {'nrows','skiprows','chunksize'} & set(options) or importlib.util.find_spec('pyarrow') is None:
+        return pd.read_csv(data_file(city) if source is None else source, **options)
+
+    # The pyarrow engine only accepts types for columns in the file and infers the
+    # times itself, so the types are applied once the file is read.  It also names
+    # the unnamed first column '' (rather than 'Unnamed: 0'), reads empty text as ''
+    # (rather than missing) and may read the times with a unit other than
+    # nanoseconds, so these are conformed to the default engine
+    dtypes = options.pop('dtype')
+    dates = options.pop('parse_dates')
+    df = pd.read_csv(data_file(city) if source is None else source, engine = 'pyarrow', **options)
+    df = df.rename(columns = {'': 'Unnamed: 0'})
+    for col in dates:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors = 'coerce').astype('datetime64[ns]')
+    for col in dtypes:
+        if col in df.columns and dtypes[col] == 'object':
+            df[col] = df[col].mask(df[col] == '')
+
+    return df.astype({col: dtypes[col] for col in dtypes if col in df.columns})
+
+def stratified_sample(city, fraction):
+    """
+    Selects a random sample of the trips for the specified city, stratified by
+    year, month and day of the week so that every combination is represented in
+    proportion to its share of trips.
+
+    The file is read once, SAMPLE_BLOCK bytes at a time, but only the sampled lines
+    are parsed.  The stratum of each line is read from the bytes of its Start Time
+    (see line_strata), and each line is given a random key.  Lines with a key below
+    twice the fraction (with the lowest key of each stratum in each block) are kept
+    as candidates.  Once the candidates have been parsed and validated (see
+    clean_trips), the candidates with the lowest keys are selected in each stratum
+    to match the number of lines counted for it.  The data file holds one trip on
+    each line.
+
+    As only the sampled lines are validated, the trips failing validation are not
+    listed (the quarantine file is written when the full data is loaded).
+
+    Args:
+        (str) city - name of the city to review
+        (float) fraction - the share of trips to include in the sample
+
+    Returns:
+        df - the trips sampled, conformed and cleaned
+        recorded - the user columns included in the file
+        (float) fraction - the share of trips actually included in the sample
+        quarantine - None, as the trips not sampled are not validated
+    """
+    import io
+
+    rng = np.random.default_rng()
+    limit = min(2 * fraction, 1.0)
+    totals = np.zeros(SAMPLE_YEARS * 12 * 7, dtype = np.int64)
+    lines = []
+
+    path = data_file(city)
+    with open(path, 'rb') as file:
+        stream = decompressed(file, path)
+        data = stream.read(SAMPLE_BLOCK)
+        header = data[:data.find(b'\n') + 1] if b'\n' in data else data
+        rest = data[len(header):]
+        names = [name.strip().strip('"') for name in header.decode('utf-8').split(',')]
+        column = names.index('Start Time')
+
+        while rest:
+            block = stream.read(SAMPLE_BLOCK)
+            data = rest + block
+            if block:
+                # The last (incomplete) line of the block is carried over to the next
+                cut = data.rfind(b'\n') + 1
+                data, rest = data[:cut], data[cut:]
+            else:
+                data, rest = data + (b'' if data.endswith(b'\n') else b'\n'), b''
+            if not data:
+                continue
+
+            buffer = np.frombuffer(data, dtype = np.uint8)
+            ends = np.flatnonzero(buffer == ord('\n')) + 1
+            starts = np.r_[0, ends[:-1]]
+            stratum = line_strata(buffer, starts, ends, column)
+            key = rng.random(len(starts))
+            totals += np.bincount(stratum[stratum >= 0], minlength = len(totals))
+
+            # The lowest key of each stratum is kept, so every stratum has a candidate
+            order = np.lexsort((key, stratum))
+            lowest = np.zeros(len(starts), dtype = bool)
+            lowest[order[np.unique(stratum[order], return_index = True)[1]]] = True
+
+            keep = ((key < limit) | lowest) & (stratum >= 0)
+            lines += [data[a:z] for a, z in zip(starts[keep].tolist(), ends[keep].tolist())]
+            progress_step(len(starts))
+
+    raw = read_trips(city, source = io.BytesIO(header + b''.join(lines)))
+    df, recorded = conform_trips(raw)
+    df, quarantine = clean_trips(df, raw)
+
+    start = df['Start Time']
+    strata = (((start.dt.year - SAMPLE_YEAR) * 12 + start.dt.month - 1) * 7 + start.dt.dayofweek).to_numpy().astype(np.int64)
+    keys = rng.random(len(df))
+
+    # Number of trips required from each stratum (at least one)
+    targets = np.where(totals > 0, np.maximum(np.round(totals * fraction), 1), 0)
+
+    # Select the candidates with the lowest keys in each stratum
+    order = np.lexsort((keys, strata))
+    counts = np.bincount(strata, minlength = len(totals))
+    offsets = np.cumsum(counts) - counts
+    rank = np.arange(len(strata)) - offsets[strata[order]]
+    selected = np.zeros(len(strata), dtype = bool)
+    selected[order[rank < targets[strata[order]]]] = True
+
+    return df[selected].reset_index(drop = True), recorded, selected.sum() / max(totals.sum(), 1), None
+
+def line_strata(data, starts, ends, column):
+    """
+    Finds the stratum of each line of a data file (see stratified_sample) from the
+    bytes of its Start Time ('YYYY-MM-DD ...'), without parsing the line.  The stratum
+    combines the year (from SAMPLE_YEAR), month and day of the week.
+
+    Args:
+        data - array of the bytes of whole lines
+        starts - the offset of the start of each line
+        ends - the offset of the end of each line (after its line break)
+        (int) column - the position of the Start Time among the columns
+
+    Returns:
+        array of the stratum of each line (-1 where the line has no valid Start Time)
+    """
+    # The Start Time follows the comma ending the columns before it (e.g. a trip id).
+    # Lines with too few commas are given one past the end of the data
+    pos = starts
+    if column > 0:
+        commas = np.append(np.flatnonzero(data == ord(',')), len(data))
+        pos = commas[np.minimum(np.searchsorted(commas, starts) + column - 1, len(commas) - 1)] + 1
+    pos = pos + (data[np.minimum(pos, len(data) - 1)] == ord('"'))
+
+    digits = data[np.minimum(pos[:, None] + np.arange(10), len(data) - 1)].astype(np.int64) - ord('0')
+    numbers = digits[:, [0, 1, 2, 3, 5, 6, 8, 9]]
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 5] * 10 + digits[:, 6]
+    day = digits[:, 8] * 10 + digits[:, 9]
+    valid = ((pos + 10 <= ends) & ((numbers >= 0) & (numbers <= 9)).all(axis = 1)
+             & (year >= SAMPLE_YEAR) & (year < SAMPLE_YEAR + SAMPLE_YEARS)
+             & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31))
+
+    # Days since 1970-01-01 (a Thursday) give the day of the week (Monday is 0)
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0)
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + day - 1
+    stratum = ((year - SAMPLE_YEAR) * 12 + month - 1) * 7 + (days + 3) % 7
+
+    return np.where(valid, stratum, -1)
+
+def conform_trips(df):
+    """
+    Conforms the trips read from a city's data file (or a chunk of it):
+        - Column 'Unnamed: 0' is removed for consistency with online version
+        - User columns conformed to the common schema (see null_values)
+        - Columns converted to compact types: whole seconds for Trip Duration
+          (stored as int32 once the trips are validated, see clean_trips) and
+          int16 for Birth Year (with 0 where the birth year is not known)
+
+    Args:
+        df - DataFrame read from the city's data file (see read_trips)
+
+    Returns:
+        df - the conformed DataFrame
+        recorded - the user columns included in the file
+    """
+    # Drop first column ('Unnamed: 0')
+    df = df.drop(['Unnamed: 0'], axis = 1)
+
+    # Conform the user columns to the common schema, so every city has the same columns
+    recorded = [col for col in null_values if col in df.columns]
+    for col in null_values:
+        if col in recorded:
+            df[col] = df[col].fillna(null_values[col])
+        else:
+            df[col] = null_values[col]
+
+    # Dates that could not be parsed (or an empty file's columns) are left as text,
+    # so are converted here, with any invalid dates missing
+    for col in TRIP_DATES:
+        if df[col].dtype.kind != 'M':
+            df[col] = pd.to_datetime(df[col], errors = 'coerce')
+
+    # Change columns to compact types (durations are recorded in seconds, and may be
+    # missing until the trips are validated)
+    df['Trip Duration'] = df['Trip Duration'].round()
+    df['Birth Year'] = df['Birth Year'].astype(np.int16)
+
+    return df, recorded
+
+def clean_trips(df, raw = None):
+    """
+    Validates conformed trips (see conform_trips) and adds the cleaned columns used
+    by the reports, in a single vectorised pass:
+        - Column 'Var' created with the difference in seconds between the Trip
+          Duration and the time from Start Time to End Time
+        - Columns 'Age' (0 where the Birth Year is not known) and 'Age Group'
+          (see age_order) created
+        - Trips flagged with reason codes where:
+            MISSING_TIME - the Start Time or End Time is missing
+            MISSING_DURATION - the Trip Duration is missing
+            END_BEFORE_START - the End Time is before the Start Time
+            NEGATIVE_DURATION - the Trip Duration is negative
+            LONG_DURATION - the Trip Duration, or the time from Start Time to End
+                            Time, is more than MAX_TRIP_DURATION
+            BIRTH_YEAR - the Birth Year is after the trip, or more than AGE_LIMIT
+                         years before it
+
+    Trips flagged for their times or duration are removed.  Trips flagged only for
+    the Birth Year are kept, as the user reports show the trips by older users.
+
+    Args:
+        df - the conformed DataFrame
+        raw - the trips as read, before they were conformed (default: df), so that
+              the quarantine lists the values in the data file
+
+    Returns:
+        df - the cleaned DataFrame
+        quarantine - DataFrame of the flagged trips, with their codes in 'Reason'
+    """
+    # Time from Start Time to End Time in whole seconds (NaN where either is missing)
+    seconds = np.trunc((df['End Time'].to_numpy() - df['Start Time'].to_numpy()) / np.timedelta64(1, 's'))
+    duration = df['Trip Duration'].to_numpy()
+    birth_year = df['Birth Year'].to_numpy()
+    age = np.where(birth_year == 0, 0, df['Start Time'].to_numpy().astype('datetime64[Y]').astype(np.int64) + 1970 - birth_year)
+
+    checks = {'MISSING_TIME': np.isnan(seconds),
+              'MISSING_DURATION': ~np.isfinite(duration),
+              'END_BEFORE_START': seconds < 0,
+              'NEGATIVE_DURATION': duration < 0,
+              'LONG_DURATION': (duration > MAX_TRIP_DURATION) | (seconds > MAX_TRIP_DURATION),
+              'BIRTH_YEAR': (age < 0) | (age > AGE_LIMIT)}
+    flagged = np.logical_or.reduce(list(checks.values()))
+    keep = ~np.logical_or.reduce([checks[code] for code in checks if code != 'BIRTH_YEAR'])
+
+    # List the reason codes for each flagged trip
+    reasons = np.full(flagged.sum(), '', dtype = object)
+    for code, check in checks.items():
+        reasons = np.where(check[flagged], reasons + ' ' + code, reasons)
+    quarantine = (df if raw is None else raw)[flagged].copy()
+    quarantine.insert(0, 'Reason', [reason.strip() for reason in reasons])
+
+    df = df[keep].copy()
+    df['Trip Duration'] = duration[keep].astype(np.int32)
+    df['Var'] = np.abs(duration[keep] - seconds[keep]).astype(np.int32)
+    df['Age'] = age[keep].astype(np.int16)
+
+    # Create new column for Age Group of the users (ages after the trip have no group)
+    age = df['Age'].to_numpy()
+    ages = [(age == 0),
+            (age > 0) & (age < 18),
+            (age >= 18) & (age < 30),
+            (age >= 30) & (age < 40),
+            (age >= 40) & (age < 50),
+            (age >= 50) & (age < 60),
+            (age >= 60) & (age < 70),
+            (age >= 70)]
+    df['Age Group'] = pd.Categorical.from_codes(np.select(ages, range(len(age_order)), -1), categories = age_order)
+
+    return df, quarantine
+
+def write_quarantine(city, quarantine, show = print):
+    """
+    Writes the trips that failed validation at load (see clean_trips) to the city's
+    quarantine file, next to its data file, with the reason codes for each trip.
+
+    Args:
+        (str) city - name of the city
+        quarantine - DataFrame of the flagged trips created by clean_trips()
+        show - function displaying the number of trips listed (default: print)
+    """
+    path = os.path.splitext(CITY_DATA[city])[0] + QUARANTINE_SUFFIX
+
+    # Written to a temporary file first, so the file is never left partly written
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        quarantine.to_csv(temp, index = False)
+        os.replace(temp, path)
+    except OSError:
+        return
+
+    if len(quarantine) > 0:
+        removed = (quarantine['Reason'] != 'BIRTH_YEAR').sum()
+        show('{:,} trips failed validation ({:,} removed) and are listed in {}.'.format(len(quarantine), removed, path))
+
+def clean_path(city):
+    """
+    Returns the path of the cache of a city's cleaned data (next to the data file).
+    """
+    return os.path.splitext(CITY_DATA[city])[0] + CLEAN_SUFFIX
+
+def write_clean(city, df, stations):
+    """
+    Caches a city's cleaned and prepared data (see load_data), so that later loads
+    read it instead of the data file.  The cache is identified with the data file by
+    its size and modification time.
+
+    The cache is a NumPy archive of plain arrays, which (unlike a pickle) cannot run
+    code when it is read.  Text columns are stored as integer codes with the list of
+    their values, as they are for shared memory (see share_dataset).
+
+    Args:
+        (str) city - name of the city
+        df - the prepared DataFrame of all trips
+        stations - the station names, in order of their codes
+    """
+    stat = os.stat(data_file(city))
+    meta = {'format': CLEAN_FORMAT, 'size': stat.st_size, 'modified': stat.st_mtime_ns,
+            'recorded': df.attrs['recorded'], 'columns': []}
+    arrays = {'stations': np.array(stations, dtype = str)}
+
+    for n, col in enumerate(df.columns):
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            kind = 'category'
+            codes, categories = values.cat.codes.to_numpy(), values.cat.categories
+        elif values.dtype.kind in 'biufmM':
+            kind = 'values'
+        else:
+            kind = 'text'
+            codes, categories = pd.factorize(values.to_numpy())
+        if kind == 'values':
+            arrays['column{}'.format(n)] = values.to_numpy()
+        else:
+            arrays['column{}'.format(n)] = codes.astype(np.int32)
+            arrays['values{}'.format(n)] = np.array(categories, dtype = str)
+        meta['columns'].append({'name': col, 'kind': kind})
+    arrays['meta'] = np.array(json.dumps(meta))
+
+    # Written to a temporary file first, so readers never see a partial cache
+    path = clean_path(city)
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp, path)
+    except OSError:
+        pass
+
+def clean_cache(city):
+    """
+    Checks that the cache of a city's cleaned data (see write_clean) is current,
+    reading only its metadata.
+
+    Args:
+        (str) city - name of the city
+
+    Returns:
+        the metadata of the cache, or None if there is no cache or the data file has
+        changed since the cache was written
+    """
+    numeric_stack()
+    try:
+        stat = os.stat(data_file(city))
+        with np.load(clean_path(city), allow_pickle = False) as archive:
+            meta = json.loads(str(archive['meta']))
+    except Exception:
+        return None
+
+    if meta.get('format') != CLEAN_FORMAT:
+        return None
+    if meta.get('size') != stat.st_size or meta.get('modified') != stat.st_mtime_ns:
+        return None
+
+    return meta
+
+def read_clean(city):
+    """
+    Reads the cache of a city's cleaned data (see write_clean).
+
+    Args:
+        (str) city - name of the city
+
+    Returns:
+        df - the prepared DataFrame, stations - the station names, and the user
+        columns recorded for the city, or None if there is no cache or the data
+        file has changed since the cache was written
+    """
+    meta = clean_cache(city)
+    if meta is None:
+        return None
+
+    data = {}
+    with np.load(clean_path(city), allow_pickle = False) as archive:
+        for n, col in enumerate(meta['columns']):
+            values = archive['column{}'.format(n)]
+            if col['kind'] == 'category':
+                values = pd.Categorical.from_codes(values, categories = archive['values{}'.format(n)].tolist())
+            elif col['kind'] == 'text':
+                # Missing values have the code -1, so take the NaN on the end of the list
+                values = np.array(archive['values{}'.format(n)].tolist() + [np.nan], dtype = object)[values]
+            data[col['name']] = values
+        stations = pd.Index(archive['stations'].tolist(), dtype = object)
+
+    return pd.DataFrame(data, copy = False), stations, meta['recorded']
+
+def enrich_trips(df):
+    """
+    Adds the columns used by the reports to conformed trips (see conform_trips):
+        - Trips sorted by 'Start Time', so that the column serves as a time index
+          for date and hour range filters (see load_filters)
+        - New columns created separating the components of 'Start Time'
+        - Column 'Trip' created based on start and end stations
+        - Columns 'Start Code' and 'End Code' created, numbering the stations
+          (uint16, unless there are more than 65,535 stations)
+
+    Args:
+        df - the conformed DataFrame
+
+    Returns:
+        df - the DataFrame with the added columns
+        stations - the station names, in order of their codes
+    """
+    # Sort trips by Start Time to allow range filters to use a binary search
+    df = df.sort_values(by = 'Start Time', kind = 'mergesort', ignore_index = True)
+
+    # Create new columns for components of Start Time.  The names are looked up from
+    # the numeric components, which is much quicker than formatting each time
+    starts = df['Start Time'].dt
+    hours = np.array(['{:02d}'.format(hour) for hour in range(24)], dtype = object)
+    df.insert(1,'Year', starts.year.to_numpy().astype(np.int16))
+    df.insert(2,'Month', np.array(month_names, dtype = object)[starts.month.to_numpy() - 1])
+    df.insert(3,'Day', np.array(day_order, dtype = object)[starts.dayofweek.to_numpy()])
+    df.insert(4,'Hour', hours[starts.hour.to_numpy()])
+
+    # Create a Trip column based on start and end station
+    df['Trip'] = df['Start Station'] + ' to ' + df['End Station']
+
+    # Number the stations, so station reports can use vectorised counts
+    codes, stations = pd.factorize(pd.concat([df['Start Station'], df['End Station']], ignore_index = True))
+    code_type = np.uint16 if len(stations) <= np.iinfo(np.uint16).max else np.uint32
+    df['Start Code'] = codes[:len(df)].astype(code_type)
+    df['End Code'] = codes[len(df):].astype(code_type)
+
+    return df, stations
+
+def estimate_footprint(city, rows = 10000):
+    """
+    Estimates the memory needed to load a city's data, by preparing the first rows
+    of its data file and scaling their size up to the number of rows in the file.
+
+    Args:
+        (str) city - name of the city
+        (int) rows - the number of rows to prepare
+
+    Returns:
+        (int) the estimated memory needed in bytes
+        (int) the estimated number of rows in the file
+    """
+    head = read_trips(city, nrows = rows)
+    if len(head) == 0:
+        return 0, 0
+
+    # Size in the file (after any compression) of the header and rows read
+    path = data_file(city)
+    with open(path, 'rb') as raw:
+        stream = decompressed(raw, path)
+        blocks = []
+        lines = 0
+        while lines <= len(head):
+            block = stream.read(2**16)
+            if not block:
+                break
+            blocks.append(block)
+            lines += block.count(b'\n')
+        data = b''.join(blocks)
+        ends = np.flatnonzero(np.frombuffer(data, dtype = np.uint8) == ord('\n'))
+        head_bytes = ends[len(head)] + 1 if len(ends) > len(head) else len(data)
+        file_bytes = raw.tell() * head_bytes / max(len(data), 1)
+
+    df, recorded = conform_trips(head)
+    df, quarantine = clean_trips(df)
+    df, stations = enrich_trips(df)
+    row_bytes = df.memory_usage(deep = True).sum() / len(df)
+    file_rows = len(head) * os.path.getsize(path) / file_bytes
+
+    # The file as read and the prepared columns are both held while loading
+    return int(2 * row_bytes * file_rows), int(file_rows)
+
+def read_whole(city):
+    """
+    Reads the whole of a city's data file.  Unless the pyarrow engine is available
+    (see read_trips), the file is parsed in chunks of CHUNK_ROWS rows, so that the
+    progress of the load can be shown and it can be cancelled (see progress_step).
+
+    Args:
+        (str) city - name of the city
+
+    Returns:
+        DataFrame of all of the trips
+    """
+    import importlib.util
+    if importlib.util.find_spec('pyarrow') is not None:
+        return read_trips(city)
+
+    chunks = []
+    for chunk in read_trips(city, chunksize = CHUNK_ROWS):
+        chunks.append(chunk)
+        progress_step(len(chunk))
+
+    return pd.concat(chunks, ignore_index = True) if chunks else read_trips(city)
+
+def read_chunked(city, fraction):
+    """
+    Reads a city's data file in chunks, for data too large for the memory budget.
+    The trip duration sketches, trip series, year counts and the extent of the data
+    (for its catalog) are built from every trip, while only a random sample of the
+    trips is kept for the reports needing trip details.
+
+    Args:
+        (str) city - name of the city
+        (float) fraction - share of trips to keep
+
+    Returns:
+        df - the trips kept, conformed and cleaned (see clean_trips)
+        recorded - the user columns included in the file
+        sketch - trip duration sketch of all trips (see duration_sketch)
+        series - trip series of all trips (see update_series)
+        years - year counts of all trips (see year_counts)
+        (float) fraction - the share of trips actually kept
+        quarantine - the trips that failed validation
+        extent - dictionary of the first and last start times and the station names
+                 of all trips
+    """
+    rng = np.random.default_rng()
+
+    # Start from the (empty) header, so that an empty file still has its columns
+    raw = read_trips(city, nrows = 0)
+    df, recorded = conform_trips(raw)
+    df, quarantine = clean_trips(df, raw)
+    kept = [df]
+    flagged = [quarantine]
+    sketch = None
+    series = None
+    years = None
+    total = 0
+    extent = {'first_start': None, 'last_start': None, 'stations': set()}
+
+    for raw in read_trips(city, chunksize = CHUNK_ROWS):
+        chunk, recorded = conform_trips(raw)
+        chunk, quarantine = clean_trips(chunk, raw)
+        flagged.append(quarantine)
+        sketch = duration_sketch(chunk) if sketch is None else merge_sketches(sketch, duration_sketch(chunk))
+        series = update_series(series, chunk)
+        years = merge_year_counts(years, year_counts(chunk))
+        if len(chunk) > 0:
+            first, last = chunk['Start Time'].min(), chunk['Start Time'].max()
+            extent['first_start'] = first if extent['first_start'] is None else min(extent['first_start'], first)
+            extent['last_start'] = last if extent['last_start'] is None else max(extent['last_start'], last)
+        for col in ['Start Station','End Station']:
+            extent['stations'].update(chunk[col].dropna().unique())
+        kept.append(chunk[rng.random(len(chunk)) < fraction])
+        total += len(chunk)
+        progress_step(len(chunk))
+
+    df = pd.concat(kept, ignore_index = True)
+
+    return (df, recorded, sketch, series, years, len(df) / max(total, 1), pd.concat(flagged, ignore_index = True),
+            extent)
+
+def load_data(city, sample = None):
+    """
+    Loads data for the specified city (see prepare_data), and stores its trip
+    duration sketches, station names, station row index, daily and hourly trip
+    counts and trip counts for each year in city_store[city].
+
+    Args:
+        (str) city - name of the city to review
+        (float) sample - share of trips to load, or None to load all trips
+
+    Returns:
+        df - Pandas DataFrame containing unfiltered city data
+    """
+    df, store = prepare_data(city, sample)
+    city_store[city] = store
+
+    return df
+
+def prepare_data(city, sample = None, show = print):
+    """
+    Loads data for the specified city, conforms it (see conform_trips) and adds the
+    columns used by the reports (see enrich_trips), and precomputes the totals used
+    by the reports: trip duration sketches, the station names, the station row
+    index, daily and hourly trip counts and the trip counts for each year (see
+    year_counts).  The totals are returned rather than stored, so that data can be
+    loaded in the background without changing the data in use (see report_pack).
+
+    When a sample fraction is provided, only a stratified sample of the trips is
+    loaded and the fraction sampled is recorded in df.attrs['sample_fraction'] so
+    that reported trip counts can be scaled up to estimates.
+
+    The metadata for the file is recorded in its catalog (see update_catalog).
+    Trips are validated and cleaned as they are loaded (see clean_trips), and the
+    trips failing validation are listed in the quarantine file once the load has
+    completed (see write_quarantine).  The cleaned data for all trips is cached (see
+    write_clean), so later loads read the cache rather than the data file while the
+    file is unchanged.
+
+    Where the data is estimated to need more memory than MEMORY_BUDGET, the file is
+    read in chunks instead.  The totals then cover every trip, and a sample of trips
+    that fits within the budget is kept for the reports.
+
+    Args:
+        (str) city - name of the city to review
+        (float) sample - share of trips to load, or None to load all trips
+        show - function displaying messages about the load (default: print), e.g. to
+               hold them until a load in the background has completed
+
+    Returns:
+        df - Pandas DataFrame containing unfiltered city data
+        store - dictionary of the totals, for city_store[city]
+    """
+    start_time = time.time()
+    numeric_stack()
+    sketch = None
+    series = None
+    years = None
+    fraction = None
+    cached = None
+    quarantine = None
+    extent = None
+
+    if sample:
+        progress_stage('Sampling')
+        df, recorded, fraction, quarantine = stratified_sample(city, sample)
+    else:
+        cached = read_clean(city)
+        if cached is not None:
+            df, stations, recorded = cached
+        else:
+            footprint, rows = estimate_footprint(city)
+            progress_stage('Reading', rows)
+            if footprint > MEMORY_BUDGET:
+                show('The {} data needs about {:,.0f} MB of memory, more than the budget of {:,.0f} MB.'
+                     .format(city.title(), footprint / 1024**2, MEMORY_BUDGET / 1024**2))
+                show('Totals are calculated from all trips, and trip details from a sample of trips.')
+                df, recorded, sketch, series, years, fraction, quarantine, extent = read_chunked(city, MEMORY_BUDGET / footprint)
+            else:
+                raw = read_whole(city)
+                df, recorded = conform_trips(raw)
+                progress_stage('Preparing')
+                df, quarantine = clean_trips(df, raw)
+                del raw
+
+    if cached is None:
+        progress_stage('Preparing')
+        df, stations = enrich_trips(df)
+
+    # A cancelled load stops here, before the data is cached or stored (see run_cancellable)
+    progress_step(0)
+
+    if quarantine is not None:
+        write_quarantine(city, quarantine, show)
+
+    df.attrs['recorded'] = recorded
+    if fraction is not None:
+        df.attrs['sample_fraction'] = fraction
+    elif cached is None:
+        write_clean(city, df, stations)
+
+    # Precompute the trip duration sketches used by the trip duration reports
+    store = {'duration_sketch': duration_sketch(df) if sketch is None else sketch,
+             'stations': stations,
+             'station_index': station_index(df, stations),
+             'series': update_series(None, df) if series is None else series,
+             'year_counts': year_counts(df) if years is None else years}
+
+    # Report every month with trips, whichever years the data covers
+    df.attrs['months'] = year_months(store['year_counts'])
+    df.attrs['periods'] = year_periods(store['year_counts'])
+
+    # Record the metadata for the file, unless only a sample of trips was counted
+    if store['series'] is not None and store['series']['frac'] == 1.0:
+        update_catalog(city, df, store, extent)
+
+    show("Processing time: %.2f seconds." % (time.time() - start_time))
+
+    return df, store
+
+def catalog_path(city):
+    """
+    Returns the path of the catalog for a city's data file (next to the data file).
+    """
+    return os.path.splitext(CITY_DATA[city])[0] + CATALOG_SUFFIX
+
+def update_catalog(city, df, store, extent = None):
+    """
+    Records the metadata for a city's data file in its catalog, so that the welcome
+    screen and filter choices can be shown without loading the data: the number of
+    trips, the first and last start times, the months available, the number of
+    stations, the columns in the file, the years available and the summary of trips
+    by month and day.
+    The catalog is identified with the file by its size and modification time.
+
+    Args:
+        city - the city the data is for
+        df - the data loaded for the city by prepare_data()
+        store - the totals precomputed for the city by prepare_data()
+        extent - the first and last start times and station names of all trips, where
+                 df holds only a sample of them (see read_chunked)
+    """
+    if extent is None:
+        extent = {'first_start': df['Start Time'].min(), 'last_start': df['Start Time'].max(),
+                  'stations': store['stations']}
+
+    series = store['series']
+    days = pd.DatetimeIndex(series['first'] + np.arange(len(series['daily'])))
+    counts = pd.DataFrame({'Year': days.year, 'Month': days.strftime('%b'), 'Day': days.strftime('%a'),
+                           'Trip': series['daily']})
+    summary = summary_table(counts[counts['Trip'] > 0])
+
+    stat = os.stat(data_file(city))
+    entry = {'file': data_file(city),
+             'size': stat.st_size,
+             'modified': stat.st_mtime_ns,
+             'rows': int(series['daily'].sum()),
+             'first_start': extent['first_start'],
+             'last_start': extent['last_start'],
+             'months': [month for month in summary.columns if summary[month].sum() > 0],
+             'years': year_list(store['year_counts']),
+             'stations': len(extent['stations']),
+             'columns': source_columns(df),
+             'recorded': df.attrs['recorded'],
+             'summary': summary}
+
+    # Written to a temporary file first, so readers never see a partial catalog
+    path = catalog_path(city)
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp, 'w') as f:
+            json.dump(entry, f, default = json_value)
+        os.replace(temp, path)
+    except OSError:
+        pass
+
+def read_catalog(city):
+    """
+    Reads the catalog for a city's data file (see update_catalog).
+
+    Args:
+        city - the selected city
+
+    Returns:
+        dictionary of the metadata, or None if there is no catalog or the data file
+        has changed since the catalog was written
+    """
+    try:
+        with open(catalog_path(city)) as f:
+            entry = json.load(f)
+        stat = os.stat(data_file(city))
+    except (OSError, TypeError, ValueError):
+        return None
+
+    if entry.get('size') != stat.st_size or entry.get('modified') != stat.st_mtime_ns:
+        return None
+
+    return entry
+
+def catalog_summary(entry):
+    """
+    Creates the summary table of trip volumes by month and day (see city_summary)
+    from a city's catalog.
+
+    Args:
+        entry - the catalog read by read_catalog()
+
+    Returns:
+        df_summ - a summary table of trip volumes
+    """
+    numeric_stack()
+    summary = entry['summary']
+    if len(summary['index_names']) > 1:
+        index = pd.MultiIndex.from_tuples([tuple(row) for row in summary['index']], names = summary['index_names'])
+    else:
+        index = pd.Index(summary['index'], name = 'Day')
+
+    return pd.DataFrame(summary['data'], index = index, columns = pd.Index(summary['columns'], name = 'Month'))
+
+def duration_sketch(df):
+    """
+    Builds quantile sketches of Trip Duration for each month and day of the week.
+
+    Each sketch is a histogram over logarithmic buckets, where bucket i holds the
+    durations between SKETCH_GAMMA**(i-1) and SKETCH_GAMMA**i seconds.  Any quantile
+    read from a sketch is within SKETCH_ACCURACY (relative) of the exact value.
+
+    Sketches with the same bucket layout are merged by simply adding them, so they
+    can be built separately for chunks of a file (or in separate processes) and
+    combined with merge_sketches() without any loss of accuracy.
+
+    Args:
+        df - the DataFrame (or chunk) of trip data
+
+    Returns:
+        sketch - array of bucket counts with shape (12 months, 7 days, SKETCH_BUCKETS)
+    """
+    durations = np.maximum(df['Trip Duration'].to_numpy(dtype = float), 1.0)
+    buckets = np.ceil(np.log(durations) / np.log(SKETCH_GAMMA)).astype(np.int64)
+    buckets = np.clip(buckets, 0, SKETCH_BUCKETS - 1)
+
+    months = df['Start Time'].dt.month.to_numpy() - 1
+    days = df['Start Time'].dt.dayofweek.to_numpy()
+    cells = (months * 7 + days) * SKETCH_BUCKETS + buckets
+
+    sketch = np.bincount(cells, minlength = 12 * 7 * SKETCH_BUCKETS)
+
+    return sketch.reshape(12, 7, SKETCH_BUCKETS)
+
+def merge_sketches(*sketches):
+    """
+    Merges trip duration sketches built from separate chunks of data.
+
+    Args:
+        sketches - the sketches to combine
+
+    Returns:
+        sketch - a sketch equivalent to one built over all of the data
+    """
+    return np.sum(sketches, axis = 0)
+
+def sketch_quantiles(sketch, month, day, quantiles):
+    """
+    Estimates trip duration quantiles from a sketch for the selected month and day.
+
+    Args:
+        sketch - trip duration sketch created by duration_sketch()
+        month - the month filter selected
+        day - the day filter selected
+        quantiles - list of quantiles required (e.g. [0.5, 0.9, 0.99])
+
+    Returns:
+        list of estimated durations in seconds, one for each quantile
+        (None for each quantile if there are no trips)
+    """
+    if month != 'All':
+        sketch = sketch[datetime.datetime.strptime(month, '%b').month - 1]
+    else:
+        sketch = sketch.sum(axis = 0)
+
+    if day != 'All':
+        sketch = sketch[day_order.index(day)]
+    else:
+        sketch = sketch.sum(axis = 0)
+
+    cum_counts = np.cumsum(sketch)
+    total = cum_counts[-1]
+    if total == 0:
+        return [None for q in quantiles]
+
+    # Locate the bucket holding each rank, and return the bucket's mid-point
+    ranks = [q * (total - 1) for q in quantiles]
+    buckets = np.searchsorted(cum_counts, ranks, side = 'right')
+
+    return [2 * SKETCH_GAMMA**b / (SKETCH_GAMMA + 1) for b in buckets]
+
+def update_series(series, df):
+    """
+    Adds the trips in a DataFrame to a series of trip counts for every day (and hour
+    of each day), so that trends over time can be reported without rescanning trips.
+
+    Trips are counted with a single bincount over the hour of each Start Time, so
+    new data can be added to an existing series by counting the new trips only.
+    The series is extended where the new trips fall outside the dates it covers.
+
+    Args:
+        series - the series to add to, or None to start a new series
+        df - the DataFrame (or chunk) of trip data
+
+    Returns:
+        series - dictionary with the 'first' date covered, the 'daily' and 'hourly'
+                 (days x 24 hours) trip counts from that date, and the share of
+                 trips counted ('frac')
+    """
+    hours = df['Start Time'].to_numpy().astype('datetime64[h]').astype(np.int64)
+    if len(hours) == 0:
+        return series
+
+    first = hours.min() // 24
+    last = hours.max() // 24
+    if series is not None:
+        old_first = series['first'].astype(np.int64)
+        first = min(first, old_first)
+        last = max(last, old_first + len(series['daily']) - 1)
+
+    hourly = np.bincount(hours - first * 24, minlength = (last - first + 1) * 24).reshape(-1, 24)
+    if series is not None:
+        offset = old_first - first
+        hourly[offset:offset + len(series['hourly'])] += series['hourly']
+
+    return {'first': np.datetime64(int(first), 'D'),
+            'daily': hourly.sum(axis = 1),
+            'hourly': hourly,
+            'frac': sample_fraction(df) if series is None else series['frac']}
+
+def year_counts(df):
+    """
+    Counts trips by year, month, hour of the day and trip duration band, so that the
+    years can be compared (see year_tables) without rescanning the trips.  Counts for
+    separate chunks of data are combined with merge_year_counts().
+
+    Args:
+        df - the DataFrame (or chunk) of trip data
+
+    Returns:
+        counts - dictionary with the 'first' year counted, the trip counts ('trips',
+                 with shape (years, 12 months, 24 hours, duration bands)) and the
+                 share of trips counted ('frac'), or None if there are no trips
+    """
+    if len(df) == 0:
+        return None
+
+    starts = df['Start Time'].dt
+    years = starts.year.to_numpy().astype(np.int64)
+    first = years.min()
+
+    # Duration bands as in duration_partials (up to and including each limit)
+    limits = [300, 600, 900, 1200, 3600, 10800, 21600]
+    bands = np.searchsorted(limits, df['Trip Duration'].to_numpy(), side = 'left')
+
+    shape = (years.max() - first + 1, 12, 24, len(duration_bands))
+    cells = np.ravel_multi_index([years - first, starts.month.to_numpy() - 1, starts.hour.to_numpy(), bands], shape)
+    trips = np.bincount(cells, minlength = int(np.prod(shape))).reshape(shape)
+
+    return {'first': int(first), 'trips': trips, 'frac': sample_fraction(df)}
+
+def merge_year_counts(*counts):
+    """
+    Merges the year counts (see year_counts) for separate chunks of data, which may
+    cover different years.
+
+    Args:
+        counts - the year counts to combine (None where a chunk had no trips)
+
+    Returns:
+        counts - year counts equivalent to those for all of the data
+    """
+    counts = [c for c in counts if c is not None]
+    if not counts:
+        return None
+
+    first = min(c['first'] for c in counts)
+    last = max(c['first'] + len(c['trips']) - 1 for c in counts)
+    trips = np.zeros((last - first + 1,) + counts[0]['trips'].shape[1:], dtype = np.int64)
+    for c in counts:
+        trips[c['first'] - first:c['first'] - first + len(c['trips'])] += c['trips']
+
+    return {'first': first, 'trips': trips, 'frac': counts[0]['frac']}
+
+def year_list(counts):
+    """
+    Lists the years with trips in year counts (see year_counts), in order.
+    """
+    if counts is None:
+        return []
+
+    return [counts['first'] + int(i) for i in np.flatnonzero(counts['trips'].sum(axis = (1, 2, 3)))]
+
+def year_months(counts):
+    """
+    Lists the months with trips in year counts (see year_counts), in calendar order.
+    """
+    if counts is None:
+        return []
+
+    return [month_names[m] for m in np.flatnonzero(counts['trips'].sum(axis = (0, 2, 3)))]
+
+def year_periods(counts):
+    """
+    Lists the years and months with trips in year counts (see year_counts), as
+    (year, month) pairs in date order.
+    """
+    if counts is None:
+        return []
+
+    trips = counts['trips'].sum(axis = (2, 3))
+    return [(counts['first'] + int(year), month_names[month]) for year, month in zip(*np.nonzero(trips))]
+
+def report_months(df):
+    """
+    Returns the months reported for a city: the months with trips in the data loaded
+    for the city (see load_data), in calendar order, whichever filters are applied.
+
+    Args:
+        df - the DataFrame of selected data
+
+    Returns:
+        list of month names (e.g. 'Jan')
+    """
+    if 'months' in df.attrs:
+        return df.attrs['months']
+
+    return present_months(df['Month'])
+
+def present_months(months):
+    """
+    Lists the months named in a column of month names, in calendar order.
+    """
+    months = set(months.unique())
+
+    return [month for month in month_names if month in months]
+
+def report_periods(df):
+    """
+    Returns the years and months reported for a city: the (year, month) pairs with
+    trips in the data loaded for the city (see load_data), in date order, whichever
+    filters are applied.
+
+    Args:
+        df - the DataFrame of selected data
+
+    Returns:
+        list of (year, month name) pairs
+    """
+    if 'periods' in df.attrs:
+        return df.attrs['periods']
+
+    return present_periods(df)
+
+def present_periods(counts):
+    """
+    Lists the years and months in the 'Year' and 'Month' columns of counts (or trips),
+    as (year, month) pairs in date order.
+    """
+    pairs = set((int(year), month) for year, month in
+                counts[['Year','Month']].drop_duplicates().itertuples(index = False, name = None))
+
+    return [(year, month) for year in sorted(set(year for year, month in pairs))
+            for month in month_names if (year, month) in pairs]
+
+def month_rows(counts, months, periods = None):
+    """
+    Returns the rows of the month tables in the usage and trip duration reports.  Where
+    the trips counted cover more than one year, each year's months are reported
+    separately, rather than adding the same month of different years together.
+
+    Args:
+        counts - counts (or trips) with 'Year' and 'Month' columns
+        months - the months reported (see report_months)
+        periods - the years and months reported (see report_periods), or None for
+                  those in the counts
+
+    Returns:
+        keys - the columns the month tables are grouped by ('Month', or 'Year' and
+               'Month')
+        rows - the rows of the month tables, in order
+        day_rows - the rows of the month and day tables, in order
+    """
+    years = set(int(year) for year in counts['Year'].unique())
+    if len(years) <= 1:
+        return ['Month'], months, pd.MultiIndex.from_product([months, day_order], names = ['Month','Day'])
+
+    periods = [(year, month) for year, month in (present_periods(counts) if periods is None else periods)
+               if year in years]
+    return (['Year','Month'], pd.MultiIndex.from_tuples(periods, names = ['Year','Month']),
+            pd.MultiIndex.from_tuples([(year, month, day) for year, month in periods for day in day_order],
+                                      names = ['Year','Month','Day']))
+
+def sample_fraction(df):
+    """
+    Returns the share of trips included in the data (1.0 unless a sample was loaded).
+    """
+    return df.attrs.get('sample_fraction', 1.0)
+
+def recorded(df, col):
+    """
+    Checks whether a user column of the common schema (see null_values) was collected
+    for the city, rather than filled with its null value at load.
+
+    Args:
+        df - DataFrame created by load_data()
+        col - the column name
+
+    Returns:
+        True if the city's data includes the column
+    """
+    return col in df.attrs.get('recorded', df.columns)
+
+def source_columns(df):
+    """
+    Lists the columns of the city's data file, excluding the columns created at load
+    (and user columns the city does not collect), for the raw data views.
+
+    Args:
+        df - DataFrame created by load_data()
+
+    Returns:
+        list of column names
+    """
+    return [col for col in df.columns if col not in ('Year','Month','Day','Hour','Trip','Start Code','End Code','Var','Age','Age Group')
+            and (col not in null_values or recorded(df, col))]
+
+def scale_count(count, frac):
+    """
+    Formats a trip count, scaling counts taken from a sample up to an estimate.
 
-    return city
+    Args:
+        count - the number of trips counted
+        frac - the share of trips included in the data
+    """
+    if frac >= 1.0:
+        return count
 
-def load_data(city):
+    return '~{:,.0f}'.format(count / frac)
+
+def table_text(values, leading_space = True):
     """
-    Loads data for the specified city and performs the following:
-        - Column 'Unnamed: 0' is removed for consistency with online version
-        - Column formats updated where necessary
-        - Column 'Trip' created based on start and end stations
-        - New columns created separating the components of 'Start Time'
+    Decides how the values of a table column (or index level) are formatted, as
+    print(DataFrame) does, so that they can then be formatted a slice at a time.
 
     Args:
-        (str) city - name of the city to review
+        values - numpy array of the values
+        leading_space - True for column values, which have a space before them
 
     Returns:
-        df - Pandas DataFrame containing unfiltered city data
+        function formatting the values in rows start:stop as a list of text, or None
+        for other values (e.g. timestamps)
     """
-    start_time = time.time()
-    df = pd.read_csv(CITY_DATA[city])
+    if values.dtype.kind in 'iu':
+        template = '{: d}' if leading_space else '{:d}'
+        return lambda start, stop: list(map(template.format, values[start:stop].tolist()))
+
+    if values.dtype.kind == 'f' and leading_space:
+        finite = values[~np.isnan(values)]
+        if np.isinf(finite).any() or (np.abs(finite) > 1e6).any() or ((np.abs(finite) < 1e-6) & (finite != 0)).any():
+            # Very large or small values are shown in scientific notation, formatted
+            # together as they share an exponent width
+            text = list(pd.io.formats.format.format_array(values, None))
+            return lambda start, stop: text[start:stop]
+
+        # Values share the fewest decimal places (up to 6, at least 1) that show them all
+        def fixed(start, stop):
+            return ['NaN' if np.isnan(value) else '{: .6f}'.format(value) for value in values[start:stop].tolist()]
+
+        places = max([len(t.rstrip('0')) - t.index('.') - 1 for x in range(0, len(values), RENDER_ROWS)
+                      for t in fixed(x, x + RENDER_ROWS) if t != 'NaN'], default = 6)
+        trim = 6 - max(places, 1)
+        return lambda start, stop: [t if t == 'NaN' else t[:len(t) - trim] for t in fixed(start, stop)]
+
+    if values.dtype != object or pd.api.types.infer_dtype(values, skipna = False) != 'string':
+        return None
+
+    # Long text is shortened to the display column width (display.max_colwidth)
+    limit = pd.options.display.max_colwidth
+    if limit is None or limit <= 3:
+        limit = None
+
+    def text(start, stop):
+        text = [' ' + t for t in values[start:stop].tolist()] if leading_space else values[start:stop].tolist()
+        if limit is None:
+            return text
+        return [t if len(t) <= limit else t[:limit - 3] + '...' for t in text]
+
+    return text
+
+def render_table(table, file = None):
+    """
+    Prints a table of numbers (or text) in the same layout as print(DataFrame), but
+    without pandas' formatting machinery.  The column widths are calculated once
+    for the whole table and the rows are then formatted and written RENDER_ROWS at
+    a time, so long tables are printed quickly, in bounded memory and without being
+    truncated.
 
-    # Drop first column ('Unnamed: 0')
-    df = df.drop(['Unnamed: 0'], axis = 1)
+    Tables with other values (e.g. timestamps) are printed by pandas.
+
+    Args:
+        table - the DataFrame to print
+        file - the file to write to (default: the terminal)
+    """
+    file = sys.stdout if file is None else file
+    index = table.index
+    slices = range(0, len(table), RENDER_ROWS)
+
+    cols = [table_text(table.iloc[:, i].to_numpy()) if isinstance(col, (str, int)) else None
+            for i, col in enumerate(table.columns)]
+    labels = [table_text(index.get_level_values(level).to_numpy(), leading_space = False)
+              for level in range(index.nlevels)]
+    if len(table) == 0 or len(cols) == 0 or any(text is None for text in cols + labels):
+        print(table, file = file)
+        return
+
+    # Integer column labels are padded to the same width, and the labels of numeric
+    # columns allow for a leading space like their values (looked up by label, as
+    # pandas does)
+    headings = [str(col) for col in table.columns]
+    if table.columns.dtype.kind in 'iu':
+        headings = [heading.ljust(max(map(len, headings))) for heading in headings]
+    numeric = dict(zip(headings, [table.dtypes.iloc[i].kind in 'iuf' for i in range(len(headings))]))
+    headings = [' ' + heading if numeric[heading] else heading for heading in headings]
+    col_widths = [max([len(heading)] + [max(map(len, text(x, x + RENDER_ROWS))) for x in slices])
+                  for heading, text in zip(headings, cols)]
+
+    # Outer levels of a MultiIndex are only shown where they change
+    same = np.zeros(len(index), dtype = bool)
+    same[1:] = True
+    repeats = []
+    for level in range(index.nlevels - 1):
+        codes = index.codes[level]
+        same[1:] &= codes[1:] == codes[:-1]
+        repeats.append(same.copy())
+
+    def label_text(level, start, stop):
+        text = labels[level](start, stop)
+        if level < len(repeats):
+            text = ['' if repeat else label for repeat, label in zip(repeats[level][start:stop].tolist(), text)]
+        return text
+
+    names = ['' if name is None else str(name) for name in index.names]
+    index_widths = [max([len(name)] + [max(map(len, label_text(level, x, x + RENDER_ROWS))) for x in slices])
+                    for level, name in enumerate(names)]
+
+    header = '' if table.columns.name is None else str(table.columns.name)
+    index_width = sum(index_widths) + len(index_widths) - 1
+    if len(header) > index_width:
+        index_widths[-1] += len(header) - index_width
+        index_width = len(header)
+
+    # Tables wider than the display width are split into blocks of columns, as pandas
+    # does, each ending with a continuation mark unless it is the last block
+    line_width = pd.options.display.width - index_width - 1
+    ends = []
+    width = 0
+    for i, col_width in enumerate(col_widths):
+        width += col_width + 1
+        if i > 0 and width + (1 if i == len(col_widths) - 1 else 2) > line_width:
+            ends.append(i)
+            width = col_width + 1
+    ends.append(len(col_widths))
+    starts = [0] + ends[:-1]
+
+    for block, (start, end) in enumerate(zip(starts, ends)):
+        if block > 0:
+            file.write('\n')
+        if len(ends) == 1:
+            marks = ['', '']
+        elif block < len(ends) - 1:
+            marks = ['  \\', '   ']
+        else:
+            marks = ['  ', '  ']
+
+        widths = col_widths[start:end]
+        lines = [header.ljust(index_width) + ''.join(' ' + heading.rjust(w)
+                                                     for heading, w in zip(headings[start:end], widths)) + marks[0]]
+        if any(names):
+            lines.append(' '.join(name.ljust(w) for name, w in zip(names, index_widths))
+                         + ' ' * sum(w + 1 for w in widths) + marks[1])
+        file.write('\n'.join(lines) + '\n')
+
+        # Each row is laid out by a single format string, and only the rows being
+        # written are formatted
+        row_format = ' '.join(['{:<%d}' % w for w in index_widths] + ['{:>%d}' % w for w in widths]) + marks[1]
+        for x in slices:
+            rows = zip(*[label_text(level, x, x + RENDER_ROWS) for level in range(len(labels))],
+                       *[text(x, x + RENDER_ROWS) for text in cols[start:end]])
+            file.write('\n'.join(row_format.format(*row) for row in rows) + '\n')
+
+def show_counts(table, frac = 1.0, cols = None, scaled = (), file = None):
+    """
+    Prints a table of trip counts (see render_table).  Where the counts are taken
+    from a sample, they are scaled up to estimates of the total and annotated with
+    a 95% confidence interval.
 
-    # Change datetime columns to datetime format
-    df['Start Time'] = df['Start Time'].astype('datetime64')
-    df['End Time'] = df['End Time'].astype('datetime64')
+    Args:
+        table - the DataFrame of trip counts
+        frac - the share of trips included in the data
+        cols - the columns holding trip counts (default: all columns)
+        scaled - other columns which are scaled but not annotated
+        file - the file to write to (default: the terminal)
+    """
+    if frac >= 1.0:
+        render_table(table, file)
+        return
 
-    # Create new columns for components of Start Time
-    df.insert(1,'Month', df['Start Time'].dt.strftime('%b'))
-    df.insert(2,'Day', df['Start Time'].dt.strftime('%a'))
-    df.insert(3,'Hour', df['Start Time'].dt.strftime('%H'))
+    table = table.copy()
+    if cols is None:
+        cols = table.columns
 
-    # Create a Trip column based on start and end station
-    df['Trip'] = df['Start Station'] + ' to ' + df['End Station']
+    for col in cols:
+        counts = table[col].astype(float)
+        ci = 1.96 * np.sqrt(counts.abs() * (1 - frac)) / frac
+        table[col] = ['' if np.isnan(n) else '{:,.0f} \u00b1{:,.0f}'.format(n / frac, c)
+                      for n, c in zip(counts, ci)]
 
-    print("Processing time: %.2f seconds." % (time.time() - start_time))
+    for col in scaled:
+        table[col] = (table[col] / frac).round().astype(int)
 
-    return df
+    render_table(table, file)
+    print('(Estimated from a {:.1%} sample of trips, with 95% confidence intervals)'.format(frac), file = file)
 
 def city_summary(df):
     """
     Produces a summary table of trip volumes by month and by day of the week
-    for the selected city.
+    for the selected city.  Where the data covers more than one year, the days
+    of the week are shown for each year.
 
     Args:
         df - the DataFrame of of unfiltered data for the selected city
@@ -93,36 +1703,126 @@ def city_summary(df):
     Returns:
         df_summ - a summary table of trip volumes
     """
+    return summary_table(trip_counts(df), report_months(df))
+
+def summary_table(counts, months = None):
+    """
+    Produces the summary table of trip volumes by month and by day of the week
+    (see city_summary) from trip counts.
+
+    Args:
+        counts - trip counts created by trip_counts() (or merged by merge_partials())
+        months - the months reported (see report_months), or None for the months counted
 
+    Returns:
+        df_summ - a summary table of trip volumes
+    """
     # Create summary report for thes selected city
-    df_summary = df.groupby(['Month','Day'], as_index=False)['Trip'].count()
-    df_summary = df_summary.pivot(index = 'Day', columns = 'Month', values = 'Trip')
-    df_summary = df_summary.reindex(index = day_order, columns = mth_order)
+    years = sorted(counts['Year'].unique())
+    if len(years) > 1:
+        rows = ['Year','Day']
+        row_ord = pd.MultiIndex.from_product([years,day_order], names = rows)
+    else:
+        rows = 'Day'
+        row_ord = day_order
+    df_summary = counts.groupby(['Year','Month','Day'], as_index=False)['Trip'].sum()
+    df_summary = df_summary.pivot(index = rows, columns = 'Month', values = 'Trip')
+    df_summary = df_summary.reindex(index = row_ord, columns = present_months(counts['Month']) if months is None else months)
 
     return df_summary
 
-def get_filters():
+def parse_period(text):
+    """
+    Converts a date and/or hour range entered by the user into a period filter.
+    Examples of accepted ranges:
+        2017-03-15 to 2017-04-02, 07:00-10:00
+        2017-03 to 2017-04
+        2017-03-15
+        2017
+        07:00-10:00
+
+    Dates are inclusive, and a year or month on its own (YYYY or YYYY-MM) covers
+    the whole year or month. Hour ranges include the start time but not the end
+    time, and may run past midnight (e.g. 22:00-02:00).
+
+    Args:
+        (str) text - the range entered by the user
+
+    Returns:
+        period - dictionary with the 'start' and (exclusive) 'end' timestamps, the
+                 'hours' range in minutes after midnight, and the original 'text'
+                 (None if the text could not be understood)
+    """
+    numeric_stack()
+    period = {'start': None, 'end': None, 'hours': None, 'text': text.strip()}
+
+    for part in text.split(','):
+        part = part.strip()
+        if part == '':
+            continue
+
+        try:
+            if ':' in part:
+                times = part.replace('\u2013', '-').replace(' to ', '-').split('-')
+                h0, h1 = [pd.Timedelta(t.strip() + ':00') // pd.Timedelta(minutes = 1) for t in times]
+                period['hours'] = (h0, h1)
+            else:
+                dates = [date.strip() for date in part.split(' to ')]
+                period['start'] = np.datetime64(pd.Timestamp(dates[0]))
+                end = dates[-1]
+                if len(end) == 4 and end.isdigit():
+                    period['end'] = np.datetime64(pd.Timestamp(str(int(end) + 1)))
+                elif len(end) == 7 and end[0:4].isdigit() and end[4] == '-' and end[5:7].isdigit():
+                    period['end'] = np.datetime64(pd.Timestamp(end) + pd.offsets.MonthBegin(1))
+                else:
+                    period['end'] = np.datetime64(pd.Timestamp(end) + pd.Timedelta(days = 1))
+        except ValueError:
+            return None
+
+    return period
+
+def get_filters(available = None, years = None):
     """
     Asks user to specify a month and/or day of the week to review. Users can also
-    select all months and/or days.
+    select all months and/or days, and may optionally restrict the review to a
+    range of dates and/or hours of the day.  Where the data covers more than one
+    year, users may also select a year, which is applied as a range of dates.
+
+    Args:
+        available - the months with data (e.g. from the city's catalog), or None
+                    to offer all months
+        years - the years with data, or None to offer no choice of year
 
     Returns:
         (str) month - name of the month to filter by, or "all" to apply no month filter
         (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        period - date and hour range to filter by (see parse_period), or None
     """
-    months = ['Jan','Feb','Mar','Apr','May','Jun','All']
+    months = (month_names if available is None else available) + ['All']
     days = ['Mon','Tue','Wed','Thu','Fri','Sat','Sun','All']
 
-    # get user input for month (Jan, Feb, ... , Jun, All)
     print('_'*72)
     print('\nDATA FILTERING')
     print('\nYou can tailor your review by selecting one of the available months (per the table above) or one of the days of the week, or both.  Alternatively, you can include all months and days.')
+
+    # get user input for year, where the data covers more than one year
+    year = 'All'
+    if years is not None and len(years) > 1:
+        print('\nFilter by Year:')
+        year = ask('Would you like to review a particular year or all years ({})?\nPlease enter the year or type \'all\' (to include all years): '.format(', '.join(str(y) for y in years)))
+        year = year.strip().title()
+
+        while year not in [str(y) for y in years] + ['All']:
+            year = ask('Sorry, we do not have data for that year. Please try again: ')
+            year = year.strip().title()
+
+    # get user input for month (Jan, Feb, ... , Dec, All)
     print('\nFilter by Month:')
-    month_input = input('Would you like to review a particular month in detail or all months?\nPlease enter the name of the month or type \'all\' (to include all months): ')
+    month_input = ask('Would you like to review a particular month in detail or all months?\nPlease enter the name of the month or type \'all\' (to include all months): ')
     month_input = month_input.strip().title()[0:3]
 
     while month_input not in months:
-        month_input = input('Sorry, we do not have data for that month. Please try again: ')
+        month_input = ask('Sorry, we do not have data for that month. Please try again: ')
         month_input = month_input.strip().title()[0:3]
 
     month = month_input
@@ -130,29 +1830,71 @@ def get_filters():
     # get user input for day of week (Mon, Tue, ... Sun, All)
 
     print('\nFilter by Day:')
-    day_input = input('Would you like to review a particular day of the week or include all days?\nPlease enter the day of the week or type \'all\' (to include all days): ')
+    day_input = ask('Would you like to review a particular day of the week or include all days?\nPlease enter the day of the week or type \'all\' (to include all days): ')
     day_input = day_input.strip().title()[0:3]
 
     while day_input not in days:
-        day_input = input('Sorry, I don\'t recognise that day. Please try again: ')
+        day_input = ask('Sorry, I don\'t recognise that day. Please try again: ')
         day_input = day_input.strip().title()[0:3]
 
     day = day_input
 
-    return month, day
+    # get optional user input for a date and/or hour range
+
+    print('\nFilter by Date and Time:')
+    period_input = ask('Would you like to review a particular range of dates and/or hours?\nPlease enter the range (e.g. 2017-03-15 to 2017-04-02, 07:00-10:00) or press Enter to skip: ')
+    period = parse_period(period_input)
+
+    while period is None:
+        period_input = ask('Sorry, I don\'t recognise that range. Please try again, or press Enter to skip: ')
+        period = parse_period(period_input)
+
+    # The year selected restricts the dates to within the year
+    if year != 'All':
+        dates = parse_period(year)
+        if period['start'] is not None:
+            dates['start'] = max(dates['start'], period['start'])
+            dates['end'] = min(dates['end'], period['end'])
+        period.update(start = dates['start'], end = dates['end'],
+                      text = ', '.join(text for text in (year, period['text']) if text))
+
+    if period['text'] == '':
+        period = None
+
+    return month, day, period
 
-def load_filters(df,month,day):
+def load_filters(df,month,day,period = None):
     """
     Applies the month and day filters to the city data already selected.
 
+    Date ranges are resolved by a binary search of the (sorted) Start Time column,
+    which selects a contiguous slice of rows. The hour range and the month and day
+    filters are then only applied to the rows within that slice.
+
     Args:
         df - the DataFrame populated with the selected city data
         month - the month filter selected
         day - the day filter selected
+        period - the date and hour range selected (see parse_period), or None
 
     Returns:
         df - filtered DataFrame with additional data modifications
     """
+    if period is not None:
+        starts = df['Start Time'].to_numpy()
+        a = 0 if period['start'] is None else np.searchsorted(starts, period['start'])
+        b = len(starts) if period['end'] is None else np.searchsorted(starts, period['end'])
+        df = df.iloc[a:b]
+
+        if period['hours'] is not None:
+            h0, h1 = period['hours']
+            starts = starts[a:b]
+            minutes = (starts - starts.astype('datetime64[D]')) // np.timedelta64(1, 'm')
+            if h0 <= h1:
+                df = df.loc[(minutes >= h0) & (minutes < h1)]
+            else:
+                df = df.loc[(minutes >= h0) | (minutes < h1)]
+
     if month != 'All':
         df = df.loc[df['Month'] == month]
 
@@ -161,20 +1903,58 @@ def load_filters(df,month,day):
 
     return df
 
-def usage_stats(df,month,day):
+def trip_counts(df):
     """
-    Displays statistics on travel times including the most frequent times
-    of travel.  Statistics displayed are tailored based on the filters selected.
-    Summaries of trips by hour of travel are also available for review via a report menu.
+    Counts trips by year, month, day and hour, as a partial result that can be merged
+    with the counts for other parts of the data (see merge_partials).  The earliest
+    Start Time of each is kept, so that the most popular month, day and hour can be
+    chosen in the order they first appear, as value_counts() does.
 
     Args:
         df - the dataframe of selected data
-        month - the month filter selected
-        day - the day filter selected
+
+    Returns:
+        DataFrame of the number of trips ('Trip') and earliest Start Time ('First')
+        by Year, Month, Day and Hour
     """
-    start_time = time.time()
+    return text_keys(df.groupby(['Year','Month','Day','Hour'], as_index = False, sort = False, observed = True).agg(
+        Trip = ('Trip','count'), First = ('Start Time','min')))
+
+def usage_tables(df):
+    """
+    Calculates the statistics and summary tables for the usage times reports.
+    The DataFrame provided is not modified.
+
+    Args:
+        df - the dataframe of selected data
+
+    Returns:
+        dictionary of the most popular month, day and hour (with their trip counts)
+        and the usage summary tables
+    """
+    counts = chunk_partials(df, 'Counting', counts = trip_counts)['counts']
+
+    return usage_report(counts, report_months(df), report_periods(df))
+
+def usage_report(counts, months = None, periods = None):
+    """
+    Calculates the statistics and summary tables for the usage times reports (see
+    usage_tables) from trip counts.
+
+    Args:
+        counts - trip counts created by trip_counts() (or merged by merge_partials())
+        months - the months reported (see report_months), or None for the months counted
+        periods - the years and months reported (see report_periods), or None for
+                  those counted
 
+    Returns:
+        dictionary of the most popular month, day and hour (with their trip counts)
+        and the usage summary tables
+    """
+    df = counts.sort_values(by = 'First', kind = 'mergesort')
     df['Hour'] = df['Hour'].astype(int)
+    mth_order = present_months(df['Month']) if months is None else months
+    mth_keys, mth_rows, mth_day_rows = month_rows(df, mth_order, periods)
 
     time_groups = [(df['Hour'] >= 1) & (df['Hour'] < 5),
                   (df['Hour'] >= 5) & (df['Hour'] < 9),
@@ -182,86 +1962,128 @@ def usage_stats(df,month,day):
                   (df['Hour'] >= 13) & (df['Hour'] < 17),
                   (df['Hour'] >= 17) & (df['Hour'] < 21),
                   (df['Hour'] >= 21) | (df['Hour'] == 0)]
-    time_order = ['1am-5am','5am-9am','9am-1pm','1pm-5pm','5pm-9pm','9pm-1am']
-
     df['Hr Group'] = np.select(time_groups, time_order)
 
-    # calculate the most common month
-    top_mth = df['Month'].value_counts().idxmax()
-    top_mth_val = df['Month'].value_counts().max()
-    top_mth_txt = 'Most popular month was {} with {} trips'.format(top_mth,top_mth_val)
+    # calculate the most common month (in order of appearance, as value_counts())
+    mth_counts = df.groupby('Month', sort = False)['Trip'].sum().sort_values(ascending = False)
+    top_mth = mth_counts.index[0]
+    top_mth_val = mth_counts.iloc[0]
 
     # calculate the most common day of week
-    top_day = df['Day'].value_counts().idxmax()
-    top_day_val = df['Day'].value_counts().max()
-    top_day_txt = 'Most popular day was {} with {} trips'.format(top_day,top_day_val)
+    day_counts = df.groupby('Day', sort = False)['Trip'].sum().sort_values(ascending = False)
+    top_day = day_counts.index[0]
+    top_day_val = day_counts.iloc[0]
 
     # calculate the most common start hour
-    top_hr = df['Hour'].value_counts().idxmax()
-    top_hr_val = df['Hour'].value_counts().max()
-    top_hr_txt = 'Most popular hour was {}:00 with {} trips'.format(top_hr,top_hr_val)
+    hr_counts = df.groupby('Hour', sort = False)['Trip'].sum().sort_values(ascending = False)
+    top_hr = hr_counts.index[0]
+    top_hr_val = hr_counts.iloc[0]
 
     # create summary tables using a groupby() method
-    mth_summary = df.groupby(['Month','Hr Group'], as_index=False)['Trip'].count()
-    mth_summary = mth_summary.pivot(index = 'Month', columns = 'Hr Group', values = 'Trip')
-    mth_summary = mth_summary.reindex(index = mth_order, columns = time_order)
+    mth_summary = df.groupby(mth_keys + ['Hr Group'], as_index=False)['Trip'].sum()
+    mth_summary = mth_summary.pivot(index = mth_keys, columns = 'Hr Group', values = 'Trip')
+    mth_summary = mth_summary.reindex(index = mth_rows, columns = time_order)
     mth_summary = mth_summary.fillna(0).astype(int)
 
-    day_summary = df.groupby(['Day','Hr Group'], as_index=False)['Trip'].count()
+    day_summary = df.groupby(['Day','Hr Group'], as_index=False)['Trip'].sum()
     day_summary = day_summary.pivot(index = 'Day', columns = 'Hr Group', values = 'Trip')
     day_summary = day_summary.reindex(index = day_order, columns = time_order)
     day_summary = day_summary.fillna(0).astype(int)
 
-    hr_summary = df.groupby(['Hr Group'], as_index=False)['Trip'].count()
+    hr_summary = df.groupby(['Hr Group'], as_index=False)['Trip'].sum()
     hr_summary = hr_summary.set_index('Hr Group').transpose()
     hr_summary = hr_summary.reindex(columns = time_order)
     hr_summary = hr_summary.fillna(0).astype(int)
 
     # Create detailed reports accessed via the Usage Reports Menu
-    hr_mth_detail = df.groupby(['Hour','Month'], as_index=False)['Trip'].count()
-    hr_mth_detail = hr_mth_detail.pivot(index = 'Hour', columns = 'Month', values = 'Trip')
-    hr_mth_detail = hr_mth_detail.reindex(columns = mth_order)
+    hr_mth_detail = df.groupby(['Hour'] + mth_keys, as_index=False)['Trip'].sum()
+    hr_mth_detail = hr_mth_detail.pivot(index = 'Hour', columns = mth_keys, values = 'Trip')
+    hr_mth_detail = hr_mth_detail.reindex(columns = mth_rows)
     hr_mth_detail = hr_mth_detail.fillna(0).astype(int)
 
-    hr_day_detail = df.groupby(['Hour','Day'], as_index=False)['Trip'].count()
+    hr_day_detail = df.groupby(['Hour','Day'], as_index=False)['Trip'].sum()
     hr_day_detail = hr_day_detail.pivot(index = 'Hour', columns = 'Day', values = 'Trip')
     hr_day_detail = hr_day_detail.reindex(columns = day_order)
     hr_day_detail = hr_day_detail.fillna(0).astype(int)
 
-    index_ord = [mth_order,day_order]
-    row_ord = pd.MultiIndex.from_product(index_ord,names=['Month','Day'])
-    mth_day_summ = df.groupby(['Month','Day','Hr Group'], as_index = False)['Trip'].count()
-    mth_day_summ = mth_day_summ.pivot(index = ['Month','Day'], columns = 'Hr Group', values = 'Trip')
-    mth_day_summ = mth_day_summ.reindex(index = row_ord, columns = time_order)
+    mth_day_summ = df.groupby(mth_keys + ['Day','Hr Group'], as_index = False)['Trip'].sum()
+    mth_day_summ = mth_day_summ.pivot(index = mth_keys + ['Day'], columns = 'Hr Group', values = 'Trip')
+    mth_day_summ = mth_day_summ.reindex(index = mth_day_rows, columns = time_order)
     mth_day_summ = mth_day_summ.fillna(0).astype(int)
 
+    return {'top_mth': top_mth,
+            'top_mth_val': top_mth_val,
+            'top_day': top_day,
+            'top_day_val': top_day_val,
+            'top_hr': top_hr,
+            'top_hr_val': top_hr_val,
+            'mth_summary': mth_summary,
+            'day_summary': day_summary,
+            'hr_summary': hr_summary,
+            'hr_mth_detail': hr_mth_detail,
+            'hr_day_detail': hr_day_detail,
+            'mth_day_summ': mth_day_summ}
+
+def usage_summary(tables, month, day, frac = 1.0):
+    """
+    Prints the most popular month, day and hour, and the trip volumes by hour
+    band tailored to the filters selected.
+
+    Args:
+        tables - dictionary of tables created by usage_tables()
+        month - the month filter selected
+        day - the day filter selected
+        frac - the fraction of trips sampled (see sample_fraction)
+    """
+    top_mth_txt = 'Most popular month was {} with {} trips'.format(tables['top_mth'],scale_count(tables['top_mth_val'],frac))
+    top_day_txt = 'Most popular day was {} with {} trips'.format(tables['top_day'],scale_count(tables['top_day_val'],frac))
+    top_hr_txt = 'Most popular hour was {}:00 with {} trips'.format(tables['top_hr'],scale_count(tables['top_hr_val'],frac))
+
     # display the calculated values
     print('_'*74)
     print('\nBIKE SHARE USAGE TIMES ANALYSIS\n')
     if month != 'All' and day != 'All':
         print(top_hr_txt)
         print('\nTrip volumes by hour band for {}s in {}\n'.format(day,month))
-        print(hr_summary)
+        show_counts(tables['hr_summary'], frac)
     elif month != 'All' and day == 'All':
         print(top_day_txt)
         print(top_hr_txt)
         print('\nTrip volumes by hour band by day in {}\n'.format(month))
-        print(day_summary)
+        show_counts(tables['day_summary'], frac)
     elif month == 'All' and day != 'All':
         print(top_mth_txt)
         print(top_hr_txt)
         print('\nTrip volumes by hour band by month on {}s\n'.format(day))
-        print(mth_summary)
+        show_counts(tables['mth_summary'], frac)
     else:
         print(top_mth_txt)
         print(top_day_txt)
         print(top_hr_txt)
         print('\nTrip volumes by hour band by month\n')
-        print(mth_summary)
+        show_counts(tables['mth_summary'], frac)
         print('\nTrip volumes by hour band by day\n')
-        print(day_summary)
+        show_counts(tables['day_summary'], frac)
+
+def usage_stats(df,month,day):
+    """
+    Displays statistics on travel times including the most frequent times
+    of travel.  Statistics displayed are tailored based on the filters selected.
+    Summaries of trips by hour of travel are also available for review via a report menu.
+
+    Args:
+        df - the dataframe of selected data
+        month - the month filter selected
+        day - the day filter selected
+    """
+    start_time = time.time()
+    frac = sample_fraction(df)
 
-    input('Press Enter to continue to the Bike Share Usage Reports menu...')
+    tables = run_cancellable('Calculating the usage reports', usage_tables, df)
+
+    usage_summary(tables, month, day, frac)
+
+    pause('Press Enter to continue to the Bike Share Usage Reports menu...')
 
     # Bike Share Usage Reporting Menu
 
@@ -272,59 +2094,399 @@ def usage_stats(df,month,day):
         print('    1. Bike Share Trips by Hour by Month')
         print('    2. Bike Share Trips by Hour by Day')
         print('    3. Bike Share Trips by hour band by month by day ')
-        select = input('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
+        select = ask('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
         select = select.lower()
 
         while select not in ('1','2','3','q'):
-                select = input('That is not a valid option. Please try again: ')
+                select = ask('That is not a valid option. Please try again: ')
                 select = select.lower()
 
         if select == '1':
             print('\nTrip volumes by hour by month')
-            print(hr_mth_detail)
-            input('Press Enter to return to the Bike Share Usage Reports menu...')
+            show_counts(tables['hr_mth_detail'], frac)
+            pause('Press Enter to return to the Bike Share Usage Reports menu...')
         elif select == '2':
             print('\nTrip volumes by hour by day')
-            print(hr_day_detail)
-            input('Press Enter to return to the Bike Share Usage Reports menu...')
+            show_counts(tables['hr_day_detail'], frac)
+            pause('Press Enter to return to the Bike Share Usage Reports menu...')
         elif select == '3':
             print('\nTrip volumes by hour band by month and day')
-            print(mth_day_summ)
-            input('Press Enter to return to the Bike Share Usage Reports menu...')
+            show_counts(tables['mth_day_summ'], frac)
+            pause('Press Enter to return to the Bike Share Usage Reports menu...')
         else:
             break
 
-    # Remove any columns created specifically for usage stats
-    df = df.drop(['Hr Group'], axis = 1, inplace = True)
-
     time_spent = time.time() - start_time
     time_spent = datetime.timedelta(seconds = int(time_spent))
     print("\nThe Usage Reporting review took {}.".format(time_spent))
 
-def station_stats(df):
+def hour_of_week(times):
     """
-    Creates a new dataframe (df_stations) listing each station used in the
-    selected city during the period selected, and summarising the number of trips
-    that start and end at each station.
+    Converts an array of timestamps into hours of the week (0 = Monday 00:00 to 00:59).
 
-    Adds new columns to df_stations which include the difference between trip
-    starts and ends for each station as both the number of trips and % of starts.
+    Args:
+        times - numpy datetime64 array
 
-    Summarises bike share activity by trip (start staion to end station)
+    Returns:
+        array of hours of the week (0 to 167)
+    """
+    hours = times.astype('datetime64[h]').astype(np.int64)
 
-    Provides statistics and reports on trip volumes by station and by trip
-    for the selected city and period.
+    # 1 January 1970 was a Thursday (day 3 of the week)
+    return ((hours // 24 + 3) % 7) * 24 + hours % 24
+
+def station_flows(df, city):
+    """
+    Counts the trips leaving (departures) and arriving at (arrivals) each station
+    in each hour of the week, using the station codes created by load_data().
+    Departures are counted by hour of the Start Time, arrivals by hour of the End
+    Time.  Both matrices are built in a single vectorised pass over the data.
 
     Args:
-        df - the DataFrame of of unfiltered data for the selected city
+        df - the DataFrame of selected data
+        city - the selected city
+
+    Returns:
+        flows - dictionary with the 'departures' and 'arrivals' matrices
+                (stations x 168 hours of the week) and the 'stations' names
     """
-    start_time = time.time()
+    stations = city_store[city]['stations']
+    cells = len(stations) * 168
+
+    # Counted CHUNK_ROWS trips at a time, so that the user can cancel the report
+    progress_stage('Counting', len(df))
+    departures = np.zeros(cells, dtype = np.int64)
+    arrivals = np.zeros(cells, dtype = np.int64)
+    for start in range(0, len(df), CHUNK_ROWS):
+        chunk = df.iloc[start:start + CHUNK_ROWS]
+        departures += np.bincount(chunk['Start Code'].to_numpy().astype(np.int64) * 168
+                                  + hour_of_week(chunk['Start Time'].to_numpy()), minlength = cells)
+        arrivals += np.bincount(chunk['End Code'].to_numpy().astype(np.int64) * 168
+                                + hour_of_week(chunk['End Time'].to_numpy()), minlength = cells)
+        progress_step(len(chunk))
+
+    return {'departures': departures.reshape(-1, 168),
+            'arrivals': arrivals.reshape(-1, 168),
+            'stations': stations}
+
+def parse_hour_band(text):
+    """
+    Converts an hour band entered by the user (e.g. '7-10', '17' or 'Mon 7-10')
+    into the hours of the week it covers.  Bands include the start hour but not
+    the end hour.
+
+    Args:
+        (str) text - the hour band entered by the user
+
+    Returns:
+        list of hours of the week, or None if the band could not be understood
+    """
+    parts = text.strip().title().split()
+    days = range(7)
+    if len(parts) == 2 and parts[0][0:3] in day_order:
+        days = [day_order.index(parts[0][0:3])]
+        parts = parts[1:]
+    if len(parts) != 1:
+        return None
+
+    hours = parts[0].split('-')
+    if not all(h.isdigit() for h in hours) or len(hours) > 2:
+        return None
+    h0 = int(hours[0])
+    h1 = int(hours[-1]) if len(hours) == 2 else h0 + 1
+    if not (0 <= h0 < 24 and 0 < h1 <= 24 and h0 < h1):
+        return None
+
+    return [d * 24 + h for d in days for h in range(h0, h1)]
+
+def top_flows(flows, hours, n = 20, draining = True):
+    """
+    Finds the stations losing (draining) or gaining (filling) the most bikes over
+    the hours selected.
+
+    Args:
+        flows - the station flows created by station_flows()
+        hours - list of hours of the week to include
+        n - the number of stations to list
+        draining - True for the stations losing the most bikes, False for those gaining
+                   the most
+
+    Returns:
+        DataFrame listing the departures, arrivals and net flow of each station
+    """
+    departures = flows['departures'][:, hours].sum(axis = 1)
+    arrivals = flows['arrivals'][:, hours].sum(axis = 1)
+    net = arrivals - departures
+
+    order = net if draining else -net
+    n = min(n, len(net))
+    top = np.argpartition(order, n - 1)[:n]
+    top = top[np.argsort(order[top], kind = 'stable')]
+
+    report = pd.DataFrame({'Departures': departures[top], 'Arrivals': arrivals[top], 'Net': net[top]},
+                          index = pd.Index(flows['stations'][top], name = 'Station'))
+
+    return report
+
+def route_durations(df, city):
+    """
+    Calculates the trip count and the mean, median and 90th percentile trip duration
+    of each route (start station to end station), using the station codes created by
+    load_data().  The trips are sorted once by route code and duration, so that the
+    durations of each route form a sorted segment, and the statistics are calculated
+    for all segments at once.
+
+    Args:
+        df - the DataFrame of selected data
+        city - the selected city
+
+    Returns:
+        routes - dictionary with the 'start' and 'end' station codes of each route,
+                 its 'trips' and its 'mean', 'median' and 'p90' durations (seconds),
+                 and the 'stations' names
+    """
+    stations = city_store[city]['stations']
+    route = df['Start Code'].to_numpy().astype(np.int64) * len(stations) + df['End Code'].to_numpy()
+    duration = df['Trip Duration'].to_numpy()
+
+    # The sort is a single step, so the report can only be cancelled before and after it
+    progress_stage('Sorting')
+    progress_step(0)
+    order = np.lexsort((duration, route))
+    route = route[order]
+    duration = duration[order].astype(np.float64)
+    progress_step(len(route))
+
+    # Each route's segment starts where the route code changes
+    starts = np.flatnonzero(np.r_[True, route[1:] != route[:-1]]) if len(route) else np.zeros(0, dtype = np.int64)
+    trips = np.diff(np.r_[starts, len(route)])
+
+    def quantile(q):
+        # Linear interpolation between the closest durations, as in Series.quantile
+        pos = starts + (trips - 1) * q
+        lower = np.floor(pos).astype(np.int64)
+        upper = np.ceil(pos).astype(np.int64)
+        return duration[lower] + (duration[upper] - duration[lower]) * (pos - lower)
+
+    return {'start': route[starts] // len(stations),
+            'end': route[starts] % len(stations),
+            'trips': trips,
+            'mean': np.add.reduceat(duration, starts) / np.maximum(trips, 1),
+            'median': quantile(0.5),
+            'p90': quantile(0.9),
+            'stations': stations}
+
+def top_routes(routes, min_trips, n = 20, slowest = True):
+    """
+    Finds the routes with the longest (slowest) or shortest (fastest) median trip
+    duration, among the routes with at least min_trips trips.
+
+    Args:
+        routes - the route statistics created by route_durations()
+        min_trips - the minimum number of trips counted for a route to be included
+        n - the number of routes to list
+        slowest - True for the slowest routes, False for the fastest
+
+    Returns:
+        DataFrame listing the trips and the mean, median and 90th percentile duration
+        of each route
+    """
+    eligible = np.flatnonzero(routes['trips'] >= min_trips)
+
+    # Order by median, then by mean duration
+    sign = -1 if slowest else 1
+    top = eligible[np.lexsort((sign * routes['mean'][eligible], sign * routes['median'][eligible]))][:n]
+
+    stations = routes['stations']
+    trips = [start + ' to ' + end for start, end in zip(stations[routes['start'][top]], stations[routes['end'][top]])]
+    report = pd.DataFrame({'Trips': routes['trips'][top]}, index = pd.Index(trips, name = 'Trip'))
+    for col, stat in [('Mean','mean'), ('Median','median'), ('90th Pct','p90')]:
+        report[col] = [str(datetime.timedelta(seconds = int(round(s)))) for s in routes[stat][top]]
+
+    return report
+
+def station_index(df, stations):
+    """
+    Builds the station row index for the data loaded for a city: the row numbers of
+    the trips grouped by start station code and by end station code, with offsets
+    locating each station's rows (compressed sparse row format).  The trips starting
+    at station code c are rows[offsets[c]:offsets[c + 1]] of the 'start' index, in
+    Start Time order.
+
+    Args:
+        df - the DataFrame created by load_data(), before any filters are applied
+        stations - the station names, in order of their codes
+
+    Returns:
+        dictionary of the 'start' and 'end' indexes, each with its 'rows' and 'offsets'
+    """
+    row_type = np.int32 if len(df) <= np.iinfo(np.int32).max else np.int64
+    index = {}
+    for side, col in [('start','Start Code'), ('end','End Code')]:
+        codes = df[col].to_numpy()
+        index[side] = {'rows': np.argsort(codes, kind = 'stable').astype(row_type),
+                       'offsets': np.concatenate(([0], np.cumsum(np.bincount(codes, minlength = len(stations)))))}
+
+    return index
+
+def station_rows(df, city, code, side = 'start'):
+    """
+    Finds the trips starting (or ending) at a station from the station row index
+    (see station_index), in time proportional to the station's trips.  The filters
+    applied by load_filters() keep the row numbers of the loaded data as the index
+    of df, so the station's rows are located in df by a binary search.
+
+    Args:
+        df - the DataFrame of selected data
+        city - the selected city
+        code - the station code
+        side - 'start' for the trips starting at the station, 'end' for those ending
+               there
+
+    Returns:
+        array of the positions in df of the station's trips, in Start Time order
+    """
+    index = city_store[city]['station_index'][side]
+    rows = index['rows'][index['offsets'][code]:index['offsets'][code + 1]]
+
+    if isinstance(df.index, pd.RangeIndex) and df.index.step == 1:
+        rows = rows[(rows >= df.index.start) & (rows < df.index.stop)]
+        return rows - df.index.start
+
+    labels = df.index.to_numpy()
+    positions = np.searchsorted(labels, rows)
+    found = positions < len(labels)
+    found[found] = labels[positions[found]] == rows[found]
+
+    return positions[found]
+
+def match_station(stations, text):
+    """
+    Finds a station by name: the station named exactly as entered (ignoring case),
+    or otherwise the first station whose name contains the text entered.
+
+    Args:
+        stations - the station names, in order of their codes
+        text - the name entered by the user
+
+    Returns:
+        (int) the station code, or None if no station matches
+    """
+    name = text.strip().lower()
+    names = pd.Index(stations).str.lower()
+    matches = np.flatnonzero(names == name)
+    if len(matches) == 0:
+        matches = np.flatnonzero(names.str.contains(name, regex = False))
+
+    return int(matches[0]) if len(matches) > 0 else None
+
+def station_detail(df, city, code, n = 10):
+    """
+    Calculates the drill-down report for a station: its trips, the trips starting
+    and ending there by hour of the day, its most common destinations, and the
+    durations of its trips.  Only the station's trips are read, using the station
+    row index (see station_rows).
+
+    Args:
+        df - the DataFrame of selected data
+        city - the selected city
+        code - the station code
+        n - the number of destinations to list
+
+    Returns:
+        dictionary of the number of 'departures' and 'arrivals', the station's 'trips'
+        (in Start Time order) and the 'hourly', 'destinations' and 'durations' tables
+    """
+    stations = city_store[city]['stations']
+    starts = station_rows(df, city, code, 'start')
+    ends = station_rows(df, city, code, 'end')
+    durations = df['Trip Duration'].to_numpy()
+
+    # Departures by hour of the Start Time, arrivals by hour of the End Time
+    start_hours = df['Start Time'].to_numpy()[starts].astype('datetime64[h]').astype(np.int64) % 24
+    end_hours = df['End Time'].to_numpy()[ends].astype('datetime64[h]').astype(np.int64) % 24
+    hourly = pd.DataFrame({'Departures': np.bincount(start_hours, minlength = 24),
+                           'Arrivals': np.bincount(end_hours, minlength = 24)},
+                          index = pd.Index(range(24), name = 'Hour'))
+
+    # Most common destinations of the trips starting at the station
+    ends_at = df['End Code'].to_numpy()[starts]
+    start_durations = durations[starts]
+    counts = np.bincount(ends_at, minlength = len(stations))
+    top = np.argsort(-counts, kind = 'stable')[:n]
+    top = top[counts[top] > 0]
+    destinations = pd.DataFrame({'Trips': counts[top]}, index = pd.Index(stations[top], name = 'Destination'))
+    destinations['Median'] = [str(datetime.timedelta(seconds = int(round(np.median(start_durations[ends_at == d])))))
+                              for d in top]
+
+    # Durations of the trips starting and ending at the station
+    summary = []
+    for rows in (starts, ends):
+        trip_times = durations[rows]
+        if len(trip_times) == 0:
+            summary.append([0, '', '', '', ''])
+            continue
+        stats = [trip_times.mean(), np.median(trip_times), np.percentile(trip_times, 90), trip_times.max()]
+        summary.append([len(trip_times)] + [str(datetime.timedelta(seconds = int(round(stat)))) for stat in stats])
+    summary = pd.DataFrame(summary, columns = ['Trips','Mean','Median','90th Pct','Longest'],
+                           index = ['Starting here','Ending here'])
+
+    return {'departures': len(starts),
+            'arrivals': len(ends),
+            'trips': df.iloc[np.union1d(starts, ends)],
+            'hourly': hourly,
+            'destinations': destinations,
+            'durations': summary}
+
+def route_counts(df):
+    """
+    Counts trips by month, day and route (start and end station), as a partial result
+    that can be merged with the counts for other parts of the data (see merge_partials).
+    The earliest Start Time of each is kept (see trip_counts).
+
+    Args:
+        df - the DataFrame of selected data
+
+    Returns:
+        DataFrame of the number of trips ('Trip') and earliest Start Time ('First')
+        by Month, Day, Start Station and End Station
+    """
+    return text_keys(df.groupby(['Month','Day','Start Station','End Station'], as_index = False, sort = False,
+                                observed = True).agg(Trip = ('Trip','count'), First = ('Start Time','min')))
+
+def station_tables(df):
+    """
+    Calculates the statistics and reports for the station and trip activity reports.
+
+    Args:
+        df - the DataFrame of selected data
+
+    Returns:
+        dictionary of the summary station statistics and station and trip reports
+    """
+    return station_report(chunk_partials(df, 'Counting', routes = route_counts)['routes'])
+
+def station_report(routes):
+    """
+    Calculates the statistics and reports for the station and trip activity reports
+    (see station_tables) from route counts.
+
+    Args:
+        routes - route counts created by route_counts() (or merged by merge_partials())
+
+    Returns:
+        dictionary of the summary station statistics and station and trip reports
+    """
+    # Trip counts by route, in order of appearance
+    routes = routes.sort_values(by = 'First', kind = 'mergesort')
+    routes['Trip Name'] = routes['Start Station'] + ' to ' + routes['End Station']
+    trip_counts = routes.groupby('Trip Name', sort = False)['Trip'].sum()
 
     # Create two summary tables based on start and end stations
-    df_start = df.groupby(['Start Station'], as_index=False)['Trip'].count()
+    df_start = routes.groupby(['Start Station'], as_index=False)['Trip'].sum()
     df_start = df_start.rename(columns = {'Start Station':'Station','Trip':'Starts'})
 
-    df_end = df.groupby(['End Station'], as_index=False)['Trip'].count()
+    df_end = routes.groupby(['End Station'], as_index=False)['Trip'].sum()
     df_end = df_end.rename(columns = {'End Station':'Station','Trip':'Ends'})
 
     # Merge the two summary tables to create table of total starts and ends by station
@@ -349,8 +2511,9 @@ def station_stats(df):
 
     max_ends = df_stations['Ends'].max()
     max_ends_loc = df_stations.iloc[df_stations['Ends'].idxmax()][0]
-    top_trip = df['Trip'].value_counts().max()
-    top_trip_loc = df['Trip'].value_counts().idxmax()
+    top_trips = trip_counts.sort_values(ascending = False)
+    top_trip = top_trips.iloc[0]
+    top_trip_loc = top_trips.index[0]
 
     avg_starts = round(df_stations['Starts'].mean())
 
@@ -382,7 +2545,7 @@ def station_stats(df):
     bottom_stat = stat_sort[-20:-1].drop(['total'], axis=1)
 
     # The 20 most and least common trips
-    df_trip = df.groupby(['Trip'], as_index = False)['Trip Duration'].count()
+    df_trip = trip_counts.sort_index().rename_axis('Trip').reset_index(name = 'Trip Duration')
     df_trip = df_trip.sort_values(by = 'Trip Duration', ascending = False).rename(columns = {'Trip Duration':'Trip Count'})
     df_trip = df_trip.set_index('Trip')
     top_20_trip = df_trip[0:20]
@@ -393,20 +2556,87 @@ def station_stats(df):
     top_var = df_stations.sort_values(by = 'absvar', ascending = False)[0:20].drop(['absvar','total'],axis=1)
     top_var = top_var.set_index('Station')
 
+    return {'tot_trips': tot_trips,
+            'num_stations': num_stations,
+            'max_starts': max_starts,
+            'max_starts_loc': max_starts_loc,
+            'max_ends': max_ends,
+            'max_ends_loc': max_ends_loc,
+            'top_trip': top_trip,
+            'top_trip_loc': top_trip_loc,
+            'avg_starts': avg_starts,
+            'med_starts': med_starts,
+            'med_ends': med_ends,
+            'max_var': max_var,
+            'max_var_loc': max_var_loc,
+            'station_det': station_det,
+            'null_list': null_list,
+            'high_per': high_per,
+            'top_stat': top_stat,
+            'bottom_stat': bottom_stat,
+            'top_20_trip': top_20_trip,
+            'bottom_20_trip': bottom_20_trip,
+            'top_var': top_var}
+
+def station_summary(tables, frac = 1.0):
+    """
+    Prints the summary station statistics: total trips and stations, the most
+    popular stations and trip, and the average and median starts and ends.
+
+    Args:
+        tables - dictionary of tables created by station_tables()
+        frac - the fraction of trips sampled (see sample_fraction)
+    """
     # Print summary statistics
     print('_'*72)
     print('\nSUMMARY STATION STATISTICS\n')
-    print('There was a total of {} trips across {} stations.'.format(tot_trips,num_stations))
-    print('\nThe most popular station for trip starts was {} with {} trips.'.format(max_starts_loc, max_starts))
-    print('The most popular station for trip ends was {} with {} trips.'.format(max_ends_loc, max_ends))
-    print('The most popular trip was {} with {} trips.'.format(top_trip_loc, top_trip))
-    print('\nThe average trip starts per station was {}.'.format(avg_starts))
-    print('\nThe median trip starts per station was {}.'.format(med_starts))
-    print('The median trip ends per station was {}.'.format(med_ends))
-    print('\nThe largest difference between trip starts and ends was {} \nat {} station.\n'.format(max_var, max_var_loc))
-    input('Press Enter to continue to the Station Utilisation Reports menu...')
+    print('There was a total of {} trips across {} stations.'.format(scale_count(tables['tot_trips'],frac),tables['num_stations']))
+    print('\nThe most popular station for trip starts was {} with {} trips.'.format(tables['max_starts_loc'], scale_count(tables['max_starts'],frac)))
+    print('The most popular station for trip ends was {} with {} trips.'.format(tables['max_ends_loc'], scale_count(tables['max_ends'],frac)))
+    print('The most popular trip was {} with {} trips.'.format(tables['top_trip_loc'], scale_count(tables['top_trip'],frac)))
+    print('\nThe average trip starts per station was {}.'.format(scale_count(tables['avg_starts'],frac)))
+    print('\nThe median trip starts per station was {}.'.format(scale_count(tables['med_starts'],frac)))
+    print('The median trip ends per station was {}.'.format(scale_count(tables['med_ends'],frac)))
+    print('\nThe largest difference between trip starts and ends was {} \nat {} station.\n'.format(scale_count(tables['max_var'],frac), tables['max_var_loc']))
+
+def station_stats(df, city):
+    """
+    Creates a new dataframe (df_stations) listing each station used in the
+    selected city during the period selected, and summarising the number of trips
+    that start and end at each station.
+
+    Adds new columns to df_stations which include the difference between trip
+    starts and ends for each station as both the number of trips and % of starts.
+
+    Summarises bike share activity by trip (start staion to end station)
+
+    Provides statistics and reports on trip volumes by station and by trip
+    for the selected city and period.
+
+    Rebalancing reports show the net flow of bikes (arrivals less departures) at
+    each station by hour, from a station x hour of week matrix built on request.
+
+    Route duration reports list the slowest and fastest routes by median trip
+    duration, from route statistics built on request (see route_durations).
+
+    The station drill-down reports on the trips of a single station, read using the
+    station row index built at load (see station_detail).
+
+    Args:
+        df - the DataFrame of of unfiltered data for the selected city
+        city - the selected city
+    """
+    start_time = time.time()
+    frac = sample_fraction(df)
+
+    tables = run_cancellable('Calculating the station reports', station_tables, df)
+
+    station_summary(tables, frac)
+    pause('Press Enter to continue to the Station Utilisation Reports menu...')
 
     # Station Utilisation Report Menu
+    flows = None
+    routes = None
     while True:
         print('_'*72)
         print('\nSTATION AND TRIP ACTIVITY REPORTS\n')
@@ -421,78 +2651,175 @@ def station_stats(df):
         print('\nTrip Reports:')
         print('    7. The 20 most common trips')
         print('    8. The 20 least common trips')
-        select = input('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
+        print('\nRebalancing Reports:')
+        print('    9. The 20 stations losing the most bikes in an hour band')
+        print('   10. The 20 stations gaining the most bikes in an hour band')
+        print('   11. Net flow of bikes by hour of the week for a station')
+        print('\nRoute Duration Reports:')
+        print('   12. The 20 slowest routes (by median trip duration)')
+        print('   13. The 20 fastest routes (by median trip duration)')
+        print('\nStation Drill-down:')
+        print('   14. Trips, hourly profile, destinations and durations for a station')
+        select = ask('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
         select = select.lower()
 
-        while select not in ('1','2','3','4','5','6','7','8','q'):
-                select = input('That is not a valid option. Please try again: ')
+        while select not in ('1','2','3','4','5','6','7','8','9','10','11','12','13','14','q'):
+                select = ask('That is not a valid option. Please try again: ')
                 select = select.lower()
 
         if select == '1':
             print('_'*72)
             print('\nStations with trip starts but no ends (and vice versa)')
-            print(null_list)
-            input('Press Enter to return to the Station and Trip Activity Reports menu...')
+            show_counts(tables['null_list'], frac, cols = ['Starts','Ends'], scaled = ['Var'])
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
 
         elif select == '2':
             print('_'*72)
             print('\nThe 20 most utilised stations')
-            print(top_stat)
-            input('Press Enter to return to the Station and Trip Activity Reports menu...')
+            show_counts(tables['top_stat'], frac, cols = ['Starts','Ends'], scaled = ['Var'])
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
 
         elif select == '3':
             print('_'*72)
             print('\nThe 20 least utilised stations')
-            print(bottom_stat)
-            input('Press Enter to return to the Station and Trip Activity Reports menu...')
+            show_counts(tables['bottom_stat'], frac, cols = ['Starts','Ends'], scaled = ['Var'])
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
 
         elif select == '4':
             print('_'*72)
             print('\nThe 20 stations with the largest variation between starts and ends')
-            print(top_var)
-            input('Press Enter to return to the Station and Trip Activity Reports menu...')
+            show_counts(tables['top_var'], frac, cols = ['Starts','Ends'], scaled = ['Var'])
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
 
         elif select == '5':
             print('_'*72)
             print('\nThe stations where the difference between starts and ends is greater than 50%')
-            print(high_per)
-            input('Press Enter to return to the Station and Trip Activity Reports menu...')
+            show_counts(tables['high_per'], frac, cols = ['Starts','Ends'], scaled = ['Var'])
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
 
         elif select == '6':
             print('_'*72)
             print('\nDETAILED STATION REPORT\n')
-            print('The detailed station report lists all stations with activity during the period and includes trip volumes. Please note, this report contains {} rows.'.format(len(df_stations)))
-            view_det = input('Would you like to continue? (Y/N): ')
+            print('The detailed station report lists all stations with activity during the period and includes trip volumes. Please note, this report contains {} rows.'.format(len(tables['station_det'])))
+            view_det = ask('Would you like to continue? (Y/N, or F to save the report to a file): ')
             view_det = view_det.lower()
 
-            while view_det not in ['y','n']:
-                view_det = input('That is not a valid option.  Please type \'Y\' or \'N\' and press Enter: ')
+            while view_det not in ['y','n','f']:
+                view_det = ask('That is not a valid option.  Please type \'Y\', \'N\' or \'F\' and press Enter: ')
                 view_det = view_det.lower()
 
             if view_det == 'y':
-                a = 0
-                b = 24
-                while True:
-                    print('\nSTATION REPORT - Lists all stations with trips recorded during the period\n')
-                    print(station_det[a:b])
-                    if b >= (len(station_det) - 1):
-                        input('Report End: Press Enter to to return to the Station and Trip Activity Reports menu...')
-                        break
-                    input('Press Enter to continue...')
-                    a += 24
-                    b += 24
+                page_data(tables['station_det'], '\nSTATION REPORT - Lists all stations with trips recorded during the period\n',
+                          page_size = 24,
+                          show = lambda page: show_counts(page, frac, cols = ['Starts','Ends'], scaled = ['Var']))
+            elif view_det == 'f':
+                path = '{}_stations.txt'.format(city.replace(' ', '_'))
+                with open(path, 'w') as f:
+                    f.write('STATION REPORT - Lists all stations with trips recorded during the period\n\n')
+                    show_counts(tables['station_det'], frac, cols = ['Starts','Ends'], scaled = ['Var'], file = f)
+                print('\nThe station report has been saved to {}.'.format(path))
+                pause('Press Enter to return to the Station and Trip Activity Reports menu...')
 
         elif select == '7':
             print('_'*72)
             print('\nThe 20 most common trips during the period selected')
-            print(top_20_trip)
-            input('Press Enter to return to the Station and Trip Activity Reports menu...')
+            show_counts(tables['top_20_trip'], frac)
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
 
         elif select == '8':
             print('_'*72)
             print('\nThe 20 least common trips during the period selected')
-            print(bottom_20_trip)
-            input('Press Enter to return to the Station and Trip Activity Reports menu...')
+            show_counts(tables['bottom_20_trip'], frac)
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
+
+        elif select in ('9','10','11'):
+            if flows is None:
+                flows = run_cancellable('Calculating the station flows', station_flows, df, city)
+
+            print('_'*72)
+            if select in ('9','10'):
+                band = ask('\nPlease enter the hour band, optionally with a day (e.g. \'7-10\' or \'Mon 7-10\'): ')
+                hours = parse_hour_band(band)
+
+                while hours is None:
+                    band = ask('Sorry, I don\'t recognise that hour band. Please try again: ')
+                    hours = parse_hour_band(band)
+
+                if select == '9':
+                    print('\nThe 20 stations losing the most bikes in the hour band {}'.format(band.strip()))
+                else:
+                    print('\nThe 20 stations gaining the most bikes in the hour band {}'.format(band.strip()))
+                show_counts(top_flows(flows, hours, draining = (select == '9')), frac,
+                            cols = ['Departures','Arrivals'], scaled = ['Net'])
+
+            else:
+                code = match_station(flows['stations'], ask('\nPlease enter the name of the station: '))
+                if code is None:
+                    print('\nSorry, no station was found matching that name.')
+                else:
+                    net = flows['arrivals'][code] - flows['departures'][code]
+                    net = pd.DataFrame(net.reshape(7, 24), index = pd.Index(day_order, name = 'Day'),
+                                       columns = pd.Index(range(24), name = 'Hour'))
+                    print('\nNet flow of bikes (arrivals less departures) at {} by hour of the week'.format(flows['stations'][code]))
+                    show_counts(net, frac, cols = [], scaled = net.columns)
+
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
+
+        elif select in ('12','13'):
+            if routes is None:
+                routes = run_cancellable('Calculating the route durations', route_durations, df, city)
+
+            print('_'*72)
+            min_trips = ask('\nPlease enter the minimum number of trips for a route to be included (default 10): ').strip()
+            while min_trips and not min_trips.isdigit():
+                min_trips = ask('That is not a valid number. Please try again: ').strip()
+            min_trips = int(min_trips) if min_trips else 10
+
+            if select == '12':
+                print('\nThe 20 slowest routes with at least {} trips'.format(min_trips))
+            else:
+                print('\nThe 20 fastest routes with at least {} trips'.format(min_trips))
+            # Sampled routes are included on their estimated number of trips
+            report = top_routes(routes, max(1, round(min_trips * frac)), slowest = (select == '12'))
+            if len(report) == 0:
+                print('\nThere are no routes with at least {} trips.'.format(min_trips))
+            else:
+                show_counts(report, frac, cols = ['Trips'])
+
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
+
+        elif select == '14':
+            print('_'*72)
+            stations = city_store[city]['stations']
+            code = match_station(stations, ask('\nPlease enter the name of the station: '))
+            if code is None:
+                print('\nSorry, no station was found matching that name.')
+            else:
+                detail = station_detail(df, city, code)
+                print('\nSTATION DRILL-DOWN - {}\n'.format(stations[code]))
+                print('There were {} trips starting and {} trips ending at the station.'.format(
+                      scale_count(detail['departures'], frac), scale_count(detail['arrivals'], frac)))
+                print('\nTrips by hour of the day (departures by start time, arrivals by end time)')
+                show_counts(detail['hourly'], frac)
+                if len(detail['destinations']) > 0:
+                    print('\nThe {} most common destinations'.format(len(detail['destinations'])))
+                    show_counts(detail['destinations'], frac, cols = ['Trips'])
+                print('\nTrip durations')
+                show_counts(detail['durations'], frac, cols = ['Trips'])
+
+                if len(detail['trips']) > 0:
+                    view = ask('\nWould you like to view the trips starting or ending at the station? (Y/N): ')
+                    view = view.lower()
+
+                    while view not in ['y','n']:
+                        view = ask('That is not a valid option.  Please type \'Y\' or \'N\' and press Enter: ')
+                        view = view.lower()
+
+                    if view == 'y':
+                        page_data(detail['trips'], '\nSTATION TRIPS - Lists the trips starting or ending at {}\n'.format(stations[code]),
+                                  cols = source_columns(df))
+
+            pause('Press Enter to return to the Station and Trip Activity Reports menu...')
 
         else:
             break
@@ -501,7 +2828,7 @@ def station_stats(df):
     time_spent = datetime.timedelta(seconds = int(time_spent))
     print("\nThe Station Reporting review took {}.".format(time_spent))
 
-def trip_dur_report(month, day, tot_report, mth_report, day_report, mth_day_report):
+def trip_dur_report(month, day, tot_report, mth_report, day_report, mth_day_report, frac = 1.0):
     """
     Prints the relevant trip duration summary reports, subject to the selected reporting criteria.
 
@@ -512,6 +2839,7 @@ def trip_dur_report(month, day, tot_report, mth_report, day_report, mth_day_repo
         mth_report - summary of trips by month by trip duration category
         day_report - summary of trips by day by trip duration category
         mth_day_report - summary of trips by month by day and by trip duration category
+        frac - the share of trips included in the data
     """
 
     print('_'*72)
@@ -519,43 +2847,43 @@ def trip_dur_report(month, day, tot_report, mth_report, day_report, mth_day_repo
 
     if (month == 'All') & (day == 'All'):
         print('Summary of all trips by Trip duration category')
-        print(tot_report)
+        show_counts(tot_report, frac)
         print('\nSummary of trips by Month by Trip duration category')
-        print(mth_report)
+        show_counts(mth_report, frac)
         print('\nSummary of trips by Day by Trip duration category')
-        print(day_report)
-        extra = input('\nWould you like to see a summary of trips by Trip duration category by both Month and Day? (Y/N): ')
+        show_counts(day_report, frac)
+        extra = ask('\nWould you like to see a summary of trips by Trip duration category by both Month and Day? (Y/N): ')
         extra = extra.lower()
 
         while extra not in ['y','n']:
-            extra = input('That is not a valid option.  Please enter either \'Y\' or \'N\':')
+            extra = ask('That is not a valid option.  Please enter either \'Y\' or \'N\':')
             extra = extra.lower()
 
         if extra == 'y':
             print('\nSummary of trips by Month by Day by Trip duration category')
-            print(mth_day_report)
-            input('Press Enter to return to the Trip Duration Reporting Menu...')
+            show_counts(mth_day_report, frac)
+            pause('Press Enter to return to the Trip Duration Reporting Menu...')
 
     elif (month == 'All') & (day != 'All'):
         print('Summary of all trips on {}s by Trip duration category'.format(day))
-        print(tot_report)
+        show_counts(tot_report, frac)
         print('\nSummary of trips on {}s by Month by Trip duration category'.format(day))
-        print(mth_report)
-        input('Press Enter to return to the Trip Duration Reporting Menu...')
+        show_counts(mth_report, frac)
+        pause('Press Enter to return to the Trip Duration Reporting Menu...')
 
     elif (month != 'All') & (day == 'All'):
         print('Summary of all trips in {} by Trip duration category'.format(month))
-        print(tot_report)
+        show_counts(tot_report, frac)
         print('\nSummary of trips in {} by Day by Trip duration category'.format(month))
-        print(day_report)
-        input('Press Enter to return to the Trip Duration Reporting Menu...')
+        show_counts(day_report, frac)
+        pause('Press Enter to return to the Trip Duration Reporting Menu...')
 
     else:
         print('Summary of all trips by trip duration category for {}s in {}'.format(day, month))
-        print(tot_report)
-        input('Press Enter to return to the Trip Duration Reports menu...')
+        show_counts(tot_report, frac)
+        pause('Press Enter to return to the Trip Duration Reports menu...')
 
-def except_report(duration_except, ex_count):
+def except_report(duration_except, ex_count, frac = 1.0):
     """
     Prints an exception summary report if any trip duration exceptions were identified.
     An exception is where the difference between start time and end time is different
@@ -565,6 +2893,7 @@ def except_report(duration_except, ex_count):
     Args:
         duration_except - the trip duration exception report
         ex_count - the number of exceptions counted
+        frac - the share of trips included in the data
     """
     print('_'*72)
     print('\nTRIP DURATION EXCEPTIONS')
@@ -574,23 +2903,28 @@ def except_report(duration_except, ex_count):
         print('\nThe following exception report has been produced by comparing the difference between the Trip Start and End Times, and the Trip Duration data.')
         print('\nVariances in the summary table below are based on the absolute value of the variance and have been categorised into bands to simplify analysis.')
         print('\nSummary of Trip Duration Exceptions')
-        print(duration_except)
+        show_counts(duration_except, frac)
         print('\nSome exceptions may warrant investigation.')
     else:
         print('\nThere are no trip duration exceptions to report')
 
-    input('Press Enter to return to the Trip Duration Reports menu...')
+    pause('Press Enter to return to the Trip Duration Reports menu...')
 
-def trip_duration_stats(df, month, day):
+def duration_partials(df):
     """
-    Produces trip duration reports and statistics for the selected city.
+    Counts trips by year, month, day and trip duration band, and trip duration
+    exceptions by year, month, day and variance category, and totals the trip
+    durations by year, month and day, as partial results that can be merged with
+    those for other parts of the data (see merge_partials).
 
     Args:
-        df - the DataFrame of of unfiltered data for the selected city
-        month - the month filter selected
-        day - the day filter selectd
+        df - the DataFrame of selected data
+
+    Returns:
+        dictionary of the 'bands' and 'exceptions' counts ('Trip') and the 'totals'
+        (number of trips, total, longest and shortest duration)
     """
-    start_time = time.time()
+    df = df[['Trip Duration','Var','Year','Month','Day','Trip']].copy()
 
     # Create new column for trip duration bands
     dur_groups = [(df['Trip Duration'] <= 300),
@@ -601,16 +2935,11 @@ def trip_duration_stats(df, month, day):
                   (df['Trip Duration'] > 3600) & (df['Trip Duration'] <= 10800),
                   (df['Trip Duration'] > 10800) & (df['Trip Duration'] <= 21600),
                   (df['Trip Duration'] > 21600)]
-    values = ['5 min','10 min','15 min','20 min','1 hr','3 hr','6 hr','>6 hr']
 
-    df['Trip Times'] = np.select(dur_groups, values)
+    df['Trip Times'] = np.select(dur_groups, duration_bands)
 
-    # Calculate the difference in seconds between Start Time and End Time and compare to Trip Duration
-    df.insert(7,'Date Diff', df['End Time'] - df['Start Time'])
-    df.insert(8,'Seconds', df['Date Diff'].dt.total_seconds().astype(int))
-    df.insert(9,'Var', abs((df['Trip Duration'] - df['Seconds'])).astype(int))
-
-    # Define variance category
+    # Define variance category (the difference between Trip Duration and the recorded
+    # times is calculated at load, see clean_trips)
     definition = [(df['Var'] <= 1),
                   (df['Var'] > 1) & (df['Var'] <= 5),
                   (df['Var'] > 5) & (df['Var'] <= 60),
@@ -619,68 +2948,170 @@ def trip_duration_stats(df, month, day):
                   (df['Var'] > 3600) & (df['Var'] <= 21600),
                   (df['Var'] > 21600) & (df['Var'] <= 86400),
                   (df['Var'] > 86400)]
-    categories = ['1 sec','5 sec','1 min','10 min','1 hr','6 hr','24 hr','>24 hr']
-    df['Var Cat'] = np.select(definition, categories)
+    df['Var Cat'] = np.select(definition, variance_bands)
+
+    # Durations are totalled as int64, as the total may not fit in the int32 column
+    df['Duration'] = df['Trip Duration'].astype(np.int64)
+
+    groups = {'observed': True, 'as_index': False, 'sort': False}
+    return {'bands': text_keys(df.groupby(['Year','Month','Day','Trip Times'], **groups)['Trip'].count()),
+            'exceptions': text_keys(df[df['Var'] != 0].groupby(['Year','Month','Day','Var Cat'], **groups)['Trip'].count()),
+            'totals': text_keys(df.groupby(['Year','Month','Day'], **groups).agg(
+                Trip = ('Trip','count'), Duration = ('Duration','sum'),
+                Longest = ('Duration','max'), Shortest = ('Duration','min')))}
+
+def duration_tables(df, city, month, day, period = None):
+    """
+    Calculates the statistics and reports for the trip duration reports.
+    The DataFrame provided is not modified.
+
+    Args:
+        df - the DataFrame of selected data
+        city - selected city
+        month - the month filter selected
+        day - the day filter selected
+        period - the date and hour range selected, or None
+
+    Returns:
+        dictionary of the trip duration statistics, reports and exceptions
+    """
+    if city in city_store and period is None:
+        partials = chunk_partials(df, 'Counting', partials = duration_partials)
+        sketch = city_store[city]['duration_sketch']
+    else:
+        partials = chunk_partials(df, 'Counting', partials = duration_partials, sketch = duration_sketch)
+        sketch = partials['sketch']
+
+    return duration_report(partials, sketch, month, day, sample_fraction(df), report_months(df),
+                           report_periods(df))
+
+def duration_report(partials, sketch, month, day, frac = 1.0, months = None, periods = None):
+    """
+    Calculates the statistics and reports for the trip duration reports (see
+    duration_tables) from the trip duration partial results.
+
+    Args:
+        partials - dictionary of 'bands', 'exceptions' and 'totals' created by
+                   duration_partials() (or merged by merge_partials())
+        sketch - trip duration sketch for the selected data
+        month - the month filter selected
+        day - the day filter selected
+        frac - the share of trips included in the data
+        months - the months reported (see report_months), or None for the months counted
+        periods - the years and months reported (see report_periods), or None for
+                  those counted
+
+    Returns:
+        dictionary of the trip duration statistics, reports and exceptions
+    """
+    bands = partials['bands']
+    exceptions = partials['exceptions']
+    totals = partials['totals']
+    mth_order = present_months(totals['Month']) if months is None else months
 
     # Define column and row values and order
-    mth_day_ord = [mth_order,day_order]
-    rows = pd.MultiIndex.from_product(mth_day_ord,names=['Month','Day'])
+    mth_keys, mth_rows, rows = month_rows(totals, mth_order, periods)
 
     # Are there execptions
-    ex_count = df[df['Var'] != 0]['Trip'].count()
+    ex_count = exceptions['Trip'].sum()
 
     # Summary of trip duartion exceptions by Variance Category and Month
-    duration_except = df[df['Var'] != 0].groupby(['Month','Var Cat'], as_index = False)['Trip'].count()
-    duration_except = duration_except.pivot(index = 'Month', columns = 'Var Cat', values = 'Trip')
-    duration_except = duration_except.reindex(index = mth_order, columns = categories)
+    duration_except = exceptions.groupby(mth_keys + ['Var Cat'], as_index = False)['Trip'].sum()
+    duration_except = duration_except.pivot(index = mth_keys, columns = 'Var Cat', values = 'Trip')
+    duration_except = duration_except.reindex(index = mth_rows, columns = variance_bands)
     duration_except = duration_except.fillna(0).astype(int)
 
     # Calculate key trip duration stats
-    tot_time = df['Trip Duration'].sum()
-    tot_time = datetime.timedelta(seconds = int(tot_time))
-    avg_time = df['Trip Duration'].mean()
+    tot_time = totals['Duration'].sum()
+    tot_time = datetime.timedelta(seconds = int(tot_time / frac))
+    avg_time = totals['Duration'].sum() / totals['Trip'].sum()
     avg_time = datetime.timedelta(seconds = int(avg_time))
-    med_time = df['Trip Duration'].median()
-    med_time = datetime.timedelta(seconds = int(med_time))
-    longest = df['Trip Duration'].max()
+    med_time, p90_time, p99_time = [datetime.timedelta(seconds = int(round(q or 0)))
+                                    for q in sketch_quantiles(sketch, month, day, [0.5, 0.9, 0.99])]
+    longest = totals['Longest'].max()
     longest = datetime.timedelta(seconds = int(longest))
-    shortest = df['Trip Duration'].min()
+    shortest = totals['Shortest'].min()
     shortest = datetime.timedelta(seconds = int(shortest))
 
     # Create trip duration reports
 
     # Total view
-    tot_report = df.groupby(['Trip Times'], as_index = False)['Trip'].count()
-    tot_report = tot_report.set_index('Trip Times').transpose().reindex(columns = values)
+    tot_report = bands.groupby(['Trip Times'], as_index = False)['Trip'].sum()
+    tot_report = tot_report.set_index('Trip Times').transpose().reindex(columns = duration_bands)
     tot_report = tot_report.fillna(0).astype(int)
 
     # Month view
-    mth_report = df.groupby(['Month','Trip Times'], as_index = False)['Trip'].count()
-    mth_report = mth_report.pivot(index = ['Month'], columns = ['Trip Times'], values = 'Trip')
-    mth_report = mth_report.reindex(index = mth_order, columns = values)
+    mth_report = bands.groupby(mth_keys + ['Trip Times'], as_index = False)['Trip'].sum()
+    mth_report = mth_report.pivot(index = mth_keys, columns = ['Trip Times'], values = 'Trip')
+    mth_report = mth_report.reindex(index = mth_rows, columns = duration_bands)
     mth_report = mth_report.fillna(0).astype(int)
 
     # Day view
-    day_report = df.groupby(['Day','Trip Times'], as_index = False)['Trip'].count()
+    day_report = bands.groupby(['Day','Trip Times'], as_index = False)['Trip'].sum()
     day_report = day_report.pivot(index = ['Day'], columns = ['Trip Times'], values = 'Trip')
-    day_report = day_report.reindex(index = day_order, columns = values)
+    day_report = day_report.reindex(index = day_order, columns = duration_bands)
     day_report = day_report.fillna(0).astype(int)
 
     # Combined month and day view
-    mth_day_report = df.groupby(['Month','Day','Trip Times'], as_index=False)['Trip'].count()
-    mth_day_report = mth_day_report.pivot(index = ['Month','Day'], columns = 'Trip Times', values = 'Trip')
-    mth_day_report = mth_day_report.reindex(index = rows, columns = values).fillna(0)
+    mth_day_report = bands.groupby(mth_keys + ['Day','Trip Times'], as_index=False)['Trip'].sum()
+    mth_day_report = mth_day_report.pivot(index = mth_keys + ['Day'], columns = 'Trip Times', values = 'Trip')
+    mth_day_report = mth_day_report.reindex(index = rows, columns = duration_bands).fillna(0)
     mth_day_report = mth_day_report.astype(int)
 
+    return {'ex_count': ex_count,
+            'duration_except': duration_except,
+            'tot_time': tot_time,
+            'avg_time': avg_time,
+            'med_time': med_time,
+            'p90_time': p90_time,
+            'p99_time': p99_time,
+            'longest': longest,
+            'shortest': shortest,
+            'tot_report': tot_report,
+            'mth_report': mth_report,
+            'day_report': day_report,
+            'mth_day_report': mth_day_report}
+
+def duration_summary(tables):
+    """
+    Prints the trip duration summary statistics: total, longest, shortest,
+    average, median and percentile trip durations.
+
+    Args:
+        tables - dictionary of tables created by duration_tables()
+    """
     # Print trip duration stats
     print('_'*72)
     print('\nTRIP DURATION SUMMARY STATISTICS\n')
-    print('Total combined time of all trips during the period (days and h:m:s): {}'.format(tot_time))
-    print('\nThe longest trip was (h:m:s:): {}'.format(longest))
-    print('The shortest trip was (h:m:s:): {}'.format(shortest))
-    print('\nAverage trip duration (h:m:s): {}'.format(avg_time))
-    print('Median trip duration (h:m:s): {}'.format(med_time))
-    input('Press Enter to continue to the Trip Duration Reports menu...')
+    print('Total combined time of all trips during the period (days and h:m:s): {}'.format(tables['tot_time']))
+    print('\nThe longest trip was (h:m:s:): {}'.format(tables['longest']))
+    print('The shortest trip was (h:m:s:): {}'.format(tables['shortest']))
+    print('\nAverage trip duration (h:m:s): {}'.format(tables['avg_time']))
+    print('Median trip duration (h:m:s): {}'.format(tables['med_time']))
+    print('90th percentile trip duration (h:m:s): {}'.format(tables['p90_time']))
+    print('99th percentile trip duration (h:m:s): {}'.format(tables['p99_time']))
+    print('(Median and percentiles are estimates, accurate to within {:.0%})'.format(SKETCH_ACCURACY))
+
+def trip_duration_stats(df, city, month, day, period = None):
+    """
+    Produces trip duration reports and statistics for the selected city.
+    The median and percentile trip durations are estimated from the trip duration
+    sketches built when the city data was loaded.
+
+    Args:
+        df - the DataFrame of of unfiltered data for the selected city
+        city - selected city
+        month - the month filter selected
+        day - the day filter selectd
+        period - the date and hour range selected, or None
+    """
+    start_time = time.time()
+    frac = sample_fraction(df)
+
+    tables = run_cancellable('Calculating the trip duration reports', duration_tables, df, city, month, day, period)
+
+    duration_summary(tables)
+    pause('Press Enter to continue to the Trip Duration Reports menu...')
 
     # Trip Duration Reporting Menu
 
@@ -690,496 +3121,1669 @@ def trip_duration_stats(df, month, day):
         print('The following reports are available:\n')
         print('    1. Bike Share Trips by Trip Duration')
         print('    2. Trip Duration Exceptions')
-        select = input('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
+        select = ask('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
         select = select.lower()
 
         while select not in ('1','2','q'):
-                select = input('That is not a valid option. Please try again: ')
+                select = ask('That is not a valid option. Please try again: ')
+                select = select.lower()
+
+        if select == '1':
+            trip_dur_report(month, day, tables['tot_report'], tables['mth_report'], tables['day_report'], tables['mth_day_report'], frac)
+
+        elif select == '2':
+            except_report(tables['duration_except'], tables['ex_count'], frac)
+
+        else:
+            break
+
+    time_spent = time.time() - start_time
+    time_spent = datetime.timedelta(seconds = int(time_spent))
+    print("\nThe Trip Duration Reporting review took {}.".format(time_spent))
+
+def user_cube(df, city):
+    """
+    Counts trips for every combination of the user dimensions (User Type, Gender,
+    Age Group, Year, Month and Day) in a single pass over the data.  All of the user
+    reports are then produced from the cube by summation.
+
+    Values outside the standard orders are excluded, as they are from the reports.
+    Where a city does not record Gender or Birth Year, all trips have the 'Unknown'
+    gender and 'N/A' age group of the common schema.
+
+    Args:
+        df - DataFrame with the Age Group column created by clean_trips()
+        city - selected city
+
+    Returns:
+        cube - dictionary with the trip 'counts' (one axis per dimension), the
+               dimension names ('dims'), the 'labels' of each dimension, the years
+               and months reported ('periods', see report_periods), the share of
+               trips included in the data ('frac') and whether the city records the
+               users' gender and age ('demographics')
+    """
+    years = sorted(int(year) for year in df['Year'].unique())
+    labels = {'User Type': user_type_order[city],
+              'Gender': gender_order,
+              'Age Group': age_order,
+              'Year': years,
+              'Month': report_months(df),
+              'Day': day_order}
+    dims = list(labels)
+    shape = [len(labels[dim]) for dim in dims]
+
+    # Counted CHUNK_ROWS trips at a time, so that the user can cancel the report
+    progress_stage('Counting', len(df))
+    counts = np.zeros(int(np.prod(shape)), dtype = np.int64)
+    for start in range(0, len(df), CHUNK_ROWS):
+        chunk = df.iloc[start:start + CHUNK_ROWS]
+        codes = [pd.Categorical(chunk[dim], categories = labels[dim]).codes.astype(np.int64) for dim in dims]
+
+        valid = np.logical_and.reduce([c >= 0 for c in codes])
+        cells = np.ravel_multi_index([c[valid] for c in codes], shape)
+        counts += np.bincount(cells, minlength = len(counts))
+        progress_step(len(chunk))
+    counts = counts.reshape(shape)
+
+    return {'counts': counts, 'dims': dims, 'labels': labels,
+            'periods': [(year, month) for year, month in report_periods(df) if year in years],
+            'frac': sample_fraction(df),
+            'demographics': recorded(df, 'Gender') and recorded(df, 'Birth Year')}
+
+def cube_table(cube, rows, col = None):
+    """
+    Sums the user cube into a table of trip counts.  Where the trips counted cover
+    more than one year, each year's months are reported separately (as in the usage
+    reports, see month_rows): the Year is added to the index before the Month, or
+    after the other rows where the Month is the table columns.
+
+    Args:
+        cube - the user cube created by user_cube()
+        rows - the dimension(s) used as the table index
+        col - the dimension used as the table columns (None for a single 'Trips' column)
+
+    Returns:
+        table - DataFrame of trip counts
+    """
+    dims = cube['dims']
+    labels = cube['labels']
+    years = len(labels['Year']) > 1
+    if years and 'Month' in rows:
+        rows = rows[:rows.index('Month')] + ['Year'] + rows[rows.index('Month'):]
+    elif years and col == 'Month':
+        rows = rows + ['Year']
+    keep = rows + ([col] if col else [])
+
+    counts = cube['counts'].sum(axis = tuple(i for i, dim in enumerate(dims) if dim not in keep))
+    counts = np.transpose(counts, [[dim for dim in dims if dim in keep].index(dim) for dim in keep])
+    counts = counts.reshape(int(np.prod([len(labels[dim]) for dim in rows])), -1)
+
+    if len(rows) == 1:
+        index = pd.Index(labels[rows[0]], name = rows[0])
+    else:
+        index = pd.MultiIndex.from_product([labels[dim] for dim in rows], names = rows)
+
+    if col:
+        columns = pd.Index(labels[col], name = col)
+    else:
+        columns = ['Trips']
+
+    table = pd.DataFrame(counts, index = index, columns = columns)
+
+    # Only the months reported for each year are listed
+    if years and 'Month' in rows:
+        periods = set(cube['periods'])
+        table = table[[period in periods for period in
+                       zip(index.get_level_values('Year'), index.get_level_values('Month'))]]
+
+    return table
+
+def run_report(cube, rows, col):
+    """
+    Generates and displays the report based on the parameters provided
+
+    Args:
+        cube - the user cube created by user_cube()
+        rows - dimension(s) used as the index of the report
+        col - dimension used as the columns of the report
+    """
+    # Generate report
+    report_detail = cube_table(cube, rows, col)
+
+    print()
+    print('_'*72)
+    print('\nBIKE SHARE USER REPORTS\n')
+    print('User Activity Report')
+    show_counts(report_detail, cube['frac'])
+    pause('Press Enter to return to the Bike Share User Reports menu...')
+
+
+def user_report_menu(cube, city, month, day):
+    """
+    Allows the user to select from a range of reporting options subject to their data
+    selection criteria.
+
+    Args:
+        cube - the user cube created by user_cube()
+        city - selected city
+        month - selected month
+        day - selected day
+
+    Calls:
+        run_report() - to generate the relevant report
+    """
+    # Define the rows and columns of each report
+    a = (['User Type'], 'Month')
+    b = (['User Type'], 'Day')
+    c = (['User Type','Month'], 'Day')
+
+    d = (['User Type'], 'Age Group')
+    e = (['User Type','Gender'], 'Age Group')
+    f = (['User Type','Month'], 'Age Group')
+    g = (['User Type','Day'], 'Age Group')
+    h = (['Gender'], 'Age Group')
+    i = (['Gender','User Type'], 'Age Group')
+    j = (['Gender','Month'], 'Age Group')
+    k = (['Gender','Day'], 'Age Group')
+
+    if not cube['demographics']:
+        reports = {'1': a, '2': b, '3': c}
+        while True:
+            print('_'*72)
+            print('\nBIKE SHARE USER REPORTS\n')
+            print('The following User Type activity reports are available:')
+            print('   1. User Type by Month')
+            print('   2. User Type by Day')
+            print('   3. User Type by Month and Day')
+            select = ask('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
+            select = select.lower()
+
+            while select not in ('1','2','3','q'):
+                select = ask('That is not a valid option. Please try again: ')
+                select = select.lower()
+
+            if select in reports:
+                run_report(cube, *reports[select])
+            else:
+                break
+
+    else:
+        reports = {'1': d, '2': e, '3': f, '4': g, '5': h, '6': i, '7': j, '8': k}
+        while True:
+            print('_'*72)
+            print('\nBIKE SHARE USER REPORTS\n')
+            print('There are a range of reporting options available. You have a choice of the following reports:')
+            print('\nReports by User Type:')
+            print('    1. User Type by Age Group')
+            print('    2. User Type by Gender by Age Group')
+            print('    3. User Type by Month by Age Group')
+            print('    4. User Type by Day by Age Group')
+            print('\nReports by Gender:')
+            print('    5. Gender by Age Group')
+            print('    6. Gender by User Type by Age Group')
+            print('    7. Gender by Month by Age Group')
+            print('    8. Gender by Day by Age Group')
+
+            select = ask('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
+            select = select.lower()
+
+            while select not in ('1','2','3','4','5','6','7','8','q'):
+                select = ask('That is not a valid option. Please try again: ')
                 select = select.lower()
 
+            if select in reports:
+                run_report(cube, *reports[select])
+            else:
+                break
+
+def user_tables(df, city):
+    """
+    Calculates the statistics and user cube for the user reports.  The statistics
+    by gender and age are only calculated where the city records them.  The
+    DataFrame provided is not modified.
+
+    Args:
+        df - the DataFrame of selected data
+        city - selected city
+
+    Returns:
+        dictionary of the user statistics and summary tables, and the user cube
+    """
+    # The Age and Age Group of the users are calculated at load (see clean_trips)
+    df = df[['Start Time','Year','Month','Day','Trip','User Type','Gender','Birth Year','Age','Age Group']]
+
+    # Count trips by all user dimensions once, for the summary and the report menu
+    cube = user_cube(df, city)
+
+    # Calculate user stats, by gender and age where the city records them
+    if not cube['demographics']:
+        user_type_count = cube_table(cube, ['User Type'])
+
+    else:
+        genders = cube_table(cube, ['Gender'])['Trips']
+        male = genders['Male']
+        female = genders['Female']
+        unknown = genders['Unknown']
+        user_type_summ = cube_table(cube, ['User Type'], 'Gender')
+        user_type_summ['Total'] = user_type_summ['Female']+user_type_summ['Male']+user_type_summ['Unknown']
+        birth_yr_max = df['Birth Year'].max()
+        birth_yr_min = df[df['Birth Year'] != 0]['Birth Year'].min()
+        age_max = df['Age'].max()
+
+        if age_max > 90:
+            over_90 = df[df['Age'] > 90]
+            over_90_count = len(over_90)
+            over_90 = over_90.groupby(['Birth Year','Age'], as_index = False)['Trip'].count()
+            over_90 = over_90.set_index('Birth Year').rename(columns = {'Trip':'Trips'})
+        else:
+            over_90 = None
+            over_90_count = 0
+
+    if not cube['demographics']:
+        return {'cube': cube,
+                'user_type_count': user_type_count}
+
+    return {'cube': cube,
+            'male': male,
+            'female': female,
+            'unknown': unknown,
+            'user_type_summ': user_type_summ,
+            'birth_yr_min': birth_yr_min,
+            'birth_yr_max': birth_yr_max,
+            'age_max': age_max,
+            'over_90': over_90,
+            'over_90_count': over_90_count}
+
+def user_stats(df, city, month, day):
+    """
+    Produces bike share user reports and statistics for the selected city.
+    Additional reporting is provided for cities where user gender and age data
+    is available.  Where age data is available, users are grouped into age bands.
+
+    Args:
+        df - the DataFrame of of unfiltered data for the selected city
+        city - selected city
+        month - selected month
+        day - selected day
+    """
+    start_time = time.time()
+    frac = sample_fraction(df)
+
+    tables = run_cancellable('Calculating the user reports', user_tables, df, city)
+    cube = tables['cube']
+    if not cube['demographics']:
+        user_type_count = tables['user_type_count']
+    else:
+        male = tables['male']
+        female = tables['female']
+        unknown = tables['unknown']
+        user_type_summ = tables['user_type_summ']
+        birth_yr_min = tables['birth_yr_min']
+        birth_yr_max = tables['birth_yr_max']
+        age_max = tables['age_max']
+        over_90 = tables['over_90']
+        over_90_count = tables['over_90_count']
+
+    # Print summary user statistics
+    print('_'*72)
+    print('\nBIKE SHARE USER SUMMARY STATISTICS\n')
+
+    if not cube['demographics']:
+        print('Summary of trips by User Type')
+        show_counts(user_type_count, frac)
+        if (month != 'All') & (day != 'All'):
+            pause('There are no more user reports available for the data selected. Press Enter to continue...')
+        else:
+            pause('Press Enter to continue to the Bike Share User Reports menu...')
+            user_report_menu(cube, city, month, day)
+    else:
+        print('Summary of trips by User Type and Gender')
+        show_counts(user_type_summ, frac)
+        print('\nThe number of male users was {}'.format(scale_count(male,frac)))
+        print('The number of female users was {}'.format(scale_count(female,frac)))
+        print('The number of users where the gender is unknown was {}'.format(scale_count(unknown,frac)))
+        print('\nThe earliest Birth Year was {}.'.format(birth_yr_min))
+        print('The latest Birth Year was {}.'.format(birth_yr_max))
+
+        if age_max > 90:
+            print('\nThere were {} trips by users > 90 years old'.format(scale_count(over_90_count,frac)))
+            older = ask('Would you like to see a breakdown by Age of trips by users > 90 years old? (Y/N): ')
+            older = older.lower()
+
+            while older not in ['y','n']:
+                older = ask('That is not a valid option.  Please enter either \'Y\' or \'N\':')
+                older = older.lower()
+
+            if older == 'y':
+                print('\nSummary of trips by users > 90 years old')
+                show_counts(over_90, frac, cols = ['Trips'])
+                pause('Press Enter to continue to the Bike Share User Reports menu...')
+
+        user_report_menu(cube, city, month, day)
+
+    time_spent = time.time() - start_time
+    time_spent = datetime.timedelta(seconds = int(time_spent))
+    print("\nThe User Reporting review took {}.".format(time_spent))
+
+def trend_tables(series, start = None, end = None):
+    """
+    Reads the daily, weekly and hourly trip reports for a range of dates from a trip
+    series, without rescanning the trips.  The rolling averages and week-over-week
+    changes for the first days of the range include the days before it.  Where the
+    series counts a sample of trips, averages and changes are scaled up to estimates.
+
+    Args:
+        series - the trip series created by update_series()
+        start - the first date of the range, or None to start at the first date
+        end - the end date of the range (exclusive), or None to end at the last date
+
+    Returns:
+        dictionary of the 'daily', 'weekly' and 'hourly' reports
+    """
+    daily = series['daily']
+    first = series['first'].astype(np.int64)
+    frac = series['frac']
+    a = 0 if start is None else int(np.clip(np.datetime64(start, 'D').astype(np.int64) - first, 0, len(daily)))
+    b = len(daily) if end is None else int(np.clip(np.datetime64(end, 'D').astype(np.int64) - first, a, len(daily)))
+    days = np.arange(a, b)
+
+    # Daily trips, with rolling averages read from the cumulative counts
+    dates = pd.DatetimeIndex(series['first'] + days, name = 'Date')
+    daily_report = pd.DataFrame({'Day': [day_order[d] for d in (first + days + 3) % 7],
+                                 'Trips': daily[a:b]}, index = dates)
+    cum_counts = np.concatenate([[0], np.cumsum(daily)])
+    for n in (7, 28):
+        average = (cum_counts[days + 1] - cum_counts[np.maximum(days + 1 - n, 0)]) / n / frac
+        daily_report['{}-Day Avg'.format(n)] = np.where(days + 1 >= n, average.round(1), np.nan)
+    prior = np.where(days >= 7, daily[np.maximum(days - 7, 0)], np.nan)
+    daily_report['WoW Change'] = ((daily[a:b] - prior) / frac).round()
+    daily_report['WoW %'] = ((daily[a:b] / np.where(prior > 0, prior, np.nan) - 1) * 100).round(1)
+
+    # Weekly trips (weeks starting on a Monday) for every week in the range
+    weeks = (first + np.arange(len(daily)) + 3) // 7
+    weekly = np.bincount(weeks - weeks[0], weights = daily).astype(np.int64)
+    week_days = np.bincount(weeks - weeks[0])
+    selected = np.arange(weeks[a] - weeks[0], weeks[b - 1] - weeks[0] + 1) if b > a else np.arange(0)
+    week_starts = np.array((weeks[0] + selected) * 7 - 3, dtype = 'datetime64[D]')
+    weekly_report = pd.DataFrame({'Days': week_days[selected], 'Trips': weekly[selected]},
+                                 index = pd.DatetimeIndex(week_starts, name = 'Week Starting'))
+    # Part weeks at either end of the data are not compared
+    full = (week_days == 7)
+    previous = np.where((selected > 0) & full[selected] & full[np.maximum(selected - 1, 0)],
+                        weekly[np.maximum(selected - 1, 0)], np.nan)
+    weekly_report['WoW Change'] = ((weekly[selected] - previous) / frac).round()
+    weekly_report['WoW %'] = ((weekly[selected] / np.where(previous > 0, previous, np.nan) - 1) * 100).round(1)
+
+    # Trips by hour of the day over the range
+    hourly = series['hourly'][a:b].sum(axis = 0)
+    hourly_report = pd.DataFrame({'Trips': hourly,
+                                  'Avg per Day': (hourly / max(b - a, 1) / frac).round(1)},
+                                 index = pd.Index(['{:02d}'.format(h) for h in range(24)], name = 'Hour'))
+
+    return {'daily': daily_report, 'weekly': weekly_report, 'hourly': hourly_report}
+
+def year_tables(counts):
+    """
+    Compares the trips in each year by month, hour band and trip duration band, from
+    the year counts calculated at load (see year_counts), without rescanning the
+    trips.  Each year after the first is compared with the year before it.  So that
+    years with trips in only some months are compared like for like, the hour band
+    and trip duration reports only count the months with trips in every year (or all
+    months, if there are none).
+
+    Args:
+        counts - the year counts created by year_counts()
+
+    Returns:
+        dictionary of the 'month', 'hour' and 'duration' reports, with the trips for
+        each year and the percentage change on the previous year, and the 'months'
+        counted by the hour band and trip duration reports
+    """
+    years = year_list(counts)
+    trips = counts['trips'][[year - counts['first'] for year in years]]
+    labels = [str(year) for year in years]
+
+    months = [month_names.index(month) for month in year_months(counts)]
+    by_month = trips.sum(axis = (2, 3))
+    common = [m for m in months if by_month[:, m].all()] or months
+
+    # Hours of the day grouped into the hour bands of the usage reports (9pm-1am last)
+    hour_bands = ((np.arange(24) - 1) % 24) // 4
+    selected = trips[:, common]
+    by_band = np.stack([selected[:, :, hour_bands == band].sum(axis = (1, 2, 3)) for band in range(len(time_order))], axis = 1)
+
+    reports = {'month': pd.DataFrame(by_month[:, months].T, columns = labels,
+                                     index = pd.Index([month_names[m] for m in months], name = 'Month')),
+               'hour': pd.DataFrame(by_band.T, columns = labels, index = pd.Index(time_order, name = 'Hour Band')),
+               'duration': pd.DataFrame(selected.sum(axis = (1, 2)).T, columns = labels,
+                                        index = pd.Index(duration_bands, name = 'Trip Times'))}
+
+    for report in reports.values():
+        for previous, year in zip(labels, labels[1:]):
+            prior = report[previous].to_numpy()
+            report['{} vs {} %'.format(year, previous)] = ((report[year] / np.where(prior > 0, prior, np.nan) - 1) * 100).round(1)
+        report.columns.name = 'Year'
+
+    reports['months'] = [month_names[m] for m in common]
+
+    return reports
+
+def year_summary(tables, frac = 1.0):
+    """
+    Prints the year-over-year reports (see year_tables).
+
+    Args:
+        tables - dictionary of the reports created by year_tables()
+        frac - share of trips included in the data, to scale the trip counts
+    """
+    years = [col for col in tables['month'].columns if '%' not in col]
+    print('_'*72)
+    print('\nYEAR-OVER-YEAR COMPARISON')
+    if len(years) < 2:
+        print('\nThe data only covers {}, so there is no previous year to compare with.'.format(', '.join(years)))
+    print('\nTrips by month, and change on the same month of the previous year')
+    show_counts(tables['month'], frac, cols = years)
+    if len(tables['months']) < len(tables['month']):
+        print('\nThe following reports count the months with trips in every year ({}).'.format(', '.join(tables['months'])))
+    print('\nTrips by hour band, and change on the previous year')
+    show_counts(tables['hour'], frac, cols = years)
+    print('\nTrips by trip duration, and change on the previous year')
+    show_counts(tables['duration'], frac, cols = years)
+
+def trend_stats(df, city, period = None):
+    """
+    Produces the trip trend reports for the selected city from the daily and hourly
+    trip counts calculated at load.  Any range of dates can be reported without
+    rescanning the trips.  The trends cover all trips on the dates selected, so the
+    month and day filters do not apply.  The years are compared from the year counts
+    calculated at load (see year_tables), and cover all trips.
+
+    Args:
+        df - the DataFrame of selected data
+        city - selected city
+        period - the selected date and hour range (its dates are the default range), or
+                 None
+    """
+    start_time = time.time()
+    series = city_store[city]['series']
+    frac = series['frac']
+    start = None if period is None else period['start']
+    end = None if period is None else period['end']
+
+    while True:
+        tables = trend_tables(series, start, end)
+        dates = tables['daily'].index
+        print('_'*72)
+        print('\nTRIP TRENDS\n')
+        if len(dates):
+            print('Trends for all trips from {} to {} ({} days).'.format(dates[0].date(), dates[-1].date(), len(dates)))
+        else:
+            print('There are no trips in the dates selected.')
+        print('\nThe following reports are available:')
+        print('    1. Daily trips, with 7 and 28 day averages and week-over-week change')
+        print('    2. Weekly trips, with week-over-week change')
+        print('    3. Trips by hour of the day')
+        print('    4. Change the range of dates')
+        print('    5. Year-over-year trips by month, hour band and trip duration')
+        select = ask('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
+        select = select.lower()
+
+        while select not in ('1','2','3','4','5','q'):
+            select = ask('That is not a valid option. Please try again: ')
+            select = select.lower()
+
         if select == '1':
-            trip_dur_report(month, day, tot_report, mth_report, day_report, mth_day_report)
+            page_data(tables['daily'], '\nDAILY TRIPS - 7 and 28 day averages and change on the same day of the previous week\n',
+                      page_size = 28,
+                      show = lambda page: show_counts(page, frac, cols = ['Trips']))
 
         elif select == '2':
-            except_report(duration_except, ex_count)
+            print('_'*72)
+            print('\nWeekly trips (weeks starting on Monday), and change on the previous week')
+            show_counts(tables['weekly'], frac, cols = ['Trips'])
+            pause('Press Enter to return to the Trip Trends menu...')
+
+        elif select == '3':
+            print('_'*72)
+            print('\nTrips by hour of the day')
+            show_counts(tables['hourly'], frac, cols = ['Trips'])
+            pause('Press Enter to return to the Trip Trends menu...')
+
+        elif select == '4':
+            dates = parse_period(ask('\nPlease enter the range of dates (e.g. 2017-03-01 to 2017-03-31), or press Enter for all dates: '))
+
+            while dates is None:
+                dates = parse_period(ask('Sorry, I don\'t recognise that range. Please try again, or press Enter for all dates: '))
+
+            start = dates['start']
+            end = dates['end']
+
+        elif select == '5':
+            year_summary(year_tables(city_store[city]['year_counts']), frac)
+            pause('Press Enter to return to the Trip Trends menu...')
 
         else:
             break
 
-    # Remove any columns created specifically for trip duration stats
-    df = df.drop(['Trip Times','Date Diff','Seconds','Var','Var Cat'], axis = 1, inplace = True)
-
     time_spent = time.time() - start_time
     time_spent = datetime.timedelta(seconds = int(time_spent))
-    print("\nThe Trip Duration Reporting review took {}.".format(time_spent))
+    print("\nThe Trip Trends review took {}.".format(time_spent))
 
-def run_report(df, group, idx, col, idx_ord, col_ord):
+def partition_ranges(city, partitions):
     """
-    Generates and displays the report based on the parameters provided
+    Splits a city's data file into byte ranges of about the same size, each starting
+    at the beginning of a line, so that the ranges can be parsed separately.
+    Compressed files cannot be split, so are read as a single range.
 
     Args:
-        df - dataframe
-        group - columns used in the groupby() function
-        idx - dataframe column(s) specified as the index in the pivot
-        col - dataframe column specified as the index in the pivot
-        idx_ord - index order required for re-indexing the pivot
-        col_ord - column order required for re-indexing the pivot
-    """
-    # Generate report
-    report_detail = df.groupby(group, as_index = False)['Trip'].count()
-    report_detail = report_detail.pivot(index = idx, columns = col, values = 'Trip')
-    report_detail = report_detail.reindex(index = idx_ord, columns = col_ord)
-    report_detail = report_detail.fillna(0).astype(int)
+        (str) city - name of the city
+        (int) partitions - the number of ranges required
 
-    print()
-    print('_'*72)
-    print('\nBIKE SHARE USER REPORTS\n')
-    print('User Activity Report')
-    print(report_detail)
-    input('Press Enter to return to the Bike Share User Reports menu...')
+    Returns:
+        list of (start, stop) byte offsets, excluding the header row
+        (or [(None, None)] for the whole of a compressed file)
+    """
+    path = data_file(city)
+    if path != CITY_DATA[city]:
+        return [(None, None)]
+
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.readline()
+        bounds = [f.tell()]
+        for i in range(1, partitions):
+            # Move to the start of the next line after the split point
+            f.seek(max(size * i // partitions, bounds[0]) - 1)
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    bounds = sorted(set(bounds))
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def partition_partials(city, start, stop, period = None):
+    """
+    Parses a byte range of a city's data file (see partition_ranges) and calculates
+    the partial results for the city summary, usage, station and trip duration
+    reports.  Runs in a worker process for partitioned_tables().
 
+    Args:
+        (str) city - name of the city
+        start, stop - byte offsets of the range in the data file (None for the whole
+                      file)
+        period - the date and hour range selected (see parse_period), or None
 
-def user_report_menu(df, city, month, day):
+    Returns:
+        dictionary of the partial results (see merge_partials)
     """
-    Allows the user to select from a range of reporting options subject to their data
-    selection criteria.
+    if start is None:
+        df = read_trips(city)
+    else:
+        import io
+        with open(data_file(city), 'rb') as f:
+            header = f.readline()
+            f.seek(start)
+            df = read_trips(city, source = io.BytesIO(header + f.read(stop - start)))
+
+    df, recorded = conform_trips(df)
+    df, quarantine = clean_trips(df)
+    df, stations = enrich_trips(df)
+
+    # The city summary covers all trips, the reports the trips within the period
+    partials = {'summary': trip_counts(df), 'years': year_counts(df)}
+    if period is not None:
+        df = load_filters(df, 'All', 'All', period)
+    partials['trips'] = partials['summary'] if period is None else trip_counts(df)
+    partials['routes'] = route_counts(df)
+    partials['sketch'] = duration_sketch(df)
+    partials.update(duration_partials(df))
+
+    return partials
+
+def merge_partials(partials):
+    """
+    Merges the partial results calculated for separate parts of the data.  Counts and
+    totals are added together, and the earliest, longest and shortest values kept
+    (see PARTIAL_MERGE).  Trip duration sketches are merged with merge_sketches(),
+    and year counts with merge_year_counts().
 
     Args:
-        df - DataFrame
-        city - selected city
-        month - selected month
-        day - selected day
+        partials - list of dictionaries of partial results (see partition_partials)
 
-    Calls:
-        run_report() - to generate the relevant report
+    Returns:
+        dictionary of the partial results for all of the data
     """
-    # Define different group by options
-    a = ['User Type','Month']
-    b = ['User Type','Day']
-    c = ['User Type','Month','Day']
-
-    d = ['User Type','Age Group']
-    e = ['User Type','Gender','Age Group']
-    f = ['User Type','Month','Age Group']
-    g = ['User Type','Day','Age Group']
-    h = ['Gender','Age Group']
-    i = ['Gender','User Type','Age Group']
-    j = ['Gender','Month','Age Group']
-    k = ['Gender','Day','Age Group']
-
-    # Define standard index and column orders
-    gender = ['Female','Male','Unknown']
-    age_groups = ['N/A','<18','18-29','30\'s','40\'s','50\'s','60\'s','70+']
-
-    index_a = ['User Type']
-    index_b = ['User Type']
-    index_c = ['User Type','Month']
-    index_d = ['User Type']
-    index_e = ['User Type','Gender']
-    index_f = ['User Type','Month']
-    index_g = ['User Type','Day']
-    index_h = ['Gender']
-    index_i = ['Gender','User Type']
-    index_j = ['Gender','Month']
-    index_k = ['Gender','Day']
-
-    # Define columns used in the pivot tables
-    col_w1 = ['Month']
-    col_w23 = ['Day']
-    col_other = ['Age Group']
-
-    # Define User Types by city
-    if city == 'chicago':
-        ut_order = ['Customer','Dependent','Subscriber']
-    elif city == 'new york city':
-        ut_order = ['Customer','Subscriber','Unknown']
-    else:
-        ut_order = ['Customer','Subscriber']
-
-    # Define indices for MultiIndex DataFrames
-    idx_a = ut_order
-    idx_b = ut_order
-    idx_c = [ut_order,mth_order]
-    idx_d = ut_order
-    idx_e = [ut_order,gender]
-    idx_f = [ut_order,mth_order]
-    idx_g = [ut_order,day_order]
-    idx_h = gender
-    idx_i = [gender,ut_order]
-    idx_j = [gender,mth_order]
-    idx_k = [gender,day_order]
-
-    # Define row indices
-    rows_c = pd.MultiIndex.from_product(idx_c, names = index_c)
-    rows_e = pd.MultiIndex.from_product(idx_e, names = index_e)
-    rows_f = pd.MultiIndex.from_product(idx_f, names = index_f)
-    rows_g = pd.MultiIndex.from_product(idx_g, names = index_g)
-    rows_i = pd.MultiIndex.from_product(idx_i, names = index_i)
-    rows_j = pd.MultiIndex.from_product(idx_j, names = index_j)
-    rows_k = pd.MultiIndex.from_product(idx_k, names = index_k)
-
-    if city == 'washington':
-        while True:
-            print('_'*72)
-            print('\nBIKE SHARE USER REPORTS\n')
-            print('The following User Type activity reports are available:')
-            print('   1. User Type by Month')
-            print('   2. User Type by Day')
-            print('   3. User Type by Month and Day')
-            select = input('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
-            select = select.lower()
+    merged = {}
+    for name in partials[0]:
+        parts = [part[name] for part in partials]
+        if name == 'sketch':
+            merged[name] = merge_sketches(*parts)
+            continue
+        if name == 'years':
+            merged[name] = merge_year_counts(*parts)
+            continue
+
+        frame = pd.concat(parts, ignore_index = True)
+        values = {col: PARTIAL_MERGE[col] for col in frame.columns if col in PARTIAL_MERGE}
+        keys = [col for col in frame.columns if col not in values]
+        merged[name] = frame.groupby(keys, as_index = False, sort = False).agg(values)
+
+    return merged
+
+def chunk_partials(df, stage, **builders):
+    """
+    Calculates partial results (e.g. trip_counts) for the selected data CHUNK_ROWS
+    trips at a time, and merges them (see merge_partials), so that the progress of a
+    report can be shown and the report stopped if the user cancels it.
 
-            while select not in ('1','2','3','q'):
-                select = input('That is not a valid option. Please try again: ')
-                select = select.lower()
+    Args:
+        df - the DataFrame of selected data
+        (str) stage - description of the stage shown with the progress
+        builders - the function calculating each partial result, by name (functions
+                   returning a dictionary of partial results, e.g. duration_partials,
+                   add each of them by its own name)
 
-            if select == '1':
-                group = a
-                idx = index_a
-                col = col_w1
-                idx_ord = idx_a
-                col_ord = mth_order
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            elif select == '2':
-                group = b
-                idx = index_b
-                col = col_w23
-                idx_ord = idx_b
-                col_ord = day_order
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            elif select == '3':
-                group = c
-                idx = index_c
-                col = col_w23
-                idx_ord = rows_c
-                col_ord = day_order
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            else:
-                break
+    Returns:
+        dictionary of the partial results for all of the selected data
+    """
+    progress_stage(stage, len(df))
+    partials = []
+    for start in range(0, max(len(df), 1), CHUNK_ROWS):
+        chunk = df.iloc[start:start + CHUNK_ROWS]
+        part = {}
+        for name, build in builders.items():
+            result = build(chunk)
+            part.update(result if isinstance(result, dict) else {name: result})
+        partials.append(part)
+        progress_step(len(chunk))
+
+    return partials[0] if len(partials) == 1 else merge_partials(partials)
+
+def partitioned_tables(city, month = 'All', day = 'All', period = None, workers = None):
+    """
+    Calculates the tables for the city summary, usage, station and trip duration
+    reports by map-reduce, without loading the city's data into this process.  The
+    data file is split into byte ranges (see partition_ranges), which worker
+    processes parse and reduce to partial results in parallel.  The partial results
+    are merged and the month and day filters applied to them, and the report tables
+    are then produced exactly as for data loaded by load_data().
+
+    Args:
+        (str) city - name of the city
+        month - the month filter selected
+        day - the day filter selected
+        period - the date and hour range selected (see parse_period), or None
+        workers - the number of worker processes (default: one for each CPU)
 
+    Returns:
+        dictionary of the 'summary', 'usage', 'station', 'duration' and 'years' tables
+        (see city_summary, usage_tables, station_tables, duration_tables and
+        year_tables).  The usage, station and duration tables are None if no trips
+        match the filters
+    """
+    import concurrent.futures
+    start_time = time.time()
+    numeric_stack()
+
+    workers = workers or os.cpu_count()
+    entry = read_catalog(city)
+    progress_stage('Reading', None if entry is None else entry['rows'])
+
+    # More ranges than workers, to balance the work and show the progress made
+    ranges = partition_ranges(city, workers * 4)
+    parts = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers = min(workers, len(ranges))) as pool:
+        try:
+            for part in pool.map(partition_partials, [city] * len(ranges),
+                                 [start for start, stop in ranges], [stop for start, stop in ranges],
+                                 [period] * len(ranges)):
+                parts.append(part)
+                progress_step(int(part['summary']['Trip'].sum()))
+        except Cancelled:
+            pool.shutdown(cancel_futures = True)
+            raise
+    partials = merge_partials(parts)
+    months = present_months(partials['summary']['Month'])
+    periods = present_periods(partials['summary'])
+
+    # Apply the month and day filters to the partial results
+    for name in ('trips','routes','bands','exceptions','totals'):
+        frame = partials[name]
+        if month != 'All':
+            frame = frame[frame['Month'] == month]
+        if day != 'All':
+            frame = frame[frame['Day'] == day]
+        partials[name] = frame
+
+    tables = {'summary': summary_table(partials['summary'], months),
+              'years': year_tables(partials['years'])}
+
+    # The usage, station and duration reports describe the trips selected, so need at least one
+    if partials['trips']['Trip'].sum() > 0:
+        tables.update(usage = usage_report(partials['trips'], months, periods),
+                      station = station_report(partials['routes']),
+                      duration = duration_report(partials, partials['sketch'], month, day, months = months,
+                                                 periods = periods))
     else:
-        while True:
-            print('_'*72)
-            print('\nBIKE SHARE USER REPORTS\n')
-            print('There are a range of reporting options available. You have a choice of the following reports:')
-            print('\nReports by User Type:')
-            print('    1. User Type by Age Group')
-            print('    2. User Type by Gender by Age Group')
-            print('    3. User Type by Month by Age Group')
-            print('    4. User Type by Day by Age Group')
-            print('\nReports by Gender:')
-            print('    5. Gender by Age Group')
-            print('    6. Gender by User Type by Age Group')
-            print('    7. Gender by Month by Age Group')
-            print('    8. Gender by Day by Age Group')
+        tables.update(usage = None, station = None, duration = None)
 
-            select = input('Please enter the number of the report you would like to view, or enter \'Q\' to quit: ')
-            select = select.lower()
+    print("Processing time: %.2f seconds." % (time.time() - start_time))
 
-            while select not in ('1','2','3','4','5','6','7','8','q'):
-                select = input('That is not a valid option. Please try again: ')
-                select = select.lower()
+    return tables
 
-            if select == '1':
-                group = d
-                idx = index_d
-                col = col_other
-                idx_ord = idx_d
-                col_ord = age_groups
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            elif select == '2':
-                group = e
-                idx = index_e
-                col = col_other
-                idx_ord = rows_e
-                col_ord = age_groups
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            elif select == '3':
-                group = f
-                idx = index_f
-                col = col_other
-                idx_ord = rows_f
-                col_ord = age_groups
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            elif select == '4':
-                group = g
-                idx = index_g
-                col = col_other
-                idx_ord = rows_g
-                col_ord = age_groups
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            elif select == '5':
-                group = h
-                idx = index_h
-                col = col_other
-                idx_ord = idx_h
-                col_ord = age_groups
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            elif select == '6':
-                group = i
-                idx = index_i
-                col = col_other
-                idx_ord = rows_i
-                col_ord = age_groups
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            elif select == '7':
-                group = j
-                idx = index_j
-                col = col_other
-                idx_ord = rows_j
-                col_ord = age_groups
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            elif select == '8':
-                group = k
-                idx = index_k
-                col = col_other
-                idx_ord = rows_k
-                col_ord = age_groups
-                run_report(df, group, idx, col, idx_ord, col_ord)
-            else:
-                break
+def city_report(city, month = 'All', day = 'All', period = None, workers = None):
+    """
+    Prints the city summary, usage, station and trip duration summary statistics
+    for a city without interaction, from tables calculated by partitioned_tables().
+    Where the data covers more than one year, the years are also compared.
 
-def user_stats(df, city, month, day):
+    Args:
+        (str) city - name of the city
+        month - the month filter selected
+        day - the day filter selected
+        period - the date and hour range selected (see parse_period), or None
+        workers - the number of worker processes (default: one for each CPU)
     """
-    Cleans the bike share user data where required.
+    print('\nRetrieving data ...\n')
+    try:
+        tables = run_cancellable('Calculating the reports', partitioned_tables, city, month, day, period, workers)
+    except Cancelled:
+        print('\nThe reports were cancelled.')
+        return
+
+    print('\nBelow is a summary of trip volumes by month and day for {}'.format(city.title()))
+    print()
+    show_counts(tables['summary'])
+    if tables['usage'] is None:
+        print('\nNo trips match the filters selected.')
+    else:
+        usage_summary(tables['usage'], month, day)
+        station_summary(tables['station'])
+        duration_summary(tables['duration'])
+    if len(tables['years']['month'].columns) > 1:
+        year_summary(tables['years'])
 
-    Produces bike share user reports and statistics for the selected city.
-    Additional reporting is provided for cities where user gender and age data
-    is available.  Where age data is available, users are grouped into age bands.
+def compare_tables(df, city):
+    """
+    Calculates the usage, trip duration and station summary for a city, used to
+    compare the cities side by side.  The figures are taken from the common schema
+    applied at load, so the same calculation serves every city.
 
     Args:
-        df - the DataFrame of of unfiltered data for the selected city
-        city - selected city
-        month - selected month
-        day - selected day
+        df - the DataFrame of selected data
+        city - the city the data is for
+
+    Returns:
+        dictionary of the summary figures
     """
-    start_time = time.time()
+    summary = {'Trips': len(df),
+               'Stations': len(np.union1d(df['Start Code'], df['End Code']))}
 
-    # Create Year column based on Start Time
-    df.insert(1,'Year', df['Start Time'].dt.year)
-
-    # Clean Data
-    if city == 'new york city':
-        df[['User Type']] = df[['User Type']].fillna('Unknown')
-        df[['Gender']] = df[['Gender']].fillna('Unknown')
-        df[['Birth Year']] = df[['Birth Year']].fillna(0.0)
-        df['Birth Year'] = df['Birth Year'].astype(int)
-    elif city == 'chicago':
-        df[['Gender']] = df[['Gender']].fillna('Unknown')
-        df[['Birth Year']] = df[['Birth Year']].fillna(0.0)
-        df['Birth Year'] = df['Birth Year'].astype(int)
-
-    # Create an Age column that is zero if Birth Year missing
-    if city != 'washington':
-        df.loc[df['Birth Year'] == 0, 'Age'] = 0
-        df.loc[df['Birth Year'] != 0, 'Age'] = df['Year'] - df['Birth Year']
-        df['Age'] = df['Age'].astype(int)
-
-        # Create new column for Age Group of the users
-        ages = [(df['Age'] == 0),
-                (df['Age'] > 0) & (df['Age'] < 18),
-                (df['Age'] >= 18) & (df['Age'] < 30),
-                (df['Age'] >= 30) & (df['Age'] < 40),
-                (df['Age'] >= 40) & (df['Age'] < 50),
-                (df['Age'] >= 50) & (df['Age'] < 60),
-                (df['Age'] >= 60) & (df['Age'] < 70),
-                (df['Age'] >= 70)]
-        age_groups = ['N/A','<18','18-29','30\'s','40\'s','50\'s','60\'s','70+']
-
-        df['Age Group'] = np.select(ages, age_groups)
-
-    # Calculate user stats and reports based on city
-    if city == 'washington':
-        user_type_count = df.groupby(['User Type'], as_index = False)['Trip'].count()
-        user_type_count = user_type_count.set_index('User Type').rename(columns = {'Trip':'Trips'})
+    # The busiest month, day and hour (in order of appearance, as value_counts())
+    for col in ['Month','Day','Hour']:
+        counts = df.groupby(col, sort = False, observed = True).size().sort_values(ascending = False)
+        summary['Busiest ' + col] = counts.index[0] if len(counts) else None
 
-    else:
-        male = df[df['Gender'] == 'Male']['Trip'].count()
-        female = df[df['Gender'] == 'Female']['Trip'].count()
-        unknown = df[df['Gender'] == 'Unknown']['Trip'].count()
-        user_type_summ = df.groupby(['User Type','Gender'], as_index = False)['Trip'].count()
-        user_type_summ = user_type_summ.pivot(index = ['User Type'], columns = ['Gender'], values = 'Trip')
-        user_type_summ = user_type_summ.fillna(0).astype(int)
-        user_type_summ['Total'] = user_type_summ['Female']+user_type_summ['Male']+user_type_summ['Unknown']
-        birth_yr_max = df['Birth Year'].max()
-        birth_yr_min = df[df['Birth Year'] != 0]['Birth Year'].min()
-        age_max = df['Age'].max()
+    # Where the trips cover more than one year, the busiest month of any year (e.g. 'Mar 2017')
+    if df['Year'].nunique() > 1:
+        year, month = df.groupby(['Year','Month'], sort = False, observed = True).size().idxmax()
+        summary['Busiest Month'] = '{} {}'.format(month, year)
 
-        if age_max > 90:
-            over_90 = df[df['Age'] > 90]
-            over_90_count = len(over_90)
-            over_90 = over_90.groupby(['Birth Year','Age'], as_index = False)['Trip'].count()
-            over_90 = over_90.set_index('Birth Year').rename(columns = {'Trip':'Trips'})
+    minutes = df['Trip Duration'] / 60
+    summary['Mean Trip (mins)'] = round(minutes.mean(), 1)
+    summary['Median Trip (mins)'] = round(minutes.median(), 1)
+    summary['Longest Trip (hrs)'] = round(minutes.max() / 60, 1)
 
-    # Print summary user statistics
-    print('_'*72)
-    print('\nBIKE SHARE USER SUMMARY STATISTICS\n')
+    for col in ['Gender','Birth Year']:
+        summary['% ' + col + ' Recorded'] = round((df[col] != null_values[col]).mean() * 100, 1)
 
-    if city == 'washington':
-        print('Summary of trips by User Type')
-        print(user_type_count)
-        if (month != 'All') & (day != 'All'):
-            input('There are no more user reports available for the data selected. Press Enter to continue...')
-        else:
-            input('Press Enter to continue to the Bike Share User Reports menu...')
-            user_report_menu(df, city, month, day)
-    else:
-        print('Summary of trips by User Type and Gender')
-        print(user_type_summ)
-        print('\nThe number of male users was {}'.format(male))
-        print('The number of female users was {}'.format(female))
-        print('The number of users where the gender is unknown was {}'.format(unknown))
-        print('\nThe earliest Birth Year was {}.'.format(birth_yr_min))
-        print('The latest Birth Year was {}.'.format(birth_yr_max))
+    user_types = df['User Type'].value_counts(normalize = True)
+    for user_type in user_type_order[city]:
+        summary['% ' + user_type] = round(user_types.get(user_type, 0.0) * 100, 1)
 
-        if age_max > 90:
-            print('\nThere were {} trips by users > 90 years old'.format(over_90_count))
-            older = input('Would you like to see a breakdown by Age of trips by users > 90 years old? (Y/N): ')
-            older = older.lower()
+    return summary
 
-            while older not in ['y','n']:
-                older = input('That is not a valid option.  Please enter either \'Y\' or \'N\':')
-                older = older.lower()
+def city_comparison(city, month, day, period):
+    """
+    Loads the data for a city and calculates its comparison summary (see
+    compare_tables).  Run in a worker process by compare_cities().
+    """
+    df = load_filters(load_data(city), month, day, period)
+    return compare_tables(df, city)
 
-            if older == 'y':
-                print('\nSummary of trips by users > 90 years old')
-                print(over_90)
-                input('Press Enter to continue to the Bike Share User Reports menu...')
+def compare_cities(month, day, period = None):
+    """
+    Compares trip volumes, durations and stations across all of the cities, side by
+    side.  The cities are loaded and summarised in parallel, one worker process each.
+
+    Args:
+        month - selected month
+        day - selected day
+        period - the selected date and hour range, or None
+    """
+    import concurrent.futures
+
+    start_time = time.time()
+    numeric_stack()
 
-        user_report_menu(df, city, month, day)
+    cities = [city for city in CITY_DATA if data_file(city) is not None]
+    with concurrent.futures.ProcessPoolExecutor(max_workers = len(cities)) as pool:
+        summaries = list(pool.map(city_comparison, cities, [month] * len(cities),
+                                  [day] * len(cities), [period] * len(cities)))
 
-    # Remove any columns created specifically for user stats
-    if city != 'washington':
-        df = df.drop(['Year','Age','Age Group'], axis = 1, inplace = True)
-    else:
-        df = df.drop(['Year'], axis = 1, inplace = True)
+    comparison = pd.DataFrame(summaries, index = [city.title() for city in cities]).T.fillna('')
+
+    print()
+    print('_'*72)
+    print('\nBIKE SHARE CITY COMPARISON\n')
+    print('Trips selected for month: {}, day: {}{}'.format(month, day, '' if period is None else ', period: ' + period['text']))
+    print()
+    render_table(comparison)
 
     time_spent = time.time() - start_time
     time_spent = datetime.timedelta(seconds = int(time_spent))
-    print("\nThe User Reporting review took {}.".format(time_spent))
+    print("\nThe City Comparison took {}.".format(time_spent))
 
-def data_view(df):
+def find_station(arrays, cols, text, start):
     """
-    Allows users to view the raw data (5 rows at a time). Includes an end of file message.
+    Finds the next row, from the start row onwards, where any of the station columns
+    contains the text provided.  Rows are searched in blocks so that the search stops
+    at the first match without scanning the rest of the data.
 
     Args:
-        df - the dataframe with the selected data
+        arrays - dictionary of the column arrays being paged
+        cols - the station columns to search
+        text - the (case insensitive) text to find
+        start - the first row to search
+
+    Returns:
+        (int) the row number of the next match, or None if there is no match
     """
+    rows = len(arrays[cols[0]])
+    block = 100000
+    for a in range(start, rows, block):
+        found = np.zeros(min(block, rows - a), dtype = bool)
+        for col in cols:
+            found |= pd.Series(arrays[col][a:a+block]).str.contains(text, case = False, regex = False).to_numpy(dtype = bool)
+        if found.any():
+            return a + int(found.argmax())
+
+    return None
+
+def page_data(df, title, page_size = 5, cols = None, show = render_table):
+    """
+    Pages through the rows of a DataFrame, rendering only the rows on the current page.
+
+    Rows are read directly from the underlying column arrays, so the data is never
+    copied, however many rows are selected.  As well as moving forwards and backwards,
+    users can jump to a row, change the page size, search for a station or jump to
+    the first trip starting at or after a given time.
+
+    Args:
+        df - the DataFrame to page through
+        title - heading displayed above each page
+        page_size - number of rows displayed on each page
+        cols - the columns to display (default: all columns)
+        show - function used to display each page
+    """
+    if cols is None:
+        cols = list(df.columns)
+
+    arrays = {col: df[col].to_numpy() for col in cols}
+    index = df.index
+    rows = len(index)
+
+    # Station searches include the index where it holds station names
+    station_cols = [col for col in cols if 'Station' in col]
+    if index.name == 'Station':
+        arrays['Station'] = index.to_numpy()
+        station_cols.append('Station')
+    start_sorted = None
+
+    options = '(Y/N, B = back, G <row> = go to row, P <rows> = page size'
+    if station_cols:
+        options += ', S <name> = find station'
+    if 'Start Time' in cols:
+        options += ', T <time> = find time'
+    options += ')'
 
     x = 0
-    y = 5
-    df = df.drop(['Month','Day','Hour','Trip'], axis = 1)
     while True:
-        print('\nDETAILED DATA - Lists every trip recorded during the period\n')
-        print(df[x:y])
-        if y >= (len(df) - 1):
-            input('Data File End: Press Enter to quit...')
+        y = min(x + page_size, rows)
+        page = pd.DataFrame({col: arrays[col][x:y] for col in cols}, index = index[x:y])
+        print(title)
+        show(page)
+        print('Rows {} to {} of {}'.format(x + 1, y, rows))
+
+        if y >= rows:
+            cont = ask('\nEnd of data. Press Enter to quit, or enter an option {}: '.format(options))
+            if cont.strip() == '':
+                break
+        else:
+            cont = ask('\nWould you like to continue? {}: '.format(options))
+        command = cont.strip()[0:1].lower()
+        arg = cont.strip()[1:].strip()
+
+        if command in ('', 'y'):
+            # The last page stays on screen, rather than moving on to its final row
+            if y >= rows:
+                print('\nThis is the end of the data.')
+            else:
+                x = y
+        elif command == 'n':
             break
-        cont = input('\nWould you like to continue? (Y/N): ')
-        cont = cont.lower()
+        elif command == 'b':
+            x = max(x - page_size, 0)
+        elif command == 'g' and arg.isdigit():
+            x = min(max(int(arg) - 1, 0), max(rows - 1, 0))
+        elif command == 'p' and arg.isdigit() and int(arg) > 0:
+            page_size = int(arg)
+        elif command == 's' and station_cols and arg:
+            found = find_station(arrays, station_cols, arg, x + 1)
+            if found is None:
+                print('\nNo further rows found for station \'{}\'.'.format(arg))
+            else:
+                x = found
+        elif command == 't' and 'Start Time' in cols and arg:
+            try:
+                when = np.datetime64(pd.Timestamp(arg))
+            except ValueError:
+                print('\nSorry, I don\'t recognise that time. Please use the format YYYY-MM-DD HH:MM.')
+                continue
+            starts = arrays['Start Time']
+            if start_sorted is None:
+                start_sorted = bool(np.all(starts[1:] >= starts[:-1]))
+            if start_sorted:
+                found = int(np.searchsorted(starts, when))
+            else:
+                later = np.flatnonzero(starts[x+1:] >= when)
+                found = x + 1 + int(later[0]) if len(later) else rows
+            if found >= rows:
+                print('\nNo trips found starting at or after {}.'.format(arg))
+            else:
+                x = found
+        else:
+            print('\nThat is not a valid option. Please try again.')
 
-        while cont not in ['y','n']:
-            cont = input('That is not a valid option. Please type \'Y\' or \'N\' and press Enter: ')
-            cont = cont.lower()
+def data_view(df):
+    """
+    Allows users to view the raw data (5 rows at a time). Includes an end of file message.
 
-        if cont == 'n':
-            break
-        x += 5
-        y += 5
+    Args:
+        df - the dataframe with the selected data
+    """
+    page_data(df, '\nDETAILED DATA - Lists every trip recorded during the period\n', cols = source_columns(df))
 
-def report_pack(df, city, month, day):
+def report_pack(df, city, month, day, period = None):
     """
     Provides a menu system that allows users to choose the area they want to look at.
     Option 5 gives users access to the raw data (5 rows at a time).  If they do not select
     this option during their session, users will be asked if they want to view the data before they quit.
     However, if users have selected option 5 during their session, they will not be prompted again when they quit.
 
+    Where the session is based on a sample of trips, option E loads the full data in the
+    background.  Once loaded, the session switches to exact figures at the next menu.
+
     Args:
         df - the dataframe with the selected data
         city - the selected city
         month - the selected month filter
         day - the selected day filter
+        period - the selected date and hour range, or None
     """
     viewed = False
+    exact = None
+    messages = []
     while True:
+        # Switch to the full data (and its totals, together) once the background load
+        # has completed, showing the messages held from the load
+        if exact is not None and exact.done():
+            print()
+            for message in messages:
+                print(message)
+            try:
+                full, store = exact.result()
+            except Exception as error:
+                print('The full data could not be loaded ({}). The reports continue to use the sample.'.format(error))
+            else:
+                city_store[city] = store
+                df = load_filters(full, month, day, period)
+                print('The full data has been loaded. All reports now show exact figures.')
+            exact = None
+
         print()
         print('_'*72)
         print('\nBIKE SHARE REPORTING\n')
+        if period is not None:
+            print('Trips are restricted to the period {}.\n'.format(period['text']))
+        if sample_fraction(df) < 1.0:
+            print('Trip counts are estimated from a {:.1%} sample of trips.\n'.format(sample_fraction(df)))
         print('You can select from the following Bike Share Data reporting categories:')
         print('    1. Bike Share Usage Times')
         print('    2. Station and Trip Activity')
         print('    3. Trip Durations')
         print('    4. User Information')
-        print('    5. Raw Data Review (5 rows at a time)\n')
-        select = input('Please enter the category number you would like to review or hit \'Q\' to quit: ')
+        print('    5. Raw Data Review (5 rows at a time)')
+        print('    6. Trip Trends over Time\n')
+        if sample_fraction(df) < 1.0 and exact is None:
+            print('    E. Switch to exact figures (the full data is loaded in the background)\n')
+            options = ['1','2','3','4','5','6','e','q']
+        else:
+            options = ['1','2','3','4','5','6','q']
+        select = ask('Please enter the category number you would like to review or hit \'Q\' to quit: ')
         select = select.lower()
         count = 0
 
         # Handles incorrectly keyed options
-        while select not in ['1','2','3','4','5','q']:
+        while select not in options:
             count += 1
             if count < 3:
-                select = input('That is not a valid option.  Please try again: ')
+                select = ask('That is not a valid option.  Please try again: ')
                 select = select.lower()
             elif count >= 3:
-                select = input('You must enter a number between 1 and 5 or enter \'Q\' to quit: ')
+                select = ask('You must enter a number between 1 and 6 or enter \'Q\' to quit: ')
                 select = select.lower()
 
-        # Calls the relevant reporting functions
-        if select == '1':
-            usage_stats(df, month, day)
-        elif select == '2':
-            station_stats(df)
-        elif select == '3':
-            trip_duration_stats(df, month, day)
-        elif select == '4':
-            user_stats(df, city, month, day)
-        elif select == '5':
-            viewed = True
-            data_view(df)
-        elif select == 'q':
-            if viewed == False:
-                final = input('\nBefore you finish, would you like to review the selected data in detail? (Y/N): ')
-                final = final.lower()
-
-                while final not in ['y','n']:
-                    final = input('That is not a valid option. Please type \'Y\' or \'N\' and press Enter: ')
+        # Calls the relevant reporting functions.  Reports cancelled with Ctrl-C return
+        # to this menu, with the selected data unchanged
+        try:
+            if select == '1':
+                usage_stats(df, month, day)
+            elif select == '2':
+                station_stats(df, city)
+            elif select == '3':
+                trip_duration_stats(df, city, month, day, period)
+            elif select == '4':
+                user_stats(df, city, month, day)
+            elif select == '5':
+                viewed = True
+                data_view(df)
+            elif select == '6':
+                trend_stats(df, city, period)
+            elif select == 'e':
+                import concurrent.futures
+                pool = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+                exact = pool.submit(prepare_data, city, None, messages.append)
+                pool.shutdown(wait = False)
+                print('\nThe full data is loading in the background. You can continue to review the sample in the meantime.')
+            elif select == 'q':
+                if viewed == False:
+                    final = ask('\nBefore you finish, would you like to review the selected data in detail? (Y/N): ')
                     final = final.lower()
 
-                if final == 'y':
-                    data_view(df)
-            break
+                    while final not in ['y','n']:
+                        final = ask('That is not a valid option. Please type \'Y\' or \'N\' and press Enter: ')
+                        final = final.lower()
+
+                    if final == 'y':
+                        data_view(df)
+                break
+        except (Cancelled, KeyboardInterrupt):
+            print('\n\nThe report was cancelled. The selected data is unchanged.')
+
+def json_value(value):
+    """
+    Converts report values that the json module cannot serialise (DataFrames, numpy
+    numbers, timestamps and time periods) into JSON friendly values.
+
+    Args:
+        value - the value to convert
+
+    Returns:
+        the converted value
+    """
+    if isinstance(value, pd.DataFrame):
+        data = value.astype(object).where(value.notna(), None)
+        return {'index_names': list(value.index.names),
+                'index': value.index.tolist(),
+                'columns': [str(col) for col in value.columns],
+                'data': data.to_numpy().tolist()}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return str(value)
+
+    raise TypeError('Cannot convert {} to JSON'.format(type(value).__name__))
+
+def report_data(datasets, report, city, month = 'All', day = 'All', period = None, page = 1, rows = 5):
+    """
+    Calculates one of the reports available in report_pack() for the report server,
+    and returns it as JSON.
+
+    Args:
+        datasets - dictionary of the unfiltered DataFrame for each city
+        report - the report required ('summary', 'usage', 'station', 'duration', 'user',
+                 'raw', 'compare', 'trend' or 'years')
+        city - the selected city
+        month - the month filter selected
+        day - the day filter selected
+        period - the date and hour range selected (as entered by a user), or None
+        page - the page of raw data required (raw report only)
+        rows - the number of rows on each page of raw data (raw report only)
+
+    Returns:
+        (bytes) the report as UTF-8 encoded JSON
+
+    Raises:
+        NoTrips - if the usage, station or duration report is requested for filters
+                  that match no trips
+    """
+    period = parse_period(period) if period else None
+    df = load_filters(datasets[city], month, day, period)
+
+    # The usage, station and duration reports describe the trips selected, so need at least one
+    if len(df) == 0 and report in ('usage','station','duration'):
+        raise NoTrips('No trips match the filters selected')
+
+    if report == 'summary':
+        result = {'summary': city_summary(datasets[city])}
+    elif report == 'usage':
+        result = usage_tables(df)
+    elif report == 'station':
+        result = station_tables(df)
+    elif report == 'duration':
+        result = duration_tables(df, city, month, day, period)
+    elif report == 'compare':
+        result = compare_tables(df, city)
+    elif report == 'trend':
+        result = trend_tables(city_store[city]['series'], None if period is None else period['start'],
+                              None if period is None else period['end'])
+    elif report == 'years':
+        result = year_tables(city_store[city]['year_counts'])
+    elif report == 'user':
+        result = user_tables(df, city)
+        cube = result.pop('cube')
+        reports = [(['User Type'], 'Month'), (['User Type'], 'Day'), (['User Type','Month'], 'Day')]
+        if cube['demographics']:
+            reports += [(['User Type'], 'Age Group'), (['User Type','Gender'], 'Age Group'),
+                        (['User Type','Month'], 'Age Group'), (['User Type','Day'], 'Age Group'),
+                        (['Gender'], 'Age Group'), (['Gender','User Type'], 'Age Group'),
+                        (['Gender','Month'], 'Age Group'), (['Gender','Day'], 'Age Group')]
+        result['reports'] = {' by '.join(rows + [col]): cube_table(cube, rows, col) for rows, col in reports}
+    else:
+        start = (page - 1) * rows
+        result = {'rows': len(df), 'page': page, 'data': text_keys(df.iloc[start:start + rows][source_columns(df)])}
+
+    # The filters are echoed under their own key, as reports may have a 'month' table
+    result['filters'] = {'city': city, 'month': month, 'day': day,
+                         'period': None if period is None else period['text']}
+
+    return json.dumps(result, default = json_value).encode('utf-8')
+
+def share_dataset(df, city):
+    """
+    Places the columns of a city's prepared DataFrame in shared memory blocks, so
+    that worker processes can attach to a single copy of the data rather than each
+    receiving a pickled copy (see attach_dataset).
+
+    Timestamp and numeric columns are shared as they are.  Text and categorical
+    columns are shared as integer codes, with their (much shorter) lists of values
+    in the descriptor.  The arrays of the city's totals (see city_store), e.g. the
+    trip duration sketch, are shared in the same way.
+
+    Args:
+        df - the prepared DataFrame created by load_data()
+        city - the city the data is for
+
+    Returns:
+        descriptor - small dictionary describing the shared blocks, passed to workers
+        blocks - the shared memory blocks, to be closed and unlinked by the caller
+                 once the workers have finished
+    """
+    from multiprocessing import shared_memory
+
+    blocks = []
+
+    def share(values):
+        block = shared_memory.SharedMemory(create = True, size = max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype = values.dtype, buffer = block.buf)[:] = values
+        blocks.append(block)
+        return {'block': block.name, 'dtype': values.dtype.str, 'shape': values.shape}
+
+    def numeric(value):
+        return isinstance(value, np.ndarray) and value.dtype.kind in 'biufmM'
+
+    # The station row index is only used by the interactive reports, so is not sent to
+    # workers.  The numeric arrays of the totals (also those in the series and year
+    # counts) are shared, and listed with their keys in the store.
+    store = {}
+    arrays = []
+    for key, value in city_store.get(city, {}).items():
+        if key == 'station_index':
+            continue
+        if isinstance(value, dict):
+            store[key] = {sub: None if numeric(item) else item for sub, item in value.items()}
+            arrays += [{'keys': [key, sub], **share(item)} for sub, item in value.items() if numeric(item)]
+        elif numeric(value):
+            store[key] = None
+            arrays.append({'keys': [key], **share(value)})
+        else:
+            store[key] = value
+
+    descriptor = {'city': city, 'rows': len(df), 'attrs': dict(df.attrs),
+                  'store': store, 'arrays': arrays, 'columns': []}
+
+    for col in df.columns:
+        values = df[col].to_numpy()
+        categories = None
+        ordered = None
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            # Categorical columns keep their categories (and their order)
+            values = df[col].cat.codes.to_numpy().astype(np.int32)
+            categories = list(df[col].cat.categories)
+            ordered = df[col].cat.ordered
+        elif values.dtype.kind not in 'biufmM':
+            codes, categories = pd.factorize(values)
+            values = codes.astype(np.int32)
+            categories = list(categories)
+
+        descriptor['columns'].append({'name': col, **share(values), 'categories': categories, 'ordered': ordered})
+
+    return descriptor, blocks
+
+def attach_dataset(descriptor):
+    """
+    Attaches to a city's data placed in shared memory by share_dataset(), without
+    copying it.  Text columns are attached as categorical columns over the shared
+    codes, which the reports group on directly, converting only their results back
+    to text (see text_keys).  The city's totals are placed in city_store.
+
+    Args:
+        descriptor - the descriptor created by share_dataset()
+
+    Returns:
+        df - DataFrame backed by the shared memory blocks
+        blocks - the attached blocks, which must be kept open while df is in use
+    """
+    from multiprocessing import shared_memory
+
+    numeric_stack()
+    blocks = []
+
+    def attach(entry):
+        block = shared_memory.SharedMemory(name = entry['block'])
+        blocks.append(block)
+        return np.ndarray(entry['shape'], dtype = np.dtype(entry['dtype']), buffer = block.buf)
+
+    data = {}
+    for col in descriptor['columns']:
+        values = attach(col)
+        if col['categories'] is not None:
+            # The shared codes are used as they are (missing values have the code -1)
+            values = pd.Categorical.from_codes(values, col['categories'], ordered = bool(col['ordered']))
+        data[col['name']] = values
+
+    df = pd.DataFrame(data, copy = False)
+    df.attrs.update(descriptor['attrs'])
+
+    store = {key: dict(value) if isinstance(value, dict) else value for key, value in descriptor['store'].items()}
+    for entry in descriptor['arrays']:
+        if len(entry['keys']) == 1:
+            store[entry['keys'][0]] = attach(entry)
+        else:
+            store[entry['keys'][0]][entry['keys'][1]] = attach(entry)
+    city_store[descriptor['city']] = store
+
+    return df, blocks
+
+def text_keys(frame):
+    """
+    Converts the categorical columns of a grouped result (or a page of trips) back to
+    text.  The reports group data attached from shared memory (see attach_dataset) on
+    its categorical codes, and only their (small) results are converted, so that they
+    are exactly as for data loaded by load_data().  Other results are returned unchanged.
+
+    Args:
+        frame - the DataFrame of results
+
+    Returns:
+        frame - the DataFrame with text columns
+    """
+    text = [col for col in frame.columns if isinstance(frame[col].dtype, pd.CategoricalDtype)]
+    if not text:
+        return frame
+
+    return frame.astype({col: object for col in text})
+
+def attach_worker(descriptors):
+    """
+    Initialises a worker process by attaching to the shared data for each city.  The
+    data is released when the worker exits (see detach_worker).
+
+    Args:
+        descriptors - list of descriptors created by share_dataset()
+    """
+    from multiprocessing import util
+
+    for descriptor in descriptors:
+        worker_datasets[descriptor['city']] = attach_dataset(descriptor)
+    util.Finalize(None, detach_worker, exitpriority = 10)
+
+def detach_worker():
+    """
+    Releases the shared data attached by a worker process.  The DataFrames and totals
+    are dropped first, as a block cannot be closed while arrays still use its memory.
+    """
+    for city in list(worker_datasets):
+        df, blocks = worker_datasets.pop(city)
+        city_store.pop(city, None)
+        del df
+        for block in blocks:
+            block.close()
+
+def worker_report(*key):
+    """
+    Calculates a report in a worker process from the shared data (see report_data).
+    """
+    return report_data({city: worker_datasets[city][0] for city in worker_datasets}, *key)
+
+def serve(host = '127.0.0.1', port = 8000, workers = 4, processes = False):
+    """
+    Runs a local HTTP server providing the reports available in report_pack() as JSON,
+    so that many users (and dashboards) can share one copy of the data for each city.
+
+    The data for every city in CITY_DATA is loaded once at startup.  Requests are
+    handled by an asyncio event loop, and reports are calculated by a pool of worker
+    threads or, optionally, worker processes (which attach to the data in shared
+    memory, so there is still one copy of it).  Concurrent requests for the same
+    report share one calculation, and recent results are cached (the data does not
+    change while the server runs).
+
+    Requests take the form:
+        GET /cities
+        GET /report/<report>/<city>?month=Mar&day=Mon&period=2017-03-01 to 2017-03-31&page=1&rows=5
+
+    where <report> is one of summary, usage, station, duration, user, raw, compare,
+    trend or years.
+    The compare report may also be requested for the city 'all', which summarises
+    every city in parallel.
+
+    Args:
+        host - the address to listen on (local connections only by default)
+        port - the port to listen on
+        workers - the number of worker threads (or processes) calculating reports
+        processes - True to calculate reports in worker processes rather than threads
+    """
+    import asyncio
+    import collections
+    import concurrent.futures
+    import urllib.parse
+
+    datasets = {}
+    for city in CITY_DATA:
+        if data_file(city) is not None:
+            print('Loading data for {} ...'.format(city.title()))
+            datasets[city] = load_data(city)
+
+    blocks = []
+    if processes:
+        descriptors = []
+        for city in datasets:
+            descriptor, city_blocks = share_dataset(datasets[city], city)
+            descriptors.append(descriptor)
+            blocks += city_blocks
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = attach_worker, initargs = (descriptors,))
+        calculate = (worker_report,)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        calculate = (report_data, datasets)
+    cache = collections.OrderedDict()
+    running = {}
+
+    async def get_report(key):
+        # Return a cached result, or share a calculation already in progress
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        if key not in running:
+            running[key] = asyncio.get_running_loop().run_in_executor(pool, *calculate, *key)
+        try:
+            result = await asyncio.shield(running[key])
+        finally:
+            running.pop(key, None)
+
+        cache[key] = result
+        if len(cache) > SERVER_CACHE_SIZE:
+            cache.popitem(last = False)
+
+        return result
+
+    async def respond(path):
+        url = urllib.parse.urlsplit(path)
+        parts = [urllib.parse.unquote(part) for part in url.path.strip('/').split('/')]
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        if parts == ['cities']:
+            return 200, json.dumps({city: len(datasets[city]) for city in datasets}).encode('utf-8')
+
+        if len(parts) != 3 or parts[0] != 'report':
+            return 404, b'{"error": "Not found"}'
+
+        report, city = parts[1], parts[2].lower()
+        month = query.get('month', 'All').title()[0:3]
+        day = query.get('day', 'All').title()[0:3]
+        period = query.get('period') or None
+        page = query.get('page', '1')
+        rows = query.get('rows', '5')
+
+        if report not in ('summary','usage','station','duration','user','raw','compare','trend','years'):
+            return 404, b'{"error": "Unknown report"}'
+        if city not in datasets and not (report == 'compare' and city == 'all'):
+            return 404, b'{"error": "Unknown city"}'
+        if month not in month_names + ['All'] or day not in day_order + ['All']:
+            return 400, b'{"error": "Unknown month or day"}'
+        if period is not None and parse_period(period) is None:
+            return 400, b'{"error": "Unrecognised period"}'
+        if not (page.isdigit() and rows.isdigit() and int(page) > 0 and int(rows) > 0):
+            return 400, b'{"error": "Invalid page or rows"}'
+
+        if city == 'all':
+            # Each city is summarised by a separate worker, in parallel
+            results = await asyncio.gather(*[get_report((report, city, month, day, period, 1, 5)) for city in datasets])
+            return 200, b'{' + b', '.join(json.dumps(city).encode('utf-8') + b': ' + result
+                                          for city, result in zip(datasets, results)) + b'}'
+
+        try:
+            return 200, await get_report((report, city, month, day, period, int(page), int(rows)))
+        except NoTrips as error:
+            return 400, json.dumps({'error': str(error)}).encode('utf-8')
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+
+                keep_alive = True
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    if header.lower().startswith(b'connection:') and b'close' in header.lower():
+                        keep_alive = False
+
+                method, path = (request.decode('latin-1').split() + ['', ''])[0:2]
+                if method != 'GET':
+                    status, body = 405, b'{"error": "Only GET requests are supported"}'
+                else:
+                    try:
+                        status, body = await respond(path)
+                    except Exception as error:
+                        status, body = 500, json.dumps({'error': str(error)}).encode('utf-8')
+
+                reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                          405: 'Method Not Allowed', 500: 'Internal Server Error'}[status]
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n'
+                             .format(status, reason, len(body), '' if keep_alive else 'Connection: close\r\n')
+                             .encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle, host, port)
+        print('Bike Share report server running on http://{}:{}/ (Ctrl-C to stop)'.format(host, port))
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print('\nBike Share report server stopped.')
+    finally:
+        pool.shutdown()
+        for block in blocks:
+            block.close()
+            block.unlink()
 
 def main():
+    numeric_stack(wait = False)
     while True:
         # City selection
         city = get_city()
-        print('\nRetrieving data ...\n')
-        # Data loaded and summary table presented
-        df = load_data(city)
-        city_summ = city_summary(df)
-        print('\nBelow is a summary of trip volumes by month and day for {}'.format(city.title()))
-        print()
-        print(city_summ)
-        input('Press Enter to continue...')
-        # Month and Day filters obtained and applied
-        month, day = get_filters()
-        df = load_filters(df,month,day)
-        print('\nThankyou, the required data has been selected.')
-        time.sleep(2)
-        # Reporting initiated
-        report_pack(df, city, month, day)
+        if city == 'all':
+            # All cities compared side by side for the selected month and day
+            month, day, period = get_filters()
+            compare_cities(month, day, period)
+        else:
+            # A load cancelled with Ctrl-C returns to the city selection
+            try:
+                # Large files can be reviewed quickly from a sample of trips, unless
+                # their cleaned data is cached (which loads more quickly than a sample)
+                sample = None
+                if os.path.getsize(data_file(city)) > SAMPLE_THRESHOLD and clean_cache(city) is None:
+                    quick = ask('\nThe {} data is large. Would you like a quick review based on a {:.0%} sample of trips? (Y/N): '.format(city.title(), SAMPLE_FRACTION))
+                    quick = quick.lower()
+
+                    while quick not in ['y','n']:
+                        quick = ask('That is not a valid option. Please type \'Y\' or \'N\' and press Enter: ')
+                        quick = quick.lower()
+
+                    if quick == 'y':
+                        sample = SAMPLE_FRACTION
+                # Summary table presented from the catalog, or from the data if there is no catalog
+                entry = read_catalog(city)
+                if entry is None:
+                    print('\nRetrieving data ...\n')
+                    df = run_cancellable('Loading the {} data'.format(city.title()), load_data, city, sample)
+                    city_summ = city_summary(df)
+                    frac = sample_fraction(df)
+                else:
+                    df = None
+                    city_summ = catalog_summary(entry)
+                    frac = 1.0
+                    print('\n{} has {:,} trips from {} to {}, across {:,} stations.'.format(
+                          city.title(), entry['rows'], entry['first_start'][0:10], entry['last_start'][0:10], entry['stations']))
+                print('\nBelow is a summary of trip volumes by month and day for {}'.format(city.title()))
+                print()
+                show_counts(city_summ, frac)
+                pause('Press Enter to continue...')
+                # Month and Day filters obtained, then data loaded (if not already) and filtered
+                if entry is None:
+                    month, day, period = get_filters(report_months(df), year_list(city_store[city]['year_counts']))
+                else:
+                    month, day, period = get_filters(entry['months'], entry.get('years'))
+                if df is None:
+                    print('\nRetrieving data ...\n')
+                    df = run_cancellable('Loading the {} data'.format(city.title()), load_data, city, sample)
+                selected = load_filters(df,month,day,period)
+
+                # A selection with no trips has nothing to report, so the filters are chosen again
+                while len(selected) == 0:
+                    print('\nSorry, no trips match the filters selected. Please select again.')
+                    month, day, period = get_filters(report_months(df), year_list(city_store[city]['year_counts']))
+                    selected = load_filters(df,month,day,period)
+
+                df = selected
+                print('\nThankyou, the required data has been selected.')
+                if replay is None:
+                    time.sleep(2)
+                # Reporting initiated
+                report_pack(df, city, month, day, period)
+            except Cancelled:
+                print('\n\nLoading the data was cancelled.')
+                continue
         # Review re-start option
-        restart = input('\nWould you like to review another city? (Y/N): ')
+        restart = ask('\nWould you like to review another city? (Y/N): ')
         restart = restart.lower()
 
         while restart.lower() not in ['y','n']:
-            restart = input('That is not a valid option. Please type \'Y\' or \'N\' and press Enter: ')
+            restart = ask('That is not a valid option. Please type \'Y\' or \'N\' and press Enter: ')
             restart = restart.lower()
 
         if restart == 'n':
             break
 
+def replay_session(path):
+    """
+    Replays an interactive session from a script of answers, one per line (lines
+    starting with '#' are ignored), and reports the latency of each step: the time
+    taken from an answer being given until the next question is asked.  "Press
+    Enter" pauses, and the pause after the data is selected, are skipped.  The
+    replay ends when the session ends or the script runs out of answers.
+
+    Args:
+        (str) path - the script of answers
+    """
+    global replay
+    with open(path) as f:
+        answers = [line.rstrip('\n') for line in f if not line.startswith('#')]
+
+    replay = {'answers': answers, 'steps': [], 'start': time.perf_counter()}
+    try:
+        main()
+    except EOFError:
+        pass
+    finally:
+        finish_step()
+        steps, replay = replay['steps'], None
+
+    numeric_stack()
+    report = pd.DataFrame(steps, columns = ['Prompt','Answer','Seconds'])
+    report.index = pd.RangeIndex(1, len(report) + 1, name = 'Step')
+    report['Prompt'] = report['Prompt'].str.slice(0, 40)
+
+    print('_'*72)
+    print('\nSESSION REPLAY\n')
+    print('{} steps replayed from {}, taking {:.2f} seconds in total.'.format(len(report), path, report['Seconds'].sum()))
+    print('\nLatency of each step (seconds from the answer to the next question):')
+    render_table(report.round({'Seconds': 3}))
 
 if __name__ == "__main__":
-	main()
+	parser = argparse.ArgumentParser(description = 'US Bike Share Reporting Package')
+	parser.add_argument('--serve', action = 'store_true', help = 'run the JSON report server instead of the interactive reports')
+	parser.add_argument('--host', default = '127.0.0.1', help = 'address for the report server to listen on')
+	parser.add_argument('--port', type = int, default = 8000, help = 'port for the report server to listen on')
+	parser.add_argument('--workers', type = int, help = 'number of report server workers (default 4), or report processes (default one for each CPU)')
+	parser.add_argument('--processes', action = 'store_true', help = 'use worker processes (sharing the data in shared memory) rather than threads')
+	parser.add_argument('--memory-budget', type = int, default = MEMORY_BUDGET // 1024**2, help = 'memory available for each city\'s data in MB')
+	parser.add_argument('--replay', metavar = 'SCRIPT', help = 'replay a session from a script of answers (one per line) and report the latency of each step')
+	parser.add_argument('--report', metavar = 'CITY', type = str.lower, choices = list(CITY_DATA), help = 'print the summary statistics for a city, calculated in parallel by worker processes')
+	parser.add_argument('--month', default = 'All', type = lambda text: text.title()[0:3], choices = month_names + ['All'], help = 'month filter for --report')
+	parser.add_argument('--day', default = 'All', type = lambda text: text.title()[0:3], choices = day_order + ['All'], help = 'day filter for --report')
+	parser.add_argument('--period', help = 'date and hour range for --report (e.g. "2017-03-01 to 2017-03-09")')
+	args = parser.parse_args()
+	MEMORY_BUDGET = args.memory_budget * 1024**2
+
+	period = None
+	if args.period is not None:
+		numeric_stack()
+		period = parse_period(args.period)
+		if period is None:
+			parser.error('unrecognised period: {}'.format(args.period))
+
+	if args.serve:
+		serve(args.host, args.port, args.workers or 4, args.processes)
+	elif args.report:
+		city_report(args.report, args.month, args.day, period, args.workers)
+	elif args.replay:
+		replay_session(args.replay)
+	else:
+		main()